@@ -0,0 +1,200 @@
+import os
+import re
+import asyncio
+import logging
+
+from collections import deque
+from fastapi import HTTPException, status
+from jose import JWTError, jwt
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+from typing import Deque, Dict, List, Optional
+from dotenv import load_dotenv
+
+from auth import ALGORITHM, SECRET_KEY, principal_cache
+from storage import MAX_SIZE_BYTES
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+UPLOAD_MAX_CONCURRENT = int(os.environ.get('UPLOAD_MAX_CONCURRENT', 64))
+UPLOAD_MAX_IN_FLIGHT_MB = int(os.environ.get('UPLOAD_MAX_IN_FLIGHT_MB', 1024))
+UPLOAD_USER_MAX_CONCURRENT = int(os.environ.get('UPLOAD_USER_MAX_CONCURRENT', 4))
+UPLOAD_USER_MAX_IN_FLIGHT_MB = int(os.environ.get('UPLOAD_USER_MAX_IN_FLIGHT_MB', 256))
+UPLOAD_QUEUE_LIMIT = int(os.environ.get('UPLOAD_QUEUE_LIMIT', 256))
+UPLOAD_QUEUE_TIMEOUT_SECONDS = float(os.environ.get('UPLOAD_QUEUE_TIMEOUT_SECONDS', 10))
+
+RETRY_AFTER_SECONDS = 5
+
+# requests whose body is file content, multipart bodies are parsed before any dependency runs,
+# so admission has to happen in front of the router
+UPLOAD_ROUTES = [
+    ("PUT", re.compile(r"^/files/(?!uploads/)[^/]+$")),
+    ("POST", re.compile(r"^/files/(upload|batch)$")),
+    ("PUT", re.compile(r"^/files/uploads/[^/]+/chunks/[^/]+$")),
+]
+
+
+class Waiter:
+    def __init__(self, user: Optional[str], size: int):
+        self.user = user
+        self.size = size
+        self.future = asyncio.get_running_loop().create_future()
+        # set when the waiter was last held back by its own user's limits rather than the global ones
+        self.user_limited = False
+
+
+class UploadAdmission:
+    """
+    Bounds uploads running at once and the bytes they bring, globally and per user. Requests over
+    a limit wait in a FIFO queue, a waiter held back only by its own user's limits doesn't block
+    the users behind it. A request alone is always admitted, whatever its size. Waiting longer than
+    queue_timeout is answered with 429 when the user's own limits were in the way, 503 otherwise,
+    as is a request that finds queue_limit requests already waiting.
+    """
+
+    def __init__(self,
+                 max_concurrent: int,
+                 max_bytes: int,
+                 user_max_concurrent: int,
+                 user_max_bytes: int,
+                 queue_limit: int,
+                 queue_timeout: float):
+        self.max_concurrent = max_concurrent
+        self.max_bytes = max_bytes
+        self.user_max_concurrent = user_max_concurrent
+        self.user_max_bytes = user_max_bytes
+        self.queue_limit = queue_limit
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.in_flight_bytes = 0
+        self.rejected = 0
+        # per user: uploads running and their bytes
+        self.users: Dict[str, List[int]] = {}
+        self.queue: Deque[Waiter] = deque()
+
+    def _fits(self, size: int) -> bool:
+        return self.in_flight == 0 or (self.in_flight < self.max_concurrent
+                                       and self.in_flight_bytes + size <= self.max_bytes)
+
+    def _fits_user(self, user: Optional[str], size: int) -> bool:
+        count, used = self.users.get(user, (0, 0))
+        return count == 0 or (count < self.user_max_concurrent and used + size <= self.user_max_bytes)
+
+    def _take(self, user: Optional[str], size: int):
+        self.in_flight += 1
+        self.in_flight_bytes += size
+        usage = self.users.setdefault(user, [0, 0])
+        usage[0] += 1
+        usage[1] += size
+
+    def release(self, user: Optional[str], size: int):
+        self.in_flight -= 1
+        self.in_flight_bytes -= size
+        usage = self.users[user]
+        usage[0] -= 1
+        usage[1] -= size
+        if usage[0] == 0:
+            del self.users[user]
+        self._admit_waiters()
+
+    def _admit_waiters(self):
+        for waiter in list(self.queue):
+            if not self._fits_user(waiter.user, waiter.size):
+                waiter.user_limited = True
+                continue
+            waiter.user_limited = False
+            if not self._fits(waiter.size):
+                break
+            self.queue.remove(waiter)
+            self._take(waiter.user, waiter.size)
+            waiter.future.set_result(None)
+
+    def _reject(self, status_code: int, detail: str):
+        self.rejected += 1
+        logger.error(msg=f"Upload rejected with {status_code}, {self.in_flight} in flight, {len(self.queue)} queued")
+        raise HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+
+    def _abandon(self, waiter: Waiter):
+        if waiter.future.done():
+            # admitted just as the wait ended
+            self.release(waiter.user, waiter.size)
+            return
+        waiter.future.cancel()
+        self.queue.remove(waiter)
+        self._admit_waiters()
+
+    async def acquire(self, user: Optional[str], size: int):
+        """Wait for room for an upload of size bytes, call release(user, size) once it's done."""
+        if not self.queue and self._fits(size) and self._fits_user(user, size):
+            self._take(user, size)
+            return
+        if len(self.queue) >= self.queue_limit:
+            self._reject(status.HTTP_503_SERVICE_UNAVAILABLE, "Server is busy, please, try again later")
+        waiter = Waiter(user, size)
+        self.queue.append(waiter)
+        self._admit_waiters()
+        try:
+            await asyncio.wait({waiter.future}, timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+        if waiter.future.done():
+            return
+        self._abandon(waiter)
+        if waiter.user_limited:
+            self._reject(status.HTTP_429_TOO_MANY_REQUESTS, "Too many uploads in progress, please, try again later")
+        self._reject(status.HTTP_503_SERVICE_UNAVAILABLE, "Server is busy, please, try again later")
+
+
+upload_admission = UploadAdmission(max_concurrent=UPLOAD_MAX_CONCURRENT,
+                                   max_bytes=UPLOAD_MAX_IN_FLIGHT_MB * 1024 * 1024,
+                                   user_max_concurrent=UPLOAD_USER_MAX_CONCURRENT,
+                                   user_max_bytes=UPLOAD_USER_MAX_IN_FLIGHT_MB * 1024 * 1024,
+                                   queue_limit=UPLOAD_QUEUE_LIMIT,
+                                   queue_timeout=UPLOAD_QUEUE_TIMEOUT_SECONDS)
+
+
+def is_upload(scope: Scope) -> bool:
+    return any(scope["method"] == method and pattern.match(scope["path"]) for method, pattern in UPLOAD_ROUTES)
+
+
+def upload_user(authorization: str) -> Optional[str]:
+    """Username the bearer token was issued to. Invalid tokens get None, the route rejects them anyway."""
+    scheme, _, token = authorization.partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return None
+    cached_user = principal_cache.get(token)
+    if cached_user is not None:
+        return cached_user.username
+    try:
+        return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+    except JWTError:
+        return None
+
+
+class UploadAdmissionMiddleware:
+    """Runs upload_admission in front of upload routes, sized by Content-Length or MAX_SIZE_BYTES without it."""
+
+    def __init__(self, app: ASGIApp, admission: UploadAdmission = upload_admission):
+        self.app = app
+        self.admission = admission
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not is_upload(scope):
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        user = upload_user(headers.get(b"authorization", b"").decode("latin-1"))
+        content_length = headers.get(b"content-length", b"")
+        size = int(content_length) if content_length.isdigit() else MAX_SIZE_BYTES
+        try:
+            await self.admission.acquire(user, size)
+        except HTTPException as error:
+            response = JSONResponse({"detail": error.detail}, status_code=error.status_code, headers=error.headers)
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.admission.release(user, size)
@@ -1,14 +1,19 @@
 import os
+import time
 import logging
 
 from jose import JWTError, jwt
 from fastapi import Depends, HTTPException, status
 from datetime import datetime, timedelta
 from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy.event import listens_for
 from dotenv import load_dotenv
 
+from cache import TTLCache
 from crud import UserCRUD
-from schemas import TokenData
+from logs import bind, log_step
+from models import User
+from schemas import TokenData, UserRead
 
 logger = logging.getLogger(__name__)
 
@@ -17,9 +22,14 @@ load_dotenv()
 ALGORITHM = os.environ.get('PASSWORD_HASH_ALGORITHM')
 SECRET_KEY = os.environ.get('PASSWORD_HASH_SECRET_KEY')
 EXPIRE = int(os.environ.get('ACCESS_TOKEN_EXPIRE_MINUTES'))
+AUTH_CACHE_SIZE = int(os.environ.get('AUTH_CACHE_SIZE', 10000))
+AUTH_CACHE_TTL_SECONDS = int(os.environ.get('AUTH_CACHE_TTL_SECONDS', 60))
 
 oauth2_schema = OAuth2PasswordBearer(tokenUrl='/users/token')
 
+# resolved users by access token, entries never outlive the token itself
+principal_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL_SECONDS)
+
 credentials_error = HTTPException(
     status_code=status.HTTP_401_UNAUTHORIZED,
     detail="Invalid authentication credentials",
@@ -28,7 +38,7 @@ credentials_error = HTTPException(
 
 
 def create_token(username: str) -> dict:
-    logger.info(msg="Start create_token")
+    log_step(logger, "Start create_token")
     access_token_expires = timedelta(minutes=EXPIRE)
     response = {
         "access_token": create_access_token(
@@ -37,61 +47,85 @@ def create_token(username: str) -> dict:
         ),
         "token_type": "bearer",
     }
-    logger.info(msg="End create_token")
+    log_step(logger, "End create_token")
     return response
 
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
-    logger.info(msg="Start create_access_token")
+    log_step(logger, "Start create_access_token")
     to_encode = data.copy()
     if expires_delta:
-        logger.debug(msg=f"ACCESS_TOKEN_EXPIRE_MINUTES is {expires_delta}")
+        logger.debug("ACCESS_TOKEN_EXPIRE_MINUTES is %s", expires_delta)
         expire = datetime.utcnow() + expires_delta
     else:
-        logger.debug(msg=f"ACCESS_TOKEN_EXPIRE_MINUTES don't set, set as 15 minutes as default")
+        logger.debug(msg="ACCESS_TOKEN_EXPIRE_MINUTES don't set, set as 15 minutes as default")
         expire = datetime.utcnow() + timedelta(minutes=15)
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    logger.info(msg="End create_access_token")
+    log_step(logger, "End create_access_token")
     return encoded_jwt
 
 
-def get_current_user(users: UserCRUD = Depends(), token: str = Depends(oauth2_schema)):
-    logger.info(msg="Start get_current_user")
+def invalidate_user(username: str):
+    """Drop every cached principal of the user, call it whenever the user's record changes."""
+    principal_cache.discard_group(username)
+
+
+@listens_for(User, "after_update")
+@listens_for(User, "after_delete")
+def invalidate_changed_user(mapper, connection, target: User):
+    invalidate_user(target.username)
+
+
+async def get_current_user(users: UserCRUD = Depends(), token: str = Depends(oauth2_schema)) -> UserRead:
+    log_step(logger, "Start get_current_user")
+    cached_user = principal_cache.get(token)
+    if cached_user is not None:
+        bind(user_id=cached_user.id)
+        log_step(logger, "End get_current_user, user found in cache")
+        return cached_user
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        logger.debug(msg="Start decoding users token")
+        log_step(logger, "Start decoding users token", level=logging.DEBUG)
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
             logger.error(msg="There are not username in decoded token")
             raise credentials_exception
         token_data = TokenData(username=username)
-        logger.debug(msg="End decoding users token")
+        log_step(logger, "End decoding users token", level=logging.DEBUG)
     except JWTError:
         logger.error(msg=f"Can't decode token: {token}")
         raise credentials_exception
     username = token_data.username
-    user = users.read_by_username(username=username)
+    user = await users.read_by_username(username=username)
     if user is None:
         logger.error(msg=f"There are not {username} in registered users")
         raise credentials_exception
-    logger.info(msg="End get_current_user")
-    return user
+    current_user = UserRead.from_orm(user)
+    token_ttl = payload["exp"] - time.time() if "exp" in payload else None
+    principal_cache.set(token, current_user, ttl=token_ttl, group=current_user.username)
+    bind(user_id=current_user.id)
+    log_step(logger, "End get_current_user")
+    return current_user
 
 
-def authenticate_user(username: str, password: str, users: UserCRUD):
-    logger.info(msg="Start authenticate_user")
-    user = users.read_by_username(username=username)
+async def authenticate_user(username: str, password: str, users: UserCRUD):
+    log_step(logger, "Start authenticate_user")
+    user = await users.read_by_username(username=username)
     if not user:
         logger.error(msg=f"Username '{username}' not found")
         raise credentials_error
-    if not users.verify_password(password, user.hashed_password):
+    verified, new_hashed_password = await users.verify_and_update_password(password, user.hashed_password)
+    if not verified:
         logger.error(msg=f"Wrong password")
         raise credentials_error
-    logger.info(msg="End authenticate_user")
+    if new_hashed_password:
+        logger.info("Rehashing password of '%s' with current cost", username)
+        await users.update_hashed_password(user, new_hashed_password)
+    log_step(logger, "End authenticate_user")
     return user
@@ -0,0 +1,408 @@
+"""
+Benchmarks of the upload, listing, auth and delete paths, run in-process against the ASGI app.
+
+The schema is dropped and created again in the database named by BENCHMARK_DB_DATABASE, the rest of
+the connection settings are the usual DB_* ones, so point it at a throwaway database, e.g.
+    docker run --rm -p 5432:5432 -e POSTGRES_PASSWORD=postgres -e POSTGRES_DB=bench postgres:14
+    BENCHMARK_DB_DATABASE=bench python benchmark.py --output results.json
+Stored content goes to a temporary directory that is removed afterwards. A previous run is compared
+against with --baseline, or two result files with --compare; a metric that got worse by more than
+--tolerance fails the run.
+"""
+import os
+import sys
+import json
+import logging
+import time
+import uuid
+import shutil
+import asyncio
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+
+# the app's modules are imported by the functions using them, their settings are read on import and
+# are put in place by configure() first, --compare only reads files and doesn't need them at all
+
+Results = Dict[str, Dict[str, float]]
+
+UPLOAD_SIZES = (1024, 64 * 1024, 1024 * 1024, 8 * 1024 * 1024)
+UPLOAD_CONCURRENCY = (1, 8, 32)
+LIST_SIZES = (10, 10_000, 1_000_000)
+HASH_SIZES = (1024 * 1024, 64 * 1024 * 1024)
+INSERT_BATCH_SIZE = 10_000
+
+
+class Response:
+    def __init__(self, status: int, headers: Dict[str, str], body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body)
+
+
+async def request(method: str,
+                  path: str,
+                  token: Optional[str] = None,
+                  body: bytes = b'',
+                  headers: Optional[Dict[str, str]] = None,
+                  query: Optional[dict] = None) -> Response:
+    """Call the app the way a server would, without sockets, so only the app's own cost is measured."""
+    from main import app
+
+    headers = {**(headers or {}), 'content-length': str(len(body))}
+    if token:
+        headers['authorization'] = f'Bearer {token}'
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': urlencode(query or {}).encode(),
+        'root_path': '',
+        'headers': [(key.lower().encode(), value.encode()) for key, value in headers.items()],
+        'client': ('127.0.0.1', 50000),
+        'server': ('benchmark', 80),
+    }
+    chunk_size = 1024 * 1024
+    chunks = [body[offset:offset + chunk_size] for offset in range(0, len(body), chunk_size)] or [b'']
+    status, response_headers, response_body = 500, {}, []
+
+    async def receive():
+        if chunks:
+            chunk = chunks.pop(0)
+            return {'type': 'http.request', 'body': chunk, 'more_body': bool(chunks)}
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        nonlocal status, response_headers
+        if message['type'] == 'http.response.start':
+            status = message['status']
+            response_headers = {key.decode(): value.decode() for key, value in message.get('headers', [])}
+        elif message['type'] == 'http.response.body':
+            response_body.append(message.get('body', b''))
+
+    await app(scope, receive, send)
+    return Response(status, response_headers, b''.join(response_body))
+
+
+def check(response: Response, expected_status: int = 200) -> Response:
+    if response.status != expected_status:
+        raise RuntimeError(f"Expected {expected_status}, got {response.status}: {response.body[:200]!r}")
+    return response
+
+
+def latency_stats(prefix: str, seconds: List[float]) -> Dict[str, float]:
+    milliseconds = sorted(value * 1000 for value in seconds)
+    return {
+        f'{prefix}p50_ms': statistics.median(milliseconds),
+        f'{prefix}p95_ms': milliseconds[min(len(milliseconds) - 1, int(len(milliseconds) * 0.95))],
+    }
+
+
+async def timed(call) -> Tuple[float, object]:
+    start = time.perf_counter()
+    result = await call
+    return time.perf_counter() - start, result
+
+
+async def create_user() -> Tuple[int, str]:
+    import database
+    from auth import create_token
+    from crud import UserCRUD
+    from schemas import UserCreate
+
+    username = f'b{uuid.uuid4().hex[:19]}'
+    async with database.SessionLocal() as db:
+        user = await UserCRUD(db).create(UserCreate(username=username,
+                                                    email=f'{username}@example.com',
+                                                    password='benchmark'))
+        user_id = user.id
+    return user_id, create_token(username)['access_token']
+
+
+async def put_content(token: str, content: bytes) -> Response:
+    return await request('PUT', f'/files/{uuid.uuid4().hex}.bin', token=token, body=content,
+                         headers={'content-type': 'application/octet-stream'})
+
+
+async def upload(token: str, content: bytes) -> Response:
+    return check(await put_content(token, content))
+
+
+async def bench_hash(iterations: int) -> Results:
+    from crud import hash_file
+
+    results = {}
+    for size in HASH_SIZES:
+        content = os.urandom(size)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            hash_file(content)
+        results[f'hash_file_{size}'] = {'mb_per_second': size * iterations / (time.perf_counter() - start) / 2 ** 20}
+    return results
+
+
+async def bench_tokens(iterations: int) -> Results:
+    from auth import create_token, principal_cache
+
+    user_id, token = await create_user()
+    username = (await request('GET', '/users/logined_user', token=token)).json()['username']
+    start = time.perf_counter()
+    for _ in range(iterations):
+        create_token(username)
+    issued = iterations / (time.perf_counter() - start)
+
+    verify_uncached, verify_cached = [], []
+    for _ in range(iterations):
+        principal_cache.clear()
+        verify_uncached.append((await timed(request('GET', '/users/logined_user', token=token)))[0])
+        verify_cached.append((await timed(request('GET', '/users/logined_user', token=token)))[0])
+    return {
+        'token_issue': {'per_second': issued},
+        'token_verify_uncached': {'per_second': len(verify_uncached) / sum(verify_uncached),
+                                  **latency_stats('', verify_uncached)},
+        'token_verify_cached': {'per_second': len(verify_cached) / sum(verify_cached),
+                                **latency_stats('', verify_cached)},
+    }
+
+
+async def bench_upload_sizes(iterations: int) -> Results:
+    from storage import MAX_SIZE_BYTES
+
+    _, token = await create_user()
+    results = {}
+    for size in UPLOAD_SIZES:
+        if size > MAX_SIZE_BYTES:
+            continue
+        durations = [(await timed(upload(token, os.urandom(size))))[0] for _ in range(iterations)]
+        results[f'upload_{size}'] = {
+            'mb_per_second': size * len(durations) / sum(durations) / 2 ** 20,
+            'per_second': len(durations) / sum(durations),
+            **latency_stats('', durations),
+        }
+    return results
+
+
+async def bench_concurrent_uploads(iterations: int) -> Results:
+    results = {}
+    for concurrency in UPLOAD_CONCURRENCY:
+        # uploads are spread over as many users as run at once, so the per-user admission limit doesn't queue them
+        tokens = [(await create_user())[1] for _ in range(concurrency)]
+        contents = [os.urandom(64 * 1024) for _ in range(concurrency * iterations)]
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def limited_upload(token: str, content: bytes) -> Tuple[float, Response]:
+            async with semaphore:
+                return await timed(put_content(token, content))
+
+        start = time.perf_counter()
+        timings = await asyncio.gather(*(
+            limited_upload(tokens[index % concurrency], content) for index, content in enumerate(contents)
+        ))
+        elapsed = time.perf_counter() - start
+        # uploads turned away by admission are counted apart, their latency isn't the upload's
+        durations = [duration for duration, response in timings if check_admitted(response)]
+        results[f'upload_concurrency_{concurrency}'] = {
+            'per_second': len(durations) / elapsed,
+            'rejected': len(timings) - len(durations),
+            **(latency_stats('', durations) if durations else {}),
+        }
+    return results
+
+
+def check_admitted(response: Response) -> bool:
+    """False for uploads rejected by admission, anything else but success is a failure of the benchmark."""
+    if response.status in (429, 503):
+        return False
+    check(response)
+    return True
+
+
+async def add_file_rows(owner_id: int, count: int):
+    """Listing only reads rows, so they're inserted directly instead of being uploaded."""
+    from sqlalchemy import insert
+
+    import database
+    from models import File
+    from storage import UPLOAD_DIR
+
+    async with database.SessionLocal() as db:
+        for first in range(0, count, INSERT_BATCH_SIZE):
+            await db.execute(insert(File), [
+                {'filename': f'file-{number}.bin',
+                 'file_dir': UPLOAD_DIR,
+                 'owner_id': owner_id,
+                 'content_type': 'application/octet-stream',
+                 'file_size_bytes': number,
+                 'filehash': f'{number:064x}'}
+                for number in range(first, min(first + INSERT_BATCH_SIZE, count))
+            ])
+            await db.commit()
+
+
+async def bench_list(iterations: int, list_sizes: Tuple[int, ...]) -> Results:
+    results = {}
+    for count in list_sizes:
+        user_id, token = await create_user()
+        await add_file_rows(user_id, count)
+        first_page, last_page = [], []
+        for _ in range(iterations):
+            duration, response = await timed(request('GET', '/files/', token=token, query={'limit': 100}))
+            first_page.append(duration)
+            check(response)
+            duration, response = await timed(request('GET', '/files/', token=token,
+                                                     query={'limit': 100, 'order': 'desc'}))
+            last_page.append(duration)
+            check(response)
+        results[f'list_{count}'] = {**latency_stats('first_page_', first_page),
+                                    **latency_stats('last_page_', last_page)}
+    return results
+
+
+async def bench_delete(iterations: int) -> Results:
+    _, token = await create_user()
+    count = iterations * 10
+    file_ids = [(await upload(token, os.urandom(1024))).json()['id'] for _ in range(count)]
+    start = time.perf_counter()
+    for file_id in file_ids:
+        check(await request('DELETE', f'/files/{file_id}', token=token))
+    one_by_one = count / (time.perf_counter() - start)
+
+    file_ids = [(await upload(token, os.urandom(1024))).json()['id'] for _ in range(count)]
+    start = time.perf_counter()
+    check(await request('DELETE', '/files/batch', token=token, body=json.dumps({'ids': file_ids}).encode(),
+                        headers={'content-type': 'application/json'}))
+    batch = count / (time.perf_counter() - start)
+    return {'delete_one_by_one': {'files_per_second': one_by_one}, 'delete_batch': {'files_per_second': batch}}
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def configure():
+    if not os.environ.get('BENCHMARK_DB_DATABASE'):
+        sys.exit("Set BENCHMARK_DB_DATABASE to a database the benchmark may wipe")
+    os.environ['DB_DATABASE'] = os.environ['BENCHMARK_DB_DATABASE']
+    # a directory of the benchmark's own, it is removed afterwards
+    os.environ['UPLOAD_FILES_DIR'] = tempfile.mkdtemp(prefix='filesstorage-benchmark-')
+
+
+async def run(only: Optional[List[str]], iterations: int, list_sizes: Tuple[int, ...]) -> dict:
+    import database
+
+    benchmarks: Dict[str, Callable] = {
+        'hash': lambda: bench_hash(iterations),
+        'tokens': lambda: bench_tokens(iterations),
+        'upload': lambda: bench_upload_sizes(iterations),
+        'concurrent_upload': lambda: bench_concurrent_uploads(iterations),
+        'list': lambda: bench_list(iterations, list_sizes),
+        'delete': lambda: bench_delete(iterations),
+    }
+    async with database.get_engine().begin() as connection:
+        await connection.run_sync(database.Base.metadata.drop_all)
+        await connection.run_sync(database.Base.metadata.create_all)
+    results = {}
+    try:
+        for name, benchmark in benchmarks.items():
+            if only and name not in only:
+                continue
+            print(f"Running {name}", file=sys.stderr)
+            results.update(await benchmark())
+    finally:
+        await database.dispose_engine()
+    return {
+        'meta': {
+            'started_at': datetime.utcnow().isoformat(),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'iterations': iterations,
+        },
+        'results': results,
+    }
+
+
+def lower_is_better(metric: str) -> bool:
+    return metric.endswith('_ms') or metric == 'rejected'
+
+
+def compare(baseline: dict, current: dict, tolerance: float) -> bool:
+    """Print the change of every metric present in both, returns False if any got worse by more than tolerance."""
+    ok = True
+    for name, metrics in sorted(current['results'].items()):
+        for metric, value in sorted(metrics.items()):
+            old = baseline['results'].get(name, {}).get(metric)
+            if old is None:
+                continue
+            if old == 0:
+                # no relative change from zero, any increase of e.g. rejected uploads is a regression
+                worse = lower_is_better(metric) and value > 0
+                change_text = ''
+            else:
+                change = (value - old) / old
+                worse = change > tolerance if lower_is_better(metric) else change < -tolerance
+                change_text = f' ({change:+.1%})'
+            ok = ok and not worse
+            print(f"{'REGRESSION' if worse else 'ok':<10} {name}.{metric}: {old:.3f} -> {value:.3f}{change_text}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', nargs='+', help="benchmarks to run: hash tokens upload concurrent_upload list delete")
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--list-sizes', type=lambda value: tuple(int(size) for size in value.split(',')),
+                        default=LIST_SIZES, help="files per user listed, comma separated")
+    parser.add_argument('--output', help="file to write the results to, stdout by default")
+    parser.add_argument('--baseline', help="results of an earlier run to compare against")
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'), help="only compare two results files")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="allowed relative slowdown, 0.1 is 10%%")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as baseline_file, open(args.compare[1]) as current_file:
+            sys.exit(0 if compare(json.load(baseline_file), json.load(current_file), args.tolerance) else 1)
+
+    configure()
+    from logs import stop_logging
+    # sets logging up, the level is lowered after it
+    import main as app_main
+
+    # only problems are logged, records of every request would skew the numbers
+    logging.getLogger().setLevel(logging.WARNING)
+    try:
+        current = asyncio.run(run(args.only, args.iterations, args.list_sizes))
+    finally:
+        stop_logging()
+        shutil.rmtree(os.environ['UPLOAD_FILES_DIR'], ignore_errors=True)
+    output = json.dumps(current, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            sys.exit(0 if compare(json.load(baseline_file), current, args.tolerance) else 1)
+
+
+if __name__ == '__main__':
+    main()
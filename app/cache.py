@@ -0,0 +1,129 @@
+import time
+
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Set
+
+
+class TTLCache:
+    """
+    Bounded LRU cache whose entries also expire after ttl seconds. Entries can be put in a group,
+    all entries of a group are dropped at once with discard_group.
+    Not thread-safe, meant to be used from the event loop only.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # key: (expires_at, value, group)
+        self._data = OrderedDict()
+        # group: keys of its entries
+        self._groups: Dict[Hashable, Set[Hashable]] = {}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _remove(self, key: Hashable, item: tuple):
+        group = item[2]
+        if group is not None:
+            keys = self._groups[group]
+            keys.discard(key)
+            if not keys:
+                del self._groups[group]
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires_at, value, _ = item
+        if expires_at <= time.monotonic():
+            self.pop(key)
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None, group: Optional[Hashable] = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        self.pop(key)
+        self._data[key] = (time.monotonic() + ttl, value, group)
+        if group is not None:
+            self._groups.setdefault(group, set()).add(key)
+        while len(self._data) > self.maxsize:
+            self._remove(*self._data.popitem(last=False))
+
+    def pop(self, key: Hashable):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self._remove(key, item)
+
+    def discard_group(self, group: Hashable):
+        for key in self._groups.pop(group, ()):
+            del self._data[key]
+
+    def clear(self):
+        self._data.clear()
+        self._groups.clear()
+
+
+class ByteBudgetCache:
+    """
+    LRU cache bounded by the total size of its values rather than their number. Values bigger than
+    max_item_bytes aren't admitted, so a few large values can't flush out many small hot ones.
+    Not thread-safe, meant to be used from the event loop only.
+    """
+
+    def __init__(self, max_bytes: int, max_item_bytes: int):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = min(max_item_bytes, max_bytes)
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # lookups the caller skipped because admits() refused the value, left out of the hit ratio
+        self.bypasses = 0
+        # bumped by pop, lets a caller tell whether a key was invalidated while it was computing its value
+        self.invalidations = 0
+        # key: (size, value)
+        self._data = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def admits(self, size: int) -> bool:
+        return size <= self.max_item_bytes
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key: Hashable, value: Any, size: int):
+        if not self.admits(size):
+            return
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.size_bytes -= item[0]
+        self._data[key] = (size, value)
+        self.size_bytes += size
+        while self.size_bytes > self.max_bytes:
+            evicted_size, _ = self._data.popitem(last=False)[1]
+            self.size_bytes -= evicted_size
+
+    def pop(self, key: Hashable):
+        self.invalidations += 1
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.size_bytes -= item[0]
+
+    def clear(self):
+        self._data.clear()
+        self.size_bytes = 0
@@ -0,0 +1,76 @@
+import os
+
+from typing import Optional
+from dotenv import load_dotenv
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+load_dotenv()
+
+COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', 3))
+# compressed only when the first chunk shrinks to at most this fraction of its size
+COMPRESSION_MIN_RATIO = float(os.environ.get('COMPRESSION_MIN_RATIO', 0.8))
+# media types to compress, entries ending with "/" match the whole type, empty disables compression
+COMPRESSION_CONTENT_TYPES = [
+    content_type.strip().lower()
+    for content_type in os.environ.get(
+        'COMPRESSION_CONTENT_TYPES',
+        'text/,application/json,application/xml,application/javascript,application/x-ndjson,application/csv'
+    ).split(',')
+    if content_type.strip()
+]
+
+ZSTD = 'zstd'
+
+
+def should_compress(content_type: Optional[str]) -> bool:
+    if zstandard is None or not content_type:
+        return False
+    media_type = content_type.split(';')[0].strip().lower()
+    return any(
+        media_type.startswith(compressed_type) if compressed_type.endswith('/') else media_type == compressed_type
+        for compressed_type in COMPRESSION_CONTENT_TYPES
+    )
+
+
+class StreamCompressor:
+    """
+    Compresses a stream with zstd if its first chunk compresses well enough, otherwise passes it through.
+    The first chunk is flushed as a block of its own, which is what its compressed size is measured on.
+    """
+
+    def __init__(self):
+        self.compression: Optional[str] = None
+        self._compressobj = None
+        self._sampled = False
+
+    def compress(self, data: bytes) -> bytes:
+        if not self._sampled:
+            self._sampled = True
+            compressobj = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL).compressobj()
+            sample = compressobj.compress(data) + compressobj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+            if len(sample) > len(data) * COMPRESSION_MIN_RATIO:
+                return data
+            self.compression = ZSTD
+            self._compressobj = compressobj
+            return sample
+        if self._compressobj is None:
+            return data
+        return self._compressobj.compress(data)
+
+    def flush(self) -> bytes:
+        if self._compressobj is None:
+            return b''
+        return self._compressobj.flush()
+
+
+def new_decompressor(compression: str):
+    """Incremental decompressor with a decompress(data) method for content stored with compression."""
+    if compression != ZSTD:
+        raise RuntimeError(f"Unknown compression '{compression}'")
+    if zstandard is None:
+        raise RuntimeError("Content is stored zstd compressed, but the zstandard package isn't installed")
+    return zstandard.ZstdDecompressor().decompressobj()
@@ -7,6 +7,14 @@ class DBSettings(BaseSettings):
     database: str
     host: str
     port: int
+    pool_size: int = 5
+    max_overflow: int = 10
+    pool_timeout: int = 30
+    pool_recycle: int = 1800
+    pool_pre_ping: bool = True
+    # retries of an unavailable database back off exponentially from base up to max seconds
+    connect_backoff_base: float = 0.5
+    connect_backoff_max: float = 30
 
     class Config:
         env_prefix = "DB_"
@@ -1,68 +1,235 @@
-import hashlib
 import os
-import shutil
+import uuid
 import logging
 
-from fastapi import HTTPException
+from fastapi import HTTPException, UploadFile
+from datetime import datetime, timedelta
 from fastapi.params import Depends
-from sqlalchemy.orm import Session
-from passlib.context import CryptContext
-from typing import Optional
+from starlette.concurrency import run_in_threadpool
+from collections import Counter
+from sqlalchemy import select, insert, update, delete, func, or_, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import AsyncIterator, Collection, List, NamedTuple, Optional, Tuple, Union
 from dotenv import load_dotenv
 
-from models import User, File
+from cache import ByteBudgetCache
+from compression import should_compress
+from hashing import FILE_HASH_ALGORITHM, hash_bytes
+from logs import bind, log_step
+from metrics import time_stage
+from models import User, File, Blob, PendingDeletion, ScrubFailure, UploadSession
+from passwords import password_hasher
 from dependencies import get_db
-from schemas import UserCreate, UserRead, FileCreate, FileRead
+from schemas import (
+    UserCreate,
+    UserRead,
+    UserUsage,
+    FileCreate,
+    FileRead,
+    FilePage,
+    FilePreflight,
+    FilePreflightResult,
+    FileBatchItem,
+    FileIntegrityFailure,
+    UploadSessionCreate,
+    UploadSessionRead,
+)
+from storage import (
+    StagedFile,
+    check_content_length,
+    stage_existing,
+    stage_stream,
+    stage_chunk,
+    iter_upload_file,
+    iter_location,
+    iter_session_chunks,
+    received_chunks,
+    remove_paths,
+    session_dir,
+    commit_staged,
+    discard,
+    blob_path,
+    locate,
+    locate_blob,
+    Location,
+)
+from packs import pack_writer, should_pack
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
-UPLOAD_DIR = os.environ.get('UPLOAD_FILES_DIR')
-MAX_SIZE_MB = int(os.environ.get('MAX_SIZE_UPLOADED_FILES_MB'))
+UPLOAD_SESSION_CHUNK_SIZE = int(os.environ.get('UPLOAD_SESSION_CHUNK_SIZE_BYTES', 8 * 1024 * 1024))
+UPLOAD_SESSION_MIN_CHUNK_SIZE = int(os.environ.get('UPLOAD_SESSION_MIN_CHUNK_SIZE_BYTES', 256 * 1024))
+UPLOAD_SESSION_MAX_CHUNK_SIZE = int(os.environ.get('UPLOAD_SESSION_MAX_CHUNK_SIZE_BYTES', 64 * 1024 * 1024))
+UPLOAD_SESSION_TTL_MINUTES = int(os.environ.get('UPLOAD_SESSION_TTL_MINUTES', 24 * 60))
+BATCH_MAX_FILES = int(os.environ.get('BATCH_MAX_FILES', 1000))
+USER_QUOTA_MB = int(os.environ.get('USER_QUOTA_MB', 0))
+USER_QUOTA_FILES = int(os.environ.get('USER_QUOTA_FILES', 0))
+USAGE_RECONCILE_BATCH_SIZE = int(os.environ.get('USAGE_RECONCILE_BATCH_SIZE', 1000))
+DELETION_BATCH_SIZE = int(os.environ.get('DELETION_BATCH_SIZE', 500))
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+CONTENT_CACHE_MB = int(os.environ.get('CONTENT_CACHE_MB', 64))
+CONTENT_CACHE_MAX_FILE_KB = int(os.environ.get('CONTENT_CACHE_MAX_FILE_KB', 64))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# rough cost of a cached file on top of its content: the entry, the key and the metadata
+CACHED_FILE_OVERHEAD_BYTES = 256
+
+USER_QUOTA_BYTES = USER_QUOTA_MB * 1024 * 1024
+
+
+class CachedFile(NamedTuple):
+    owner_id: int
+    location: Location
+    filehash: str
+    content_type: str
+    filename: str
+    content: bytes
+
+
+# contents of small files by file id. A file's content never changes, a new upload gets a new id,
+# so entries only have to go when their file is deleted, see FileCRUD.read_current_user_file_content
+file_cache = ByteBudgetCache(max_bytes=CONTENT_CACHE_MB * 1024 * 1024,
+                             max_item_bytes=CONTENT_CACHE_MAX_FILE_KB * 1024 + CACHED_FILE_OVERHEAD_BYTES)
 
 
 def hash_file(file):
-    logger.info(msg="Start hashing file")
-    hash_md5 = hashlib.md5(file)
-    file_hash = hash_md5.hexdigest()
-    logger.info(msg="End hashing file")
+    log_step(logger, "Start hashing file")
+    file_hash = hash_bytes(file)
+    log_step(logger, "End hashing file")
     return file_hash
 
 
+def quota_exceeded_error() -> HTTPException:
+    logger.error(msg="Storage quota exceeded")
+    return HTTPException(
+        status_code=413,
+        detail="Your storage quota is exceeded, please, delete some files first"
+    )
+
+
+def within_quota(quota, default_quota: int, usage):
+    """SQL condition: usage fits the quota column, falling back to default_quota when NULL, 0 is unlimited."""
+    limit = func.coalesce(quota, default_quota)
+    return or_(limit == 0, usage <= limit)
+
+
 class UserCRUD:
-    def __init__(self, db: Session = Depends(get_db)):
+    def __init__(self, db: AsyncSession = Depends(get_db)):
         self.db = db
 
-    def read_by_id(self, user_id: int) -> Optional[User]:
-        query = self.db.query(User)
-        return query.filter(User.id == user_id).one_or_none()
+    async def read_by_id(self, user_id: int) -> Optional[User]:
+        query = select(User).where(User.id == user_id)
+        return (await self.db.execute(query)).scalars().one_or_none()
 
-    def read_by_username(self, username: str) -> Optional[User]:
-        query = self.db.query(User)
-        return query.filter(User.username == username).one_or_none()
+    async def read_by_username(self, username: str) -> Optional[User]:
+        query = select(User).where(User.username == username)
+        return (await self.db.execute(query)).scalars().one_or_none()
 
     @staticmethod
-    def get_hashed_password(password: str) -> str:
-        return pwd_context.hash(password)
+    async def get_hashed_password(password: str) -> str:
+        return await password_hasher.hash(password)
 
     @staticmethod
-    def verify_password(password, hashed_password) -> bool:
-        return pwd_context.verify(password, hashed_password)
+    async def verify_password(password, hashed_password) -> bool:
+        return await password_hasher.verify(password, hashed_password)
 
-    def create(self, user: UserCreate) -> User:
-        hashed_password = self.get_hashed_password(user.password)
+    @staticmethod
+    async def verify_and_update_password(password, hashed_password) -> Tuple[bool, Optional[str]]:
+        return await password_hasher.verify_and_update(password, hashed_password)
 
-        db_user = User(
-            username=user.username,
-            email=user.email,
-            first_name=user.first_name,
-            last_name=user.last_name,
-            hashed_password=hashed_password
+    async def update_hashed_password(self, db_user: User, hashed_password: str) -> User:
+        db_user.hashed_password = hashed_password
+        await self.db.commit()
+        return db_user
+
+    @staticmethod
+    def usage_of(db_user: User) -> UserUsage:
+        quota_bytes = USER_QUOTA_BYTES if db_user.quota_bytes is None else db_user.quota_bytes
+        quota_files = USER_QUOTA_FILES if db_user.quota_files is None else db_user.quota_files
+        return UserUsage(used_bytes=db_user.used_bytes,
+                         files_count=db_user.files_count,
+                         quota_bytes=quota_bytes or None,
+                         quota_files=quota_files or None)
+
+    async def read_usage(self, user_id: int, for_update: bool = False) -> UserUsage:
+        """Usage and quotas of the user, for_update keeps the counters locked until commit."""
+        query = select(User).where(User.id == user_id).execution_options(populate_existing=True)
+        if for_update:
+            query = query.with_for_update()
+        return self.usage_of((await self.db.execute(query)).scalars().one())
+
+    async def charge_usage(self, user_id: int, size_bytes: int, files_count: int = 1):
+        """
+        Count new files against the user's quotas in the current transaction, raises 413 when they don't fit.
+        Check and increment are a single UPDATE, so concurrent uploads can't overshoot a quota.
+        """
+        query = (
+            update(User)
+            .where(User.id == user_id,
+                   within_quota(User.quota_bytes, USER_QUOTA_BYTES, User.used_bytes + size_bytes),
+                   within_quota(User.quota_files, USER_QUOTA_FILES, User.files_count + files_count))
+            .values(used_bytes=User.used_bytes + size_bytes, files_count=User.files_count + files_count)
+            .returning(User.id)
+            .execution_options(synchronize_session=False)
         )
+        if (await self.db.execute(query)).scalar_one_or_none() is None:
+            raise quota_exceeded_error()
+
+    async def add_usage(self, user_id: int, size_bytes: int, files_count: int):
+        """Change usage counters without a quota check, for deletions and already checked uploads."""
+        query = (
+            update(User)
+            .where(User.id == user_id)
+            .values(used_bytes=User.used_bytes + size_bytes, files_count=User.files_count + files_count)
+            .execution_options(synchronize_session=False)
+        )
+        await self.db.execute(query)
+
+    async def reconcile_usage(self) -> int:
+        """
+        Recount usage of every user from their files and repair counters that drifted, returns how many were.
+        Users are locked in batches before counting, so uploads and deletions of a batch wait for its commit.
+        """
+        log_step(logger, "Start reconciling usage")
+        repaired = 0
+        last_user_id = 0
+        while True:
+            query = (
+                select(User.id, User.used_bytes, User.files_count)
+                .where(User.id > last_user_id)
+                .order_by(User.id)
+                .limit(USAGE_RECONCILE_BATCH_SIZE)
+                .with_for_update()
+            )
+            counters = (await self.db.execute(query)).all()
+            if not counters:
+                break
+            last_user_id = counters[-1].id
+            query = (
+                select(File.owner_id, func.sum(File.file_size_bytes), func.count(File.id))
+                .where(File.owner_id.in_([user.id for user in counters]))
+                .group_by(File.owner_id)
+            )
+            usage = {owner_id: (used_bytes, files_count)
+                     for owner_id, used_bytes, files_count in (await self.db.execute(query)).all()}
+            for user in counters:
+                used_bytes, files_count = usage.get(user.id, (0, 0))
+                if (user.used_bytes, user.files_count) != (used_bytes, files_count):
+                    logger.warning(msg=f"Usage of user id={user.id} drifted, repairing")
+                    await self.db.execute(
+                        update(User)
+                        .where(User.id == user.id)
+                        .values(used_bytes=used_bytes, files_count=files_count)
+                        .execution_options(synchronize_session=False)
+                    )
+                    repaired += 1
+            await self.db.commit()
+        log_step(logger, "End reconciling usage, %s users repaired", repaired)
+        return repaired
 
-        check_exist_user = self.read_by_username(username=user.username)
+    async def create(self, user: UserCreate) -> User:
+        check_exist_user = await self.read_by_username(username=user.username)
         if check_exist_user:
             logger.error(msg=f"User with username '{user.username}' already registered")
             raise HTTPException(
@@ -70,105 +237,745 @@ class UserCRUD:
                 detail="Username already registered"
             )
 
+        hashed_password = await self.get_hashed_password(user.password)
+
+        db_user = User(
+            username=user.username,
+            email=user.email,
+            first_name=user.first_name,
+            last_name=user.last_name,
+            hashed_password=hashed_password
+        )
+
         self.db.add(db_user)
-        self.db.commit()
-        self.db.refresh(db_user)
+        await self.db.commit()
+        await self.db.refresh(db_user)
 
         return db_user
 
 
+class DeletionCRUD:
+    """
+    Journal of paths to remove. A path is journaled in the same transaction that stops referencing it
+    and removed by a background worker after commit, so a crash in between leaves no orphans behind
+    and requests never wait for unlink.
+    """
+
+    def __init__(self, db: AsyncSession = Depends(get_db)):
+        self.db = db
+
+    async def enqueue(self, paths: Collection[str]):
+        if paths:
+            await self.db.execute(insert(PendingDeletion).values([{'path': path} for path in paths]))
+
+    async def process_batch(self) -> int:
+        """
+        Remove up to DELETION_BATCH_SIZE journaled paths, returns how many were. Entries are locked with
+        SKIP LOCKED so workers don't wait for each other, and leave the journal only after removal.
+        """
+        query = (
+            select(PendingDeletion)
+            .order_by(PendingDeletion.id)
+            .limit(DELETION_BATCH_SIZE)
+            .with_for_update(skip_locked=True)
+        )
+        deletions = (await self.db.execute(query)).scalars().all()
+        if deletions:
+            await run_in_threadpool(remove_paths, [deletion.path for deletion in deletions])
+            await self.db.execute(delete(PendingDeletion).where(PendingDeletion.id.in_([d.id for d in deletions])))
+        await self.db.commit()
+        return len(deletions)
+
+    async def process(self) -> int:
+        """Drain the journal batch by batch."""
+        removed = 0
+        while True:
+            count = await self.process_batch()
+            removed += count
+            if count < DELETION_BATCH_SIZE:
+                break
+        if removed:
+            logger.info("%s pending deletions processed", removed)
+        return removed
+
+
+class BlobCRUD:
+    """
+    Reference counting of content-addressed blobs. Blob rows are locked with SELECT ... FOR UPDATE,
+    so concurrent uploads and deletions of the same content are serialized until commit.
+    """
+
+    def __init__(self, db: AsyncSession = Depends(get_db)):
+        self.db = db
+
+    async def read_by_hash_for_update(self, blob_hash: str, hash_algorithm: str) -> Optional[Blob]:
+        query = (
+            select(Blob)
+            .where(Blob.hash == blob_hash, Blob.hash_algorithm == hash_algorithm)
+            .with_for_update()
+            .execution_options(populate_existing=True)
+        )
+        return (await self.db.execute(query)).scalars().one_or_none()
+
+    @staticmethod
+    def new_blob(staged: StagedFile, refcount: int) -> Blob:
+        return Blob(hash=staged.filehash,
+                    hash_algorithm=staged.filehash_algorithm,
+                    size_bytes=staged.file_size_bytes,
+                    refcount=refcount,
+                    compression=staged.compression,
+                    stored_size_bytes=staged.stored_size_bytes,
+                    crc32=staged.crc32)
+
+    async def store(self, blob: Blob, staged: StagedFile):
+        """Move the content of a new blob into the store: small blobs go to a pack, others get a file of their own."""
+        if should_pack(staged):
+            blob.pack_id, blob.pack_offset = await pack_writer.append(self.db, staged)
+            discard(staged.path)
+        else:
+            commit_staged(staged, blob_path(blob.hash, blob.id))
+
+    async def acquire(self, staged: StagedFile) -> Blob:
+        """Take a reference to the blob with the staged content, moving the staged file into the store if it's new."""
+        blob = await self.read_by_hash_for_update(staged.filehash, staged.filehash_algorithm)
+        if blob is None:
+            blob = self.new_blob(staged, refcount=1)
+            try:
+                async with self.db.begin_nested():
+                    self.db.add(blob)
+            except IntegrityError:
+                logger.debug(msg="Blob was stored by a concurrent upload")
+                blob = await self.read_by_hash_for_update(staged.filehash, staged.filehash_algorithm)
+            else:
+                await self.store(blob, staged)
+                logger.debug("New blob id=%s stored", blob.id)
+                return blob
+        blob.refcount += 1
+        discard(staged.path)
+        logger.debug("Blob id=%s already stored, refcount=%s", blob.id, blob.refcount)
+        return blob
+
+    async def acquire_many(self, staged_files: List[StagedFile]) -> List[Blob]:
+        """acquire() for many staged files at once: one locking SELECT and one INSERT for the new blobs."""
+        if not staged_files:
+            return []
+        keys = {(staged.filehash, staged.filehash_algorithm) for staged in staged_files}
+        query = (
+            select(Blob)
+            .where(tuple_(Blob.hash, Blob.hash_algorithm).in_(keys))
+            .order_by(Blob.id)
+            .with_for_update()
+            .execution_options(populate_existing=True)
+        )
+        blobs = {(blob.hash, blob.hash_algorithm): blob for blob in (await self.db.execute(query)).scalars().all()}
+        new_blobs = {}
+        for staged in staged_files:
+            key = (staged.filehash, staged.filehash_algorithm)
+            if key not in blobs and key not in new_blobs:
+                new_blobs[key] = self.new_blob(staged, refcount=0)
+        if new_blobs:
+            try:
+                async with self.db.begin_nested():
+                    self.db.add_all(new_blobs.values())
+            except IntegrityError:
+                logger.debug(msg="Some blobs were stored by a concurrent upload, acquiring one by one")
+                return [await self.acquire(staged) for staged in staged_files]
+        acquired = []
+        for staged in staged_files:
+            key = (staged.filehash, staged.filehash_algorithm)
+            blob = blobs.get(key) or new_blobs[key]
+            if blob.refcount == 0:
+                await self.store(blob, staged)
+            else:
+                discard(staged.path)
+            blob.refcount += 1
+            acquired.append(blob)
+        return acquired
+
+    async def link(self, blob_hash: str, hash_algorithm: str, size_bytes: int) -> Optional[Blob]:
+        """Take a reference to an already stored blob, if there is one with this hash and size."""
+        blob = await self.read_by_hash_for_update(blob_hash, hash_algorithm)
+        if blob is None or blob.size_bytes != size_bytes:
+            return None
+        blob.refcount += 1
+        return blob
+
+    async def release(self, blob_id: int) -> Optional[str]:
+        """Drop a reference, returns the path to unlink after commit when it was the last one."""
+        paths = await self.release_many([blob_id])
+        return paths[0] if paths else None
+
+    async def release_many(self, blob_ids: List[int]) -> List[str]:
+        """
+        Drop one reference per listed id, returns paths of blobs that lost their last reference.
+        Packed blobs have no path of their own, their bytes are reclaimed by the pack compactor.
+        """
+        if not blob_ids:
+            return []
+        references = Counter(blob_ids)
+        query = (
+            select(Blob)
+            .where(Blob.id.in_(references))
+            .order_by(Blob.id)
+            .with_for_update()
+            .execution_options(populate_existing=True)
+        )
+        emptied_blobs = []
+        for blob in (await self.db.execute(query)).scalars().all():
+            blob.refcount -= references[blob.id]
+            if blob.refcount <= 0:
+                emptied_blobs.append(blob)
+        if not emptied_blobs:
+            return []
+        await self.db.execute(delete(Blob).where(Blob.id.in_([blob.id for blob in emptied_blobs])))
+        return [blob_path(blob.hash, blob.id) for blob in emptied_blobs if blob.pack_id is None]
+
+
 class FileCRUD:
-    def __init__(self, db: Session = Depends(get_db)):
+    def __init__(self, db: AsyncSession = Depends(get_db)):
         self.db = db
 
-    def read_current_user_all_files(self, current_user: UserRead) -> Optional[dict]:
-        logger.info(msg="Start reading current user's all files")
-        db_files = self.db.query(File).filter(File.owner_id == current_user.id).all()
-        db_files_dict = {db_file.filename: FileRead.from_orm(db_file) for db_file in db_files}
-        if not db_files_dict:
-            logger.error(msg="Files not found. There are no files in user's repository")
-            raise HTTPException(
-                        status_code=404,
-                        detail="Files not found. There are no files in your repository"
-                    )
-        logger.info(msg="End reading current user's all files")
-        return db_files_dict
-
-    def read_by_id(self, file_id: int) -> Optional[File]:
-        query = self.db.query(File)
-        return query.filter(File.id == file_id).one_or_none()
-
-    def read_by_filehash(self, filehash: str) -> Optional[File]:
-        query = self.db.query(File)
-        return query.filter(File.filehash == filehash)
-
-    def delete_file_by_id(self, current_user: UserRead, file_id: int):
-        logger.info(msg=f"Start deleting file with id={file_id}")
-        file_to_delete_query = self.db.query(File).filter(File.owner_id == current_user.id, File.id == file_id)
-        file_to_delete = file_to_delete_query.one_or_none()
-        if not file_to_delete:
+    async def read_current_user_files(self,
+                                      current_user: UserRead,
+                                      cursor: Optional[int] = None,
+                                      limit: int = 100,
+                                      order: str = "asc",
+                                      content_type: Optional[str] = None,
+                                      min_size: Optional[int] = None,
+                                      max_size: Optional[int] = None,
+                                      name_prefix: Optional[str] = None) -> FilePage:
+        """
+        One page of the user's files ordered by id. cursor is the last id of the previous page,
+        so every page is a range scan over the (owner_id, id) index.
+        """
+        log_step(logger, "Start reading current user's files page")
+        query = select(File).where(File.owner_id == current_user.id)
+        if cursor is not None:
+            query = query.where(File.id > cursor if order == "asc" else File.id < cursor)
+        if content_type is not None:
+            query = query.where(File.content_type == content_type)
+        if min_size is not None:
+            query = query.where(File.file_size_bytes >= min_size)
+        if max_size is not None:
+            query = query.where(File.file_size_bytes <= max_size)
+        if name_prefix:
+            query = query.where(File.filename.startswith(name_prefix, autoescape=True))
+        query = query.order_by(File.id.asc() if order == "asc" else File.id.desc()).limit(limit + 1)
+        db_files = (await self.db.execute(query)).scalars().all()
+        next_cursor = db_files[limit - 1].id if len(db_files) > limit else None
+        log_step(logger, "End reading current user's files page")
+        return FilePage(items=[FileRead.from_orm(db_file) for db_file in db_files[:limit]], next_cursor=next_cursor)
+
+    async def read_by_id(self, file_id: int) -> Optional[File]:
+        query = select(File).where(File.id == file_id)
+        return (await self.db.execute(query)).scalars().one_or_none()
+
+    async def read_by_filehash(self, filehash: str, owner_id: int) -> Optional[File]:
+        query = select(File).where(File.owner_id == owner_id, File.filehash == filehash).limit(1)
+        return (await self.db.execute(query)).scalars().first()
+
+    async def read_current_user_file(self, current_user: UserRead, file_id: int) -> File:
+        query = select(File).where(File.owner_id == current_user.id, File.id == file_id)
+        db_file = (await self.db.execute(query)).scalars().one_or_none()
+        if not db_file:
             logger.error(msg=f"File with id={file_id} not found")
             raise HTTPException(
                 status_code=404,
                 detail=f"File with id={file_id} not found. There are no file with such id in your repository"
             )
+        bind(file_id=db_file.id)
+        return db_file
+
+    async def read_current_user_file_content(self, current_user: UserRead, file_id: int) -> Union[CachedFile, File]:
+        """
+        The file with its content from file_cache, read into it on a miss when the file is small enough.
+        Files that aren't cached are returned as their File row.
+        """
+        invalidations = file_cache.invalidations
+        db_file = await self.read_current_user_file(current_user=current_user, file_id=file_id)
+        location = locate(db_file)
+        size = location.length + CACHED_FILE_OVERHEAD_BYTES
+        # compressed files are left out, they are sent as stored to clients accepting the encoding
+        if location.compression or not file_cache.admits(size):
+            file_cache.bypasses += 1
+            return db_file
+        cached_file = file_cache.get(file_id)
+        # the cache is per process and other workers' deletes don't reach it, so a hit is checked against
+        # the row read above, an entry of a deleted file is never served and ages out of the LRU order
+        if cached_file is not None and cached_file.filehash == db_file.filehash:
+            return cached_file
+        content = b''.join([chunk async for chunk in iter_location(location)])
+        cached_file = CachedFile(owner_id=db_file.owner_id,
+                                 location=location,
+                                 filehash=db_file.filehash,
+                                 content_type=db_file.content_type,
+                                 filename=db_file.filename,
+                                 content=content)
+        # a delete committed while the content was read must not be undone by caching it
+        if file_cache.invalidations == invalidations:
+            file_cache.set(file_id, cached_file, size)
+        return cached_file
+
+    async def check_files_owned(self, current_user: UserRead, file_ids: Collection[int]):
+        query = select(File.id).where(File.owner_id == current_user.id, File.id.in_(file_ids))
+        missing_ids = set(file_ids) - set((await self.db.execute(query)).scalars().all())
+        if missing_ids:
+            logger.error(msg=f"Files with ids {sorted(missing_ids)} not found")
+            raise HTTPException(
+                status_code=404,
+                detail=f"Files with ids {sorted(missing_ids)} not found."
+                       f" There are no files with such ids in your repository"
+            )
+
+    async def iter_current_user_files(self,
+                                      current_user: UserRead,
+                                      file_ids: Optional[Collection[int]] = None) -> AsyncIterator[File]:
+        """
+        The user's files, or those of them with file_ids, ordered by id and read EXPORT_BATCH_SIZE at a time.
+        The transaction ends after every batch, so a slow consumer doesn't keep it open.
+        """
+        last_id = 0
+        while True:
+            query = select(File).where(File.owner_id == current_user.id, File.id > last_id)
+            if file_ids is not None:
+                query = query.where(File.id.in_(file_ids))
+            db_files = (await self.db.execute(query.order_by(File.id).limit(EXPORT_BATCH_SIZE))).scalars().all()
+            await self.db.commit()
+            if not db_files:
+                return
+            for db_file in db_files:
+                yield db_file
+            last_id = db_files[-1].id
+
+    async def read_integrity_failures(self, current_user: UserRead) -> List[FileIntegrityFailure]:
+        """The user's files whose content failed its last scrub, see scrub.py."""
+        query = (
+            select(File, ScrubFailure)
+            .join(ScrubFailure, or_(ScrubFailure.blob_id == File.blob_id, ScrubFailure.file_id == File.id))
+            .where(File.owner_id == current_user.id)
+            .order_by(File.id)
+        )
+        return [
+            FileIntegrityFailure(file=FileRead.from_orm(db_file), error=failure.error, detected_at=failure.detected_at)
+            for db_file, failure in (await self.db.execute(query)).all()
+        ]
+
+    async def delete_file_by_id(self, current_user: UserRead, file_id: int):
+        log_step(logger, "Start deleting file with id=%s", file_id)
+        file_to_delete = await self.read_current_user_file(current_user=current_user, file_id=file_id)
         filename = file_to_delete.filename
-        file_to_delete_query.delete()
-        self.db.commit()
-        os.remove(f'{UPLOAD_DIR}/{current_user.id}/{filename}')
-        logger.info(msg=f"End deleting file with id={file_id}")
+        query = delete(File).where(File.id == file_to_delete.id).returning(File.id)
+        if (await self.db.execute(query)).scalar_one_or_none() is None:
+            logger.error(msg=f"File with id={file_id} was deleted concurrently")
+            raise HTTPException(
+                status_code=404,
+                detail=f"File with id={file_id} not found. There are no file with such id in your repository"
+            )
+        await UserCRUD(self.db).add_usage(user_id=current_user.id,
+                                          size_bytes=-file_to_delete.file_size_bytes,
+                                          files_count=-1)
+        if file_to_delete.blob_id is not None:
+            path_to_remove = await BlobCRUD(self.db).release(file_to_delete.blob_id)
+        else:
+            path_to_remove = locate(file_to_delete).path
+        if path_to_remove:
+            await DeletionCRUD(self.db).enqueue([path_to_remove])
+        await self.db.commit()
+        file_cache.pop(file_id)
+        log_step(logger, "End deleting file with id=%s", file_id)
         return filename
 
-    async def create(self, file_data: FileCreate, current_user: UserRead) -> File:
-        logger.info(msg="Start saving file")
-        logger.info(msg="Start reading file")
-        read_file = await file_data.file.read()
-        logger.info(msg="End reading file")
+    async def delete_files_by_ids(self, current_user: UserRead, file_ids: List[int]) -> List[FileBatchItem]:
+        """Delete many files in one transaction, ids that aren't the user's files are reported as not found."""
+        log_step(logger, "Start deleting %s files", len(file_ids))
+        query = select(File).where(File.owner_id == current_user.id, File.id.in_(file_ids))
+        files_to_delete = {db_file.id: db_file for db_file in (await self.db.execute(query)).scalars().all()}
+        if files_to_delete:
+            query = delete(File).where(File.id.in_(files_to_delete)).returning(File.id)
+            deleted_ids = set((await self.db.execute(query)).scalars().all())
+            # files deleted by a concurrent request in the meantime are reported as not found
+            files_to_delete = {
+                file_id: db_file for file_id, db_file in files_to_delete.items() if file_id in deleted_ids
+            }
+            await UserCRUD(self.db).add_usage(
+                user_id=current_user.id,
+                size_bytes=-sum(db_file.file_size_bytes for db_file in files_to_delete.values()),
+                files_count=-len(files_to_delete)
+            )
+            legacy_paths = [locate(db_file).path for db_file in files_to_delete.values() if db_file.blob_id is None]
+            blob_ids = [db_file.blob_id for db_file in files_to_delete.values() if db_file.blob_id is not None]
+            paths_to_remove = legacy_paths + await BlobCRUD(self.db).release_many(blob_ids)
+            await DeletionCRUD(self.db).enqueue(paths_to_remove)
+            await self.db.commit()
+            for file_id in files_to_delete:
+                file_cache.pop(file_id)
+        log_step(logger, "End deleting %s files", len(files_to_delete))
+        return [
+            FileBatchItem(id=file_id, filename=files_to_delete[file_id].filename, status_code=200)
+            if file_id in files_to_delete else
+            FileBatchItem(id=file_id, status_code=404, detail=f"File with id={file_id} not found")
+            for file_id in file_ids
+        ]
 
-        file_size_bytes = len(read_file)
-        filehash = hash_file(read_file)
+    @staticmethod
+    def blob_file_values(blob: Blob,
+                         filename: str,
+                         content_type: str,
+                         description: Optional[str],
+                         current_user: UserRead) -> dict:
+        return dict(
+            filename=filename,
+            file_dir=os.path.dirname(locate_blob(blob).path),
+            description=description,
+            owner_id=current_user.id,
+            content_type=content_type,
+            file_size_bytes=blob.size_bytes,
+            filehash=blob.hash,
+            filehash_algorithm=blob.hash_algorithm,
+            blob_id=blob.id
+        )
+
+    def add_blob_file(self,
+                      blob: Blob,
+                      filename: str,
+                      content_type: str,
+                      description: Optional[str],
+                      current_user: UserRead) -> File:
+        db_file = File(**self.blob_file_values(blob=blob,
+                                               filename=filename,
+                                               content_type=content_type,
+                                               description=description,
+                                               current_user=current_user),
+                       blob=blob)
+        self.db.add(db_file)
+        return db_file
+
+    async def preflight(self, preflight: FilePreflight, current_user: UserRead) -> FilePreflightResult:
+        """
+        Tell a client whether it has to send the content. Content already in the blob store is linked to
+        a new File right away, so knowing hash and size of stored content is taken as having it.
+        """
+        log_step(logger, "Start upload preflight")
+        check_content_length(preflight.size)
+        file_by_filehash = await self.read_by_filehash(filehash=preflight.hash, owner_id=current_user.id)
+        if file_by_filehash:
+            log_step(logger, "End upload preflight, user already has the file")
+            return FilePreflightResult(status="exists", file=FileRead.from_orm(file_by_filehash))
+        await UserCRUD(self.db).charge_usage(user_id=current_user.id, size_bytes=preflight.size)
+        blob = await BlobCRUD(self.db).link(blob_hash=preflight.hash,
+                                            hash_algorithm=preflight.hash_algorithm,
+                                            size_bytes=preflight.size)
+        if blob is None:
+            log_step(logger, "End upload preflight, content has to be uploaded")
+            return FilePreflightResult(status="upload")
+        db_file = self.add_blob_file(blob=blob,
+                                     filename=preflight.filename,
+                                     content_type=preflight.content_type,
+                                     description=preflight.description,
+                                     current_user=current_user)
+        await self.db.commit()
+        await self.db.refresh(db_file)
+        log_step(logger, "End upload preflight, stored content linked")
+        return FilePreflightResult(status="linked", file=FileRead.from_orm(db_file))
+
+    async def migrate_legacy_file(self, db_file: File):
+        """
+        Rehash a file stored before the blob store with FILE_HASH_ALGORITHM and move it into the store.
+        The old copy is removed only after the row points at the blob.
+        """
+        log_step(logger, "Start migrating legacy file with id=%s", db_file.id)
+        legacy_path = locate(db_file).path
+        try:
+            staged = await run_in_threadpool(stage_existing, legacy_path)
+        except FileNotFoundError:
+            # left as it is, the storage reconciler reports files missing on disk
+            logger.error(msg=f"Legacy file with id={db_file.id} is missing at {legacy_path}, not migrated")
+            return
+        try:
+            blob = await BlobCRUD(self.db).acquire(staged)
+            db_file.blob = blob
+            db_file.filehash = blob.hash
+            db_file.filehash_algorithm = blob.hash_algorithm
+            db_file.file_dir = os.path.dirname(locate_blob(blob).path)
+            await DeletionCRUD(self.db).enqueue([legacy_path])
+            await self.db.commit()
+        finally:
+            discard(staged.path)
+        log_step(logger, "End migrating legacy file with id=%s", db_file.id)
+
+    async def migrate_legacy_files(self, owner_id: int, file_sizes: Collection[int]):
+        """
+        Lazily migrate the owner's legacy files that could hold the same content as new uploads,
+        so the duplicate check compares hashes made with the same algorithm.
+        """
+        if not file_sizes:
+            return
+        query = select(File.id).where(File.owner_id == owner_id,
+                                      File.blob_id.is_(None),
+                                      File.file_size_bytes.in_(file_sizes))
+        for file_id in (await self.db.execute(query)).scalars().all():
+            # every migration commits, so each row is locked and checked again on its own. A row locked
+            # by a concurrent upload is being migrated by it and is skipped
+            query = (
+                select(File)
+                .where(File.id == file_id, File.blob_id.is_(None))
+                .with_for_update(skip_locked=True, of=File)
+                .execution_options(populate_existing=True)
+            )
+            db_file = (await self.db.execute(query)).scalars().one_or_none()
+            if db_file is not None:
+                await self.migrate_legacy_file(db_file)
 
-        db_file = File(
+    async def read_owned_filehashes(self, owner_id: int, filehashes: Collection[str]) -> set:
+        query = select(File.filehash).where(File.owner_id == owner_id, File.filehash.in_(filehashes))
+        return set((await self.db.execute(query)).scalars().all())
+
+    async def create_many(self, uploads: List[UploadFile], current_user: UserRead) -> List[FileBatchItem]:
+        """
+        Store many uploaded files with one duplicate check, one blob acquisition, one INSERT and one commit.
+        Files that can't be stored are reported per item and don't affect the others.
+        """
+        log_step(logger, "Start saving %s files", len(uploads))
+        if len(uploads) > BATCH_MAX_FILES:
+            logger.error(msg=f"Batch of {len(uploads)} files is bigger than {BATCH_MAX_FILES}")
+            raise HTTPException(
+                status_code=422,
+                detail=f"Please, upload at most {BATCH_MAX_FILES} files at once"
+            )
+        results = [None] * len(uploads)
+        staged_files = {}
+        # the connection isn't needed while the uploads are being staged
+        await self.db.commit()
+        try:
+            for index, upload in enumerate(uploads):
+                try:
+                    staged_files[index] = await stage_stream(iter_upload_file(upload),
+                                                             compress=should_compress(upload.content_type))
+                except HTTPException as error:
+                    results[index] = FileBatchItem(filename=upload.filename,
+                                                   status_code=error.status_code,
+                                                   detail=error.detail)
+            await self.migrate_legacy_files(owner_id=current_user.id,
+                                            file_sizes={staged.file_size_bytes for staged in staged_files.values()})
+            known_filehashes = await self.read_owned_filehashes(
+                owner_id=current_user.id,
+                filehashes={staged.filehash for staged in staged_files.values()}
+            )
+            usage = await UserCRUD(self.db).read_usage(user_id=current_user.id, for_update=True)
+            files_to_store = {}
+            for index, staged in staged_files.items():
+                if staged.filehash in known_filehashes:
+                    results[index] = FileBatchItem(filename=uploads[index].filename,
+                                                   status_code=400,
+                                                   detail="You already have File with same content")
+                    continue
+                if not usage.fits(staged.file_size_bytes):
+                    error = quota_exceeded_error()
+                    results[index] = FileBatchItem(filename=uploads[index].filename,
+                                                   status_code=error.status_code,
+                                                   detail=error.detail)
+                    continue
+                usage.used_bytes += staged.file_size_bytes
+                usage.files_count += 1
+                known_filehashes.add(staged.filehash)
+                files_to_store[index] = staged
+            await UserCRUD(self.db).add_usage(
+                user_id=current_user.id,
+                size_bytes=sum(staged.file_size_bytes for staged in files_to_store.values()),
+                files_count=len(files_to_store)
+            )
+            blobs = await BlobCRUD(self.db).acquire_many(list(files_to_store.values()))
+            files_values = {
+                index: self.blob_file_values(blob=blob,
+                                             filename=uploads[index].filename,
+                                             content_type=uploads[index].content_type,
+                                             description=None,
+                                             current_user=current_user)
+                for index, blob in zip(files_to_store, blobs)
+            }
+            if files_values:
+                result = await self.db.execute(insert(File).values(list(files_values.values())).returning(File.id))
+                for (index, values), file_id in zip(files_values.items(), result.scalars().all()):
+                    results[index] = FileBatchItem(id=file_id,
+                                                   filename=values['filename'],
+                                                   status_code=201,
+                                                   file=FileRead(id=file_id, **values))
+            await self.db.commit()
+        finally:
+            for staged in staged_files.values():
+                discard(staged.path)
+        log_step(logger, "End saving %s files", len(files_values))
+        return results
+
+    async def create(self, file_data: FileCreate, current_user: UserRead) -> File:
+        return await self.create_from_stream(
+            chunks=iter_upload_file(file_data.file),
             filename=file_data.file.filename,
-            file_dir=f'{UPLOAD_DIR}/{current_user.id}',
-            description=file_data.description,
-            owner_id=current_user.id,
             content_type=file_data.file.content_type,
-            file_size_bytes=file_size_bytes,
-            filehash=filehash
+            description=file_data.description,
+            current_user=current_user
         )
 
-        file_size_mb = db_file.file_size_bytes / (1024 * 1024)
-        if file_size_mb > MAX_SIZE_MB:
-            logger.error(msg=f"File too big - {round(file_size_mb, 2)} MB, max size is {MAX_SIZE_MB} MB")
+    async def create_from_stream(self,
+                                 chunks: AsyncIterator[bytes],
+                                 filename: str,
+                                 content_type: str,
+                                 description: Optional[str],
+                                 current_user: UserRead,
+                                 expected_filehash: Optional[str] = None) -> File:
+        log_step(logger, "Start saving file")
+        # the connection isn't needed while the content is being received
+        await self.db.commit()
+        log_step(logger, "Start reading file")
+        staged = await stage_stream(chunks, compress=should_compress(content_type))
+        log_step(logger, "End reading file")
+        try:
+            if expected_filehash is not None and staged.filehash != expected_filehash:
+                logger.error(msg="Hash of received content doesn't match declared hash")
+                raise HTTPException(
+                    status_code=422,
+                    detail="Received content doesn't match declared hash"
+                )
+            with time_stage('dedup_query'):
+                await self.migrate_legacy_files(owner_id=current_user.id, file_sizes=[staged.file_size_bytes])
+                file_by_filehash = await self.read_by_filehash(filehash=staged.filehash, owner_id=current_user.id)
+            if file_by_filehash:
+                logger.error(msg="File with same content have already uploaded")
+                raise HTTPException(
+                    status_code=400,
+                    detail="You already have File with same content"
+                )
+
+            logger.debug(msg="File checking successful, storing blob")
+            with time_stage('store'):
+                await UserCRUD(self.db).charge_usage(user_id=current_user.id, size_bytes=staged.file_size_bytes)
+                blob = await BlobCRUD(self.db).acquire(staged)
+                db_file = self.add_blob_file(blob=blob,
+                                             filename=filename,
+                                             content_type=content_type,
+                                             description=description,
+                                             current_user=current_user)
+            with time_stage('commit'):
+                await self.db.commit()
+        finally:
+            discard(staged.path)
+        await self.db.refresh(db_file)
+        bind(file_id=db_file.id)
+        logger.debug(msg="Record to DataBase created")
+        log_step(logger, "End saving file")
+
+        return db_file
+
+
+class UploadSessionCRUD:
+    def __init__(self, db: AsyncSession = Depends(get_db)):
+        self.db = db
+
+    async def create(self, data: UploadSessionCreate, current_user: UserRead) -> UploadSessionRead:
+        log_step(logger, "Start creating upload session")
+        check_content_length(data.file_size_bytes)
+        if data.filehash_algorithm != FILE_HASH_ALGORITHM:
+            logger.error(msg=f"Upload session declared {data.filehash_algorithm} hash")
+            raise HTTPException(
+                status_code=422,
+                detail=f"Declared hash must be {FILE_HASH_ALGORITHM}"
+            )
+        if not (await UserCRUD(self.db).read_usage(user_id=current_user.id)).fits(data.file_size_bytes):
+            raise quota_exceeded_error()
+        chunk_size_bytes = data.chunk_size_bytes or UPLOAD_SESSION_CHUNK_SIZE
+        if not UPLOAD_SESSION_MIN_CHUNK_SIZE <= chunk_size_bytes <= UPLOAD_SESSION_MAX_CHUNK_SIZE:
+            logger.error(msg=f"Upload session chunk size {chunk_size_bytes} out of bounds")
             raise HTTPException(
                 status_code=422,
-                detail=f"Your file too big - {round(file_size_mb, 2)} MB,"
-                       f" please, upload files less than {MAX_SIZE_MB} MB"
+                detail=f"Chunk size must be from {UPLOAD_SESSION_MIN_CHUNK_SIZE}"
+                       f" to {UPLOAD_SESSION_MAX_CHUNK_SIZE} bytes"
+            )
+        db_session = UploadSession(
+            id=uuid.uuid4().hex,
+            owner_id=current_user.id,
+            filename=data.filename,
+            description=data.description,
+            content_type=data.content_type,
+            file_size_bytes=data.file_size_bytes,
+            chunk_size_bytes=chunk_size_bytes,
+            filehash=data.filehash,
+            filehash_algorithm=data.filehash_algorithm,
+            expires_at=datetime.utcnow() + timedelta(minutes=UPLOAD_SESSION_TTL_MINUTES)
+        )
+        self.db.add(db_session)
+        await self.db.commit()
+        log_step(logger, "End creating upload session %s", db_session.id)
+        return UploadSessionRead.from_orm(db_session)
+
+    async def read(self, session_id: str, current_user: UserRead) -> UploadSession:
+        query = select(UploadSession).where(UploadSession.id == session_id,
+                                            UploadSession.owner_id == current_user.id,
+                                            UploadSession.expires_at > datetime.utcnow())
+        db_session = (await self.db.execute(query)).scalars().one_or_none()
+        if not db_session:
+            logger.error(msg=f"Upload session {session_id} not found")
+            raise HTTPException(
+                status_code=404,
+                detail=f"Upload session {session_id} not found or expired"
             )
+        return db_session
 
-        file_by_filehash = self.read_by_filehash(filehash=db_file.filehash).filter(File.owner_id == current_user.id)
-        if file_by_filehash.one_or_none():
-            logger.error(msg="File with same content have already uploaded")
+    async def read_status(self, session_id: str, current_user: UserRead) -> UploadSessionRead:
+        db_session = await self.read(session_id=session_id, current_user=current_user)
+        session_status = UploadSessionRead.from_orm(db_session)
+        session_status.received_chunks = await run_in_threadpool(received_chunks, session_id)
+        return session_status
+
+    async def put_chunk(self, session_id: str, index: int, chunks: AsyncIterator[bytes], current_user: UserRead):
+        db_session = await self.read(session_id=session_id, current_user=current_user)
+        if not 0 <= index < db_session.chunks_count:
+            logger.error(msg=f"Chunk {index} out of range for session {session_id}")
             raise HTTPException(
-                status_code=400,
-                detail="You already have File with same content"
-            )
-
-        logger.debug(msg="File checking successful, making folder to upload")
-        if not os.path.exists(UPLOAD_DIR):
-            os.mkdir(UPLOAD_DIR)
-        if not os.path.exists(db_file.file_dir):
-            os.mkdir(db_file.file_dir)
-        logger.debug(msg="Folder to upload created")
-        logger.debug(msg="Saving file to upload folder")
-        with open(f'{db_file.file_dir}/{db_file.filename}', 'wb') as new_file:
-            shutil.copyfileobj(file_data.file.file, new_file)
-        logger.debug(msg="File saved to folder, saving record to DataBase")
-        self.db.add(db_file)
-        self.db.commit()
-        self.db.refresh(db_file)
-        logger.debug(msg="Record to DataBase created")
-        logger.info(msg="End saving file")
+                status_code=422,
+                detail=f"Chunk index must be from 0 to {db_session.chunks_count - 1}"
+            )
+        # the connection isn't needed while the chunk is being received
+        await self.db.commit()
+        await stage_chunk(chunks=chunks, session_id=session_id, index=index, expected_size=db_session.chunk_size(index))
 
+    async def commit(self, session_id: str, current_user: UserRead) -> File:
+        log_step(logger, "Start committing upload session %s", session_id)
+        db_session = await self.read(session_id=session_id, current_user=current_user)
+        missing_chunks = set(range(db_session.chunks_count)) - set(await run_in_threadpool(received_chunks, session_id))
+        if missing_chunks:
+            logger.error(msg=f"Upload session {session_id} misses {len(missing_chunks)} chunks")
+            raise HTTPException(
+                status_code=409,
+                detail=f"Chunks {sorted(missing_chunks)[:100]} haven't been uploaded yet"
+            )
+        db_file = await FileCRUD(self.db).create_from_stream(
+            chunks=iter_session_chunks(session_id, db_session.chunks_count),
+            filename=db_session.filename,
+            content_type=db_session.content_type,
+            description=db_session.description,
+            current_user=current_user,
+            expected_filehash=db_session.filehash
+        )
+        await self.db.execute(delete(UploadSession).where(UploadSession.id == session_id))
+        await DeletionCRUD(self.db).enqueue([session_dir(session_id)])
+        await self.db.commit()
+        log_step(logger, "End committing upload session %s", session_id)
         return db_file
+
+    async def delete(self, session_id: str, current_user: UserRead):
+        await self.read(session_id=session_id, current_user=current_user)
+        await self.db.execute(delete(UploadSession).where(UploadSession.id == session_id))
+        await DeletionCRUD(self.db).enqueue([session_dir(session_id)])
+        await self.db.commit()
+
+    async def delete_expired(self) -> int:
+        """Garbage-collect expired sessions together with their chunks."""
+        result = await self.db.execute(
+            delete(UploadSession).where(UploadSession.expires_at <= datetime.utcnow()).returning(UploadSession.id)
+        )
+        session_ids = result.scalars().all()
+        await DeletionCRUD(self.db).enqueue([session_dir(session_id) for session_id in session_ids])
+        await self.db.commit()
+        if session_ids:
+            logger.info("%s expired upload sessions removed", len(session_ids))
+        return len(session_ids)
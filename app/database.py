@@ -1,18 +1,86 @@
-from sqlalchemy import create_engine
+import random
+import asyncio
+import logging
+
+from sqlalchemy import inspect, text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from typing import Optional
 
 from dependencies import get_db_settings
 
-settings = get_db_settings()
+logger = logging.getLogger(__name__)
+
+Base = declarative_base()
 
-SQLALCHEMY_DATABASE_URL = f"postgresql://{settings.username}:{settings.password}@{settings.host}/{settings.database}"
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+_engine: Optional[AsyncEngine] = None
+_session_factory = sessionmaker(class_=AsyncSession, autoflush=False, expire_on_commit=False)
 
-# Use next code if you need sqlite DB
-# SQLALCHEMY_DATABASE_URL = "sqlite:///./sql_app.db"
-# engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def get_engine() -> AsyncEngine:
+    """The engine is built on first use, so importing the app neither reads settings nor touches the database."""
+    global _engine
+    if _engine is None:
+        settings = get_db_settings()
+        _engine = create_async_engine(
+            f"postgresql+asyncpg://{settings.username}:{settings.password}"
+            f"@{settings.host}:{settings.port}/{settings.database}",
+            pool_size=settings.pool_size,
+            max_overflow=settings.max_overflow,
+            pool_timeout=settings.pool_timeout,
+            pool_recycle=settings.pool_recycle,
+            pool_pre_ping=settings.pool_pre_ping,
+        )
+        # Use next code if you need sqlite DB (requires aiosqlite)
+        # _engine = create_async_engine("sqlite+aiosqlite:///./sql_app.db", connect_args={"check_same_thread": False})
+    return _engine
 
-Base = declarative_base()
+
+def SessionLocal() -> AsyncSession:
+    return _session_factory(bind=get_engine())
+
+
+async def dispose_engine():
+    global _engine
+    if _engine is not None:
+        await _engine.dispose()
+        _engine = None
+
+
+def missing_tables(connection) -> set:
+    return set(Base.metadata.tables) - set(inspect(connection).get_table_names())
+
+
+async def check_database(timeout: float = 5.0, require_schema: bool = True) -> Optional[str]:
+    """What keeps the database from serving requests, None if nothing does."""
+    async def check() -> set:
+        async with get_engine().connect() as connection:
+            await connection.execute(text("SELECT 1"))
+            return await connection.run_sync(missing_tables) if require_schema else set()
+
+    try:
+        missing = await asyncio.wait_for(check(), timeout)
+    except Exception as error:
+        return f"database unavailable: {error.__class__.__name__}"
+    if missing:
+        return f"tables missing, run 'python manage.py init-db': {', '.join(sorted(missing))}"
+    return None
+
+
+def backoff_delays():
+    """Exponential backoff with full jitter, so that workers started together don't retry in step."""
+    settings = get_db_settings()
+    attempt = 0
+    while True:
+        yield random.uniform(0, min(settings.connect_backoff_max, settings.connect_backoff_base * 2 ** attempt))
+        attempt += 1
+
+
+async def wait_for_database(require_schema: bool = True):
+    for delay in backoff_delays():
+        problem = await check_database(require_schema=require_schema)
+        if problem is None:
+            return
+        logger.warning(msg=f"DataBase isn't ready, {problem}, trying again in {delay:.1f} seconds")
+        await asyncio.sleep(delay)
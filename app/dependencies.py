@@ -4,12 +4,9 @@ import config
 import database
 
 
-def get_db():
-    db = database.SessionLocal()
-    try:
+async def get_db():
+    async with database.SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 @lru_cache
@@ -0,0 +1,156 @@
+import time
+import zlib
+import struct
+import tarfile
+
+from typing import AsyncIterator, List, NamedTuple, Optional
+
+from models import File
+from storage import Location, iter_location, locate
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_UTF8_NAMES = 0x0800
+ZIP_DATA_DESCRIPTOR = 0x0008
+TAR_BLOCK_SIZE = tarfile.BLOCKSIZE
+
+
+class ExportEntry(NamedTuple):
+    name: str
+    location: Location
+    # CRC-32 known up front, None if it has to be computed while streaming
+    crc32: Optional[int]
+
+
+class ZipRecord(NamedTuple):
+    name: bytes
+    flags: int
+    crc32: int
+    size: int
+    offset: int
+
+
+async def export_entries(files: AsyncIterator[File]) -> AsyncIterator[ExportEntry]:
+    """Archive entries of files, names repeated within the archive get the file id as a prefix."""
+    names = set()
+    async for db_file in files:
+        name = db_file.filename if db_file.filename not in names else f'{db_file.id}-{db_file.filename}'
+        names.add(name)
+        yield ExportEntry(name=name,
+                          location=locate(db_file),
+                          crc32=db_file.blob.crc32 if db_file.blob is not None else None)
+
+
+async def iter_checked(entry: ExportEntry) -> AsyncIterator[bytes]:
+    """
+    Content of an entry, failing if it doesn't match the size announced in the headers already sent,
+    the archive would be unreadable from there on anyway.
+    """
+    size = 0
+    async for chunk in iter_location(entry.location):
+        size += len(chunk)
+        yield chunk
+    if size != entry.location.length:
+        raise RuntimeError(f"{entry.location.path} holds {size} bytes, expected {entry.location.length}")
+
+
+def dos_date_time(timestamp: float):
+    moment = time.localtime(timestamp)
+    # DOS dates start in 1980
+    return ((max(moment.tm_year, 1980) - 1980) << 9 | moment.tm_mon << 5 | moment.tm_mday,
+            moment.tm_hour << 11 | moment.tm_min << 5 | moment.tm_sec // 2)
+
+
+class ZipWriter:
+    """
+    Builds a ZIP archive with stored (uncompressed) entries as a stream of bytes. Sizes are always known
+    up front, a CRC that isn't is written after the data in a data descriptor. Entries of 4 GiB and more,
+    offsets past 4 GiB and more than 65535 entries get ZIP64 records. What is kept per entry until the
+    central directory is written at the end is the name, the CRC and two integers.
+    """
+
+    def __init__(self, timestamp: float):
+        self.date, self.time = dos_date_time(timestamp)
+        self.offset = 0
+        self.records: List[ZipRecord] = []
+
+    def _emit(self, data: bytes) -> bytes:
+        self.offset += len(data)
+        return data
+
+    def local_header(self, name: bytes, size: int, crc32: Optional[int]) -> bytes:
+        flags = ZIP_UTF8_NAMES if crc32 is not None else ZIP_UTF8_NAMES | ZIP_DATA_DESCRIPTOR
+        zip64 = size >= ZIP64_LIMIT
+        extra = struct.pack('<HHQQ', 0x0001, 16, size, size) if zip64 else b''
+        header_size = ZIP64_LIMIT if zip64 else size
+        self.records.append(ZipRecord(name=name, flags=flags, crc32=crc32 or 0, size=size, offset=self.offset))
+        return self._emit(struct.pack('<4sHHHHHLLLHH',
+                                      b'PK\x03\x04', 45 if zip64 else 20, flags, 0, self.time, self.date,
+                                      crc32 or 0, header_size, header_size, len(name), len(extra)) + name + extra)
+
+    def data(self, chunk: bytes) -> bytes:
+        return self._emit(chunk)
+
+    def data_descriptor(self, crc32: int) -> bytes:
+        record = self.records[-1]
+        self.records[-1] = record._replace(crc32=crc32)
+        if record.size >= ZIP64_LIMIT:
+            return self._emit(struct.pack('<4sLQQ', b'PK\x07\x08', crc32, record.size, record.size))
+        return self._emit(struct.pack('<4sLLL', b'PK\x07\x08', crc32, record.size, record.size))
+
+    def central_directory(self) -> bytes:
+        start = self.offset
+        parts = []
+        for record in self.records:
+            zip64_fields = []
+            if record.size >= ZIP64_LIMIT:
+                zip64_fields += [record.size, record.size]
+            if record.offset >= ZIP64_LIMIT:
+                zip64_fields.append(record.offset)
+            extra = struct.pack(f'<HH{len(zip64_fields)}Q', 0x0001, 8 * len(zip64_fields), *zip64_fields) \
+                if zip64_fields else b''
+            size = ZIP64_LIMIT if record.size >= ZIP64_LIMIT else record.size
+            parts.append(struct.pack('<4sHHHHHHLLLHHHHHLL',
+                                     b'PK\x01\x02', 3 << 8 | 45, 45 if zip64_fields else 20, record.flags, 0,
+                                     self.time, self.date, record.crc32, size, size, len(record.name),
+                                     len(extra), 0, 0, 0, 0o100644 << 16, min(record.offset, ZIP64_LIMIT)))
+            parts.append(record.name + extra)
+        directory = b''.join(parts)
+        self.offset += len(directory)
+        end = self.offset
+        count = len(self.records)
+        if count >= 0xFFFF or start >= ZIP64_LIMIT or len(directory) >= ZIP64_LIMIT:
+            directory += struct.pack('<4sQHHLLQQQQ', b'PK\x06\x06', 44, 3 << 8 | 45, 45, 0, 0,
+                                     count, count, len(directory), start)
+            directory += struct.pack('<4sLQL', b'PK\x06\x07', 0, end, 1)
+        directory += struct.pack('<4sHHHHLLH', b'PK\x05\x06', 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                                 min(end - start, ZIP64_LIMIT), min(start, ZIP64_LIMIT), 0)
+        return directory
+
+
+async def stream_zip(entries: AsyncIterator[ExportEntry]) -> AsyncIterator[bytes]:
+    writer = ZipWriter(time.time())
+    async for entry in entries:
+        yield writer.local_header(entry.name.encode(), entry.location.length, entry.crc32)
+        crc32 = 0
+        async for chunk in iter_checked(entry):
+            if entry.crc32 is None:
+                crc32 = zlib.crc32(chunk, crc32)
+            yield writer.data(chunk)
+        if entry.crc32 is None:
+            yield writer.data_descriptor(crc32)
+    yield writer.central_directory()
+
+
+async def stream_tar(entries: AsyncIterator[ExportEntry]) -> AsyncIterator[bytes]:
+    """POSIX (pax) tar, which has no limit on sizes or name lengths."""
+    mtime = int(time.time())
+    async for entry in entries:
+        info = tarfile.TarInfo(entry.name)
+        info.size, info.mtime, info.mode = entry.location.length, mtime, 0o644
+        yield info.tobuf(format=tarfile.PAX_FORMAT, encoding='utf-8', errors='surrogateescape')
+        async for chunk in iter_checked(entry):
+            yield chunk
+        padding = -entry.location.length % TAR_BLOCK_SIZE
+        if padding:
+            yield b'\0' * padding
+    yield b'\0' * (2 * TAR_BLOCK_SIZE)
@@ -0,0 +1,51 @@
+import os
+import hashlib
+
+from typing import Any, Callable, NamedTuple, Optional
+from dotenv import load_dotenv
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+load_dotenv()
+
+
+class HashAlgorithm(NamedTuple):
+    name: str
+    new: Callable[[], Any]
+    # only collision resistant algorithms may identify stored content
+    strong: bool
+
+
+ALGORITHMS = {
+    'sha256': HashAlgorithm(name='sha256', new=hashlib.sha256, strong=True),
+    'md5': HashAlgorithm(name='md5', new=hashlib.md5, strong=False),
+}
+if blake3 is not None:
+    ALGORITHMS['blake3'] = HashAlgorithm(name='blake3', new=blake3.blake3, strong=True)
+
+FILE_HASH_ALGORITHM = os.environ.get('FILE_HASH_ALGORITHM', 'sha256')
+
+if FILE_HASH_ALGORITHM not in ALGORITHMS:
+    raise RuntimeError(f"FILE_HASH_ALGORITHM '{FILE_HASH_ALGORITHM}' is unknown or its package isn't installed")
+if not ALGORITHMS[FILE_HASH_ALGORITHM].strong:
+    raise RuntimeError(f"FILE_HASH_ALGORITHM '{FILE_HASH_ALGORITHM}' isn't collision resistant")
+
+
+def new_hasher(algorithm: str = FILE_HASH_ALGORITHM):
+    return ALGORITHMS[algorithm].new()
+
+
+def algorithm_of(filehash: str, filehash_algorithm: Optional[str]) -> str:
+    """Rows stored before the algorithm was recorded have MD5 (32 hex digits) or SHA-256 hashes."""
+    if filehash_algorithm:
+        return filehash_algorithm
+    return 'md5' if len(filehash) == 32 else 'sha256'
+
+
+def hash_bytes(data: bytes, algorithm: str = FILE_HASH_ALGORITHM) -> str:
+    hasher = new_hasher(algorithm)
+    hasher.update(data)
+    return hasher.hexdigest()
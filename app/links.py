@@ -0,0 +1,126 @@
+import os
+import hmac
+import json
+import time
+import base64
+import hashlib
+import logging
+
+from fastapi import HTTPException
+from typing import Dict, NamedTuple
+from dotenv import load_dotenv
+
+from storage import Location
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+LINK_TTL_SECONDS = int(os.environ.get('LINK_TTL_SECONDS', 3600))
+LINK_MAX_TTL_SECONDS = int(os.environ.get('LINK_MAX_TTL_SECONDS', 7 * 24 * 3600))
+
+
+def derive_key(secret: bytes, info: bytes) -> bytes:
+    """HKDF-SHA256 (RFC 5869) with no salt, for a 32 byte key of its own derived from another secret."""
+    pseudorandom_key = hmac.new(b'\0' * hashlib.sha256().digest_size, secret, hashlib.sha256).digest()
+    return hmac.new(pseudorandom_key, info + b'\x01', hashlib.sha256).digest()
+
+
+# without a key of their own, links are signed with one derived from the token key rather than the token key itself
+LINK_SECRET_KEY = os.environ.get('LINK_SECRET_KEY', '').encode() or derive_key(
+    os.environ.get('PASSWORD_HASH_SECRET_KEY').encode(), b'filesstorage download links'
+)
+
+
+class LinkClaims(NamedTuple):
+    """What a download link carries, enough to serve the file without looking anything up."""
+    file_id: int
+    location: Location
+    filehash: str
+    media_type: str
+    filename: str
+    issued_at: float
+    expires_at: int
+
+
+def b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def sign(payload: str) -> str:
+    return b64encode(hmac.new(LINK_SECRET_KEY, payload.encode(), hashlib.sha256).digest())
+
+
+def link_token(claims: LinkClaims) -> str:
+    location = claims.location
+    payload = b64encode(json.dumps([
+        claims.file_id, location.path, location.offset, location.length, location.stored_length,
+        location.packed, location.compression, claims.filehash, claims.media_type, claims.filename,
+        claims.issued_at, claims.expires_at,
+    ], separators=(',', ':')).encode())
+    return f'{payload}.{sign(payload)}'
+
+
+def invalid_link_error() -> HTTPException:
+    logger.error(msg="Download link is invalid, expired or revoked")
+    return HTTPException(status_code=404, detail="Link is invalid, expired or revoked")
+
+
+class DenyList:
+    """
+    Links of a file issued before it was revoked, by file id. Entries are dropped once every link they
+    cover has expired anyway, so the list only ever holds files revoked within LINK_MAX_TTL_SECONDS.
+    The list is kept per process.
+    """
+
+    def __init__(self):
+        # in the order of revocation, so the entries to drop are always the first ones
+        self._revoked_at: Dict[int, float] = {}
+
+    def revoke(self, file_id: int):
+        now = time.time()
+        self._revoked_at.pop(file_id, None)
+        self._revoked_at[file_id] = now
+        # every entry is dropped once, so revoking takes constant time on average
+        while self._revoked_at:
+            oldest_file_id = next(iter(self._revoked_at))
+            if self._revoked_at[oldest_file_id] > now - LINK_MAX_TTL_SECONDS:
+                break
+            del self._revoked_at[oldest_file_id]
+
+    def is_revoked(self, file_id: int, issued_at: float) -> bool:
+        revoked_at = self._revoked_at.get(file_id)
+        return revoked_at is not None and issued_at <= revoked_at
+
+    def __len__(self) -> int:
+        return len(self._revoked_at)
+
+
+deny_list = DenyList()
+
+
+def verify_link(token: str) -> LinkClaims:
+    """Check signature, expiry and the deny list, raises 404 for any link that doesn't pass."""
+    payload, _, signature = token.partition('.')
+    # compared as bytes, compare_digest refuses str with non-ASCII characters
+    if not hmac.compare_digest(signature.encode(), sign(payload).encode()):
+        raise invalid_link_error()
+    (file_id, path, offset, length, stored_length, packed, compression,
+     filehash, media_type, filename, issued_at, expires_at) = json.loads(b64decode(payload))
+    if expires_at < time.time() or deny_list.is_revoked(file_id, issued_at):
+        raise invalid_link_error()
+    return LinkClaims(file_id=file_id,
+                      location=Location(path=path,
+                                        offset=offset,
+                                        length=length,
+                                        stored_length=stored_length,
+                                        packed=packed,
+                                        compression=compression),
+                      filehash=filehash,
+                      media_type=media_type,
+                      filename=filename,
+                      issued_at=issued_at,
+                      expires_at=expires_at)
@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import uuid
+import queue
+import random
+import logging
+import logging.config
+
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+from dotenv import load_dotenv
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# handlers run in a listener thread, the event loop only puts records on a queue
+LOG_QUEUE = os.environ.get('LOG_QUEUE', 'true').lower() == 'true'
+# text keeps the format of logging.conf, json writes one object per line with the request context
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text').lower()
+# Start/End records of a request are dropped, the request is logged by one summary record instead
+LOG_REQUEST_SUMMARY = os.environ.get('LOG_REQUEST_SUMMARY', 'true').lower() == 'true'
+# fraction of the other info and debug records of a request that is kept, warnings and errors always are
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 1))
+
+REQUEST_ID_HEADER = 'x-request-id'
+
+# fields of the request being handled, a dict so that code deeper in the call stack can add to it
+log_context: ContextVar[Optional[dict]] = ContextVar('log_context', default=None)
+
+listener: Optional[QueueListener] = None
+
+
+def bind(**fields):
+    """Add fields to the context of the current request, outside of a request it does nothing."""
+    context = log_context.get()
+    if context is not None:
+        context.update(fields)
+
+
+def add_stage_duration(stage: str, seconds: float):
+    context = log_context.get()
+    if context is not None:
+        stages = context.setdefault('stages', {})
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+
+def log_step(step_logger: logging.Logger, msg: str, *args, level: int = logging.INFO):
+    """
+    Log the "Start ..." or "End ..." record of a step. Inside a request whose summary is logged
+    the record would be dropped anyway, so it isn't even built.
+    """
+    if (LOG_REQUEST_SUMMARY and log_context.get() is not None) or not step_logger.isEnabledFor(level):
+        return
+    step_logger.log(level, msg, *args, stacklevel=2)
+
+
+class ContextFilter(logging.Filter):
+    """
+    Attaches the request context to records and thins out the chatter of requests.
+    Runs where the record is emitted, which is the only place the context is visible.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = log_context.get()
+        if not hasattr(record, 'context'):
+            record.context = dict(context) if context else {}
+        if context is None or getattr(record, 'summary', False) or record.levelno >= logging.WARNING:
+            return True
+        if LOG_REQUEST_SUMMARY and isinstance(record.msg, str) and record.msg.startswith(('Start ', 'End ')):
+            return False
+        return LOG_SAMPLE_RATE >= 1 or random.random() < LOG_SAMPLE_RATE
+
+
+class ListenerQueueHandler(QueueHandler):
+    """
+    Records go to a listener thread of this process, so unlike QueueHandler it doesn't format them up front,
+    only merges the arguments into the message. Tracebacks are formatted by the handlers in the thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'function': record.funcName,
+            'line': record.lineno,
+            'message': record.getMessage(),
+            **getattr(record, 'context', {}),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(config_file: str = 'logging.conf'):
+    """
+    Configure logging from config_file, then put ContextFilter in front of its handlers and,
+    with LOG_QUEUE, move the handlers into a listener thread.
+    """
+    global listener
+    logging.config.fileConfig(config_file, disable_existing_loggers=False)
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    if LOG_FORMAT == 'json':
+        for handler in handlers:
+            handler.setFormatter(JsonFormatter())
+    if LOG_QUEUE:
+        for handler in handlers:
+            root.removeHandler(handler)
+        queue_handler = ListenerQueueHandler(queue.SimpleQueue())
+        queue_handler.addFilter(ContextFilter())
+        root.addHandler(queue_handler)
+        listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+        listener.start()
+    else:
+        for handler in handlers:
+            handler.addFilter(ContextFilter())
+
+
+def stop_logging():
+    """Write out queued records and stop the listener thread."""
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+class RequestLogMiddleware:
+    """
+    Opens the log context of a request, with the request id taken from X-Request-ID or generated
+    and echoed back, and logs one summary record once the response is sent.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        headers = dict(scope["headers"])
+        request_id = headers.get(REQUEST_ID_HEADER.encode(), b'').decode('latin-1')[:64] or uuid.uuid4().hex
+        context = {'request_id': request_id}
+        token = log_context.set(context)
+        status = 500
+
+        async def send_with_request_id(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = [*message.get("headers", []),
+                                      (REQUEST_ID_HEADER.encode(), request_id.encode('latin-1'))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            duration_ms = round((time.perf_counter() - start) * 1000, 3)
+            route = getattr(scope.get("endpoint"), "__name__", "unmatched")
+            context.update(method=scope["method"], route=route, status=status, duration_ms=duration_ms)
+            stages = ' '.join(f"{stage}={seconds * 1000:.3f}ms" for stage, seconds in context.get('stages', {}).items())
+            logger.info(msg=f"{scope['method']} {scope['path']} {status} {duration_ms}ms {stages}".rstrip(),
+                        extra={'summary': True, 'context': dict(context)})
+            log_context.reset(token)
@@ -1,26 +1,113 @@
-import time
+import asyncio
 import logging
 
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
-from sqlalchemy.exc import OperationalError
+from starlette.responses import Response
 
-from database import Base, engine
-from routers import users_router, files_router
+import database
+from admission import UploadAdmissionMiddleware, upload_admission
+from auth import principal_cache
+from crud import file_cache
+from logs import RequestLogMiddleware, setup_logging, stop_logging
+from metrics import CONTENT_TYPE, CallbackMetric, MetricsMiddleware, registry
+from passwords import password_hasher
+from storage import pack_maps
+from tasks import start_background_tasks, stop_background_tasks
+from links import deny_list
+from routers import users_router, files_router, links_router
 
-logging.config.fileConfig('logging.conf', disable_existing_loggers=False)
+setup_logging()
 logger = logging.getLogger(__name__)
 
-while True:
-    try:
-        logger.info("Try connect to DataBase")
-        Base.metadata.create_all(bind=engine)
-        logger.info("Connection to DataBase successful")
-        break
-    except OperationalError:
-        logger.warning("DataBase hasn't ready yet, try again in 1 second")
-        time.sleep(1)
-        continue
-
 app = FastAPI()
+app.add_middleware(UploadAdmissionMiddleware)
+app.add_middleware(MetricsMiddleware)
+# outermost, so that the summary covers the whole request
+app.add_middleware(RequestLogMiddleware)
 app.include_router(users_router)
 app.include_router(files_router)
+app.include_router(links_router)
+
+
+def pool_stat(name: str):
+    """Read a statistic of the engine's connection pool, pools without one (NullPool) report nothing."""
+    stat = getattr(database.get_engine().sync_engine.pool, name, None)
+    return stat() if stat else None
+
+
+CallbackMetric("db_pool_size", "Connections the pool keeps.", "gauge", lambda: pool_stat("size"))
+CallbackMetric("db_pool_checked_out", "Connections in use.", "gauge", lambda: pool_stat("checkedout"))
+CallbackMetric("db_pool_checked_in", "Idle connections in the pool.", "gauge", lambda: pool_stat("checkedin"))
+CallbackMetric("db_pool_overflow", "Connections open beyond the pool size.", "gauge", lambda: pool_stat("overflow"))
+CallbackMetric("auth_cache_hits_total", "Principal cache hits.", "counter", lambda: principal_cache.hits)
+CallbackMetric("auth_cache_misses_total", "Principal cache misses.", "counter", lambda: principal_cache.misses)
+CallbackMetric("auth_cache_entries", "Principals cached.", "gauge", lambda: len(principal_cache))
+CallbackMetric("content_cache_hits_total", "File content cache hits.", "counter", lambda: file_cache.hits)
+CallbackMetric("content_cache_misses_total", "File content cache misses.", "counter", lambda: file_cache.misses)
+CallbackMetric("content_cache_bypasses_total", "File content reads not cached as too large or compressed.",
+               "counter", lambda: file_cache.bypasses)
+CallbackMetric("content_cache_entries", "Files whose content is cached.", "gauge", lambda: len(file_cache))
+CallbackMetric("content_cache_bytes", "Bytes held by the file content cache.", "gauge", lambda: file_cache.size_bytes)
+CallbackMetric("content_cache_max_bytes", "Limit of bytes held by the file content cache.", "gauge",
+               lambda: file_cache.max_bytes)
+CallbackMetric("password_hasher_in_flight", "bcrypt operations running or queued.", "gauge",
+               lambda: password_hasher.in_flight)
+CallbackMetric("password_hasher_rejected_total", "bcrypt operations rejected with 503.", "counter",
+               lambda: password_hasher.rejected)
+CallbackMetric("download_link_revocations", "Files whose download links are revoked.", "gauge", lambda: len(deny_list))
+CallbackMetric("upload_in_flight", "Uploads admitted and running.", "gauge", lambda: upload_admission.in_flight)
+CallbackMetric("upload_in_flight_bytes", "Declared bytes of running uploads.", "gauge",
+               lambda: upload_admission.in_flight_bytes)
+CallbackMetric("upload_queue_depth", "Uploads waiting for admission.", "gauge", lambda: len(upload_admission.queue))
+CallbackMetric("upload_rejected_total", "Uploads rejected with 429 or 503.", "counter",
+               lambda: upload_admission.rejected)
+CallbackMetric("upload_max_concurrent", "Limit of uploads running at once.", "gauge",
+               lambda: upload_admission.max_concurrent)
+CallbackMetric("upload_max_in_flight_bytes", "Limit of bytes of running uploads.", "gauge",
+               lambda: upload_admission.max_bytes)
+CallbackMetric("upload_queue_limit", "Limit of uploads waiting for admission.", "gauge",
+               lambda: upload_admission.queue_limit)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return Response(content=registry.render(), media_type=CONTENT_TYPE)
+
+
+@app.get("/health/live", include_in_schema=False)
+async def liveness():
+    return {"status": "alive"}
+
+
+@app.get("/health/ready", include_in_schema=False)
+async def readiness(response: Response):
+    problem = await database.check_database()
+    if problem is not None:
+        response.status_code = 503
+        return {"status": "not ready", "detail": problem}
+    return {"status": "ready"}
+
+
+async def start_when_database_ready():
+    """Background jobs start once the database answers, probing it with backoff instead of blocking startup."""
+    await database.wait_for_database()
+    logger.info("Connection to DataBase successful")
+    start_background_tasks()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # the schema is created and upgraded by "python manage.py init-db", workers only wait for it
+    startup = asyncio.create_task(start_when_database_ready())
+    yield
+    startup.cancel()
+    await stop_background_tasks()
+    await database.dispose_engine()
+    password_hasher.shutdown()
+    pack_maps.clear()
+    stop_logging()
+
+
+app.router.lifespan_context = lifespan
@@ -0,0 +1,92 @@
+import asyncio
+import argparse
+import logging
+import logging.config
+
+from sqlalchemy import inspect, text
+
+import database
+# registers the tables with Base.metadata
+import models
+from crud import UserCRUD
+
+logger = logging.getLogger(__name__)
+
+# create_all only creates missing tables, these bring tables created by earlier versions up to the models.
+# Each one is a no-op on a schema that is already up to date, so they are run on every init-db
+SCHEMA_UPGRADES = [
+    # usage counters and quotas, the counters are recounted right after they are added
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS used_bytes BIGINT NOT NULL DEFAULT 0",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS files_count INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS quota_bytes BIGINT",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS quota_files INTEGER",
+    # blob store
+    "ALTER TABLE blobs ADD COLUMN IF NOT EXISTS hash_algorithm VARCHAR",
+    "UPDATE blobs SET hash_algorithm = CASE WHEN length(hash) = 32 THEN 'md5' ELSE 'sha256' END"
+    " WHERE hash_algorithm IS NULL",
+    "ALTER TABLE blobs ALTER COLUMN hash_algorithm SET NOT NULL",
+    "ALTER TABLE blobs DROP CONSTRAINT IF EXISTS blobs_hash_key",
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_blobs_hash_hash_algorithm ON blobs (hash, hash_algorithm)",
+    "ALTER TABLE blobs ADD COLUMN IF NOT EXISTS compression VARCHAR",
+    "ALTER TABLE blobs ADD COLUMN IF NOT EXISTS stored_size_bytes BIGINT",
+    "ALTER TABLE blobs ADD COLUMN IF NOT EXISTS crc32 BIGINT",
+    "ALTER TABLE blobs ADD COLUMN IF NOT EXISTS pack_id INTEGER REFERENCES packs (id)",
+    "ALTER TABLE blobs ADD COLUMN IF NOT EXISTS pack_offset BIGINT",
+    "CREATE INDEX IF NOT EXISTS ix_blobs_pack_id ON blobs (pack_id)",
+    # files
+    "ALTER TABLE files ADD COLUMN IF NOT EXISTS filehash_algorithm VARCHAR",
+    "ALTER TABLE files ADD COLUMN IF NOT EXISTS blob_id INTEGER REFERENCES blobs (id)",
+    "CREATE INDEX IF NOT EXISTS ix_files_blob_id ON files (blob_id)",
+    """
+    DO $$ BEGIN
+        IF (SELECT data_type FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = 'files' AND column_name = 'file_size_bytes'
+        ) <> 'bigint' THEN
+            ALTER TABLE files ALTER COLUMN file_size_bytes TYPE BIGINT;
+        END IF;
+    END $$
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_files_owner_id_id ON files (owner_id, id)",
+    "CREATE INDEX IF NOT EXISTS ix_files_owner_id_filehash ON files (owner_id, filehash)",
+    "CREATE INDEX IF NOT EXISTS ix_files_owner_id_filename ON files (owner_id, filename)",
+]
+
+
+def lacks_usage_counters(connection) -> bool:
+    inspector = inspect(connection)
+    return inspector.has_table('users') and 'used_bytes' not in {
+        column['name'] for column in inspector.get_columns('users')
+    }
+
+
+async def init_db():
+    """Create missing tables and upgrade existing ones, run once per deployment before the workers start."""
+    await database.wait_for_database(require_schema=False)
+    async with database.get_engine().begin() as connection:
+        recount_usage = await connection.run_sync(lacks_usage_counters)
+        await connection.run_sync(database.Base.metadata.create_all)
+        for statement in SCHEMA_UPGRADES:
+            await connection.execute(text(statement))
+    if recount_usage:
+        async with database.SessionLocal() as db:
+            repaired = await UserCRUD(db).reconcile_usage()
+        logger.info("Usage counters added, %s users recounted", repaired)
+    await database.dispose_engine()
+    logger.info(msg="DataBase schema is up to date")
+
+
+COMMANDS = {
+    'init-db': init_db,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="One-shot maintenance commands.")
+    parser.add_argument('command', choices=COMMANDS)
+    args = parser.parse_args()
+    asyncio.run(COMMANDS[args.command]())
+
+
+if __name__ == '__main__':
+    logging.config.fileConfig('logging.conf', disable_existing_loggers=False)
+    main()
@@ -0,0 +1,232 @@
+import math
+import time
+import threading
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from logs import add_stage_duration
+
+# Starlette appends the charset to text/ media types
+CONTENT_TYPE = "text/plain; version=0.0.4"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List['Metric'] = []
+
+    def register(self, metric: 'Metric'):
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        """Every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            samples = list(metric.samples())
+            if not samples:
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in samples:
+                if labels:
+                    label_pairs = ','.join(f'{key}="{escape_label_value(str(val))}"' for key, val in labels.items())
+                    lines.append(f"{name}{{{label_pairs}}} {format_value(value)}")
+                else:
+                    lines.append(f"{name} {format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class Metric:
+    """
+    Metrics of this process only, values are plain floats behind a lock, so updating one costs a dict lookup.
+    Labels have to be passed by keyword, all of labelnames every time.
+    """
+
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels: Dict[str, str]) -> tuple:
+        return tuple(labels[name] for name in self.labelnames)
+
+    def _labels(self, key: tuple) -> Dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    def samples(self) -> Iterator[Sample]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[Sample]:
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, self._labels(key), value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # per label values: observations per bucket, then the sum of observed values
+        self._values: Dict[tuple, List[float]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    @contextmanager
+    def time(self, **labels: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterator[Sample]:
+        with self._lock:
+            values = [(key, list(state)) for key, state in self._values.items()]
+        for key, state in values:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                yield f"{self.name}_bucket", {**labels, "le": format_value(bound)}, cumulative
+            yield f"{self.name}_sum", labels, state[-1]
+            yield f"{self.name}_count", labels, cumulative
+
+
+class CallbackMetric(Metric):
+    """Value read when metrics are scraped, for state other modules keep anyway. None skips the sample."""
+
+    def __init__(self, name: str, documentation: str, type: str, callback: Callable[[], Optional[float]]):
+        super().__init__(name, documentation)
+        self.type = type
+        self.callback = callback
+
+    def samples(self) -> Iterator[Sample]:
+        value = self.callback()
+        if value is not None:
+            yield self.name, {}, value
+
+
+REQUESTS = Counter("http_requests_total", "HTTP requests handled.", ("route", "method", "status"))
+REQUEST_DURATION = Histogram("http_request_duration_seconds", "Time to handle an HTTP request.", ("route", "method"))
+REQUEST_BYTES = Counter("http_request_bytes_total", "Bytes of HTTP request bodies received.", ("route",))
+RESPONSE_BYTES = Counter("http_response_bytes_total", "Bytes of HTTP response bodies sent.", ("route",))
+UPLOAD_STAGE_DURATION = Histogram(
+    "upload_stage_duration_seconds",
+    "Time a single upload spent in each stage: read, hash, compress, write, dedup_query, store, commit.",
+    ("stage",),
+)
+
+
+def observe_stage(stage: str, seconds: float):
+    """Report time an upload spent in stage, to UPLOAD_STAGE_DURATION and to the request's log summary."""
+    UPLOAD_STAGE_DURATION.observe(seconds, stage=stage)
+    add_stage_duration(stage, seconds)
+
+
+@contextmanager
+def time_stage(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+class MetricsMiddleware:
+    """
+    Counts requests, body bytes and latency per route. The route label is the name of the endpoint
+    the router matched, so it stays low-cardinality whatever the path parameters are.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+        received = 0
+        sent = 0
+
+        async def counting_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            nonlocal status, sent
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            elif message["type"] == "http.response.zerocopysend":
+                sent += message["count"]
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            # the router stores the matched endpoint in the scope it was given
+            route = getattr(scope.get("endpoint"), "__name__", "unmatched")
+            method = scope["method"]
+            REQUESTS.inc(route=route, method=method, status=str(status))
+            REQUEST_DURATION.observe(time.perf_counter() - start, route=route, method=method)
+            if received:
+                REQUEST_BYTES.inc(received, route=route)
+            if sent:
+                RESPONSE_BYTES.inc(sent, route=route)
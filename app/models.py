@@ -1,4 +1,5 @@
-from sqlalchemy import Column, String, Integer, ForeignKey
+from datetime import datetime
+from sqlalchemy import Column, String, Integer, BigInteger, DateTime, ForeignKey, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 
 from database import Base
@@ -13,6 +14,12 @@ class User(Base):
     first_name = Column(String(20), nullable=True)
     last_name = Column(String(20), nullable=True)
     hashed_password = Column(String)
+    # usage counters kept in step with the user's files, see UserCRUD.charge_usage
+    used_bytes = Column(BigInteger, nullable=False, default=0, server_default="0")
+    files_count = Column(Integer, nullable=False, default=0, server_default="0")
+    # NULL means the USER_QUOTA_MB / USER_QUOTA_FILES defaults, 0 means unlimited
+    quota_bytes = Column(BigInteger, nullable=True)
+    quota_files = Column(Integer, nullable=True)
 
     files = relationship("File", back_populates="owner")
 
@@ -26,7 +33,103 @@ class File(Base):
     description = Column(String(100))
     owner_id = Column(Integer, ForeignKey("users.id"))
     content_type = Column(String)
-    file_size_bytes = Column(Integer)
+    file_size_bytes = Column(BigInteger)
     filehash = Column(String)
+    # NULL for rows stored before the algorithm was recorded, see hashing.algorithm_of
+    filehash_algorithm = Column(String, nullable=True)
+    blob_id = Column(Integer, ForeignKey("blobs.id"), nullable=True, index=True)
 
     owner = relationship("User", back_populates="files")
+    blob = relationship("Blob", lazy="joined")
+
+    __table_args__ = (
+        Index("ix_files_owner_id_id", "owner_id", "id"),
+        Index("ix_files_owner_id_filehash", "owner_id", "filehash"),
+        Index("ix_files_owner_id_filename", "owner_id", "filename"),
+    )
+
+
+class Blob(Base):
+    """Content-addressed file content shared by every File with the same hash."""
+    __tablename__ = "blobs"
+
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
+    hash = Column(String, nullable=False)
+    hash_algorithm = Column(String, nullable=False)
+    size_bytes = Column(BigInteger, nullable=False)
+    refcount = Column(Integer, nullable=False, default=0)
+    # "zstd" when stored compressed, stored_size_bytes is then the size on disk (NULL means size_bytes)
+    compression = Column(String, nullable=True)
+    stored_size_bytes = Column(BigInteger, nullable=True)
+    # CRC-32 of the content for ZIP exports, NULL for blobs stored before it was recorded
+    crc32 = Column(BigInteger, nullable=True)
+    # small blobs are appended to a pack segment instead of getting a file of their own
+    pack_id = Column(Integer, ForeignKey("packs.id"), nullable=True, index=True)
+    pack_offset = Column(BigInteger, nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint("hash", "hash_algorithm", name="uq_blobs_hash_hash_algorithm"),
+    )
+
+
+class Pack(Base):
+    """Append-only segment file holding many small blobs, see packs.py."""
+    __tablename__ = "packs"
+
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+
+class PendingDeletion(Base):
+    """Path to remove once the transaction that stopped referencing it has committed, see DeletionCRUD."""
+    __tablename__ = "pending_deletions"
+
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
+    path = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+class ScrubCursor(Base):
+    """How far the integrity scrubber got through a table, see scrub.py."""
+    __tablename__ = "scrub_cursors"
+
+    target = Column(String, primary_key=True)
+    last_id = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+class ScrubFailure(Base):
+    """
+    Stored content that didn't match its hash when last scrubbed. Blob and file ids aren't foreign keys,
+    deleting damaged content must not be blocked by its failure record.
+    """
+    __tablename__ = "scrub_failures"
+
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
+    blob_id = Column(Integer, nullable=True, unique=True)
+    file_id = Column(Integer, nullable=True, unique=True)
+    error = Column(String, nullable=False)
+    detected_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+class UploadSession(Base):
+    """Chunked upload in progress, chunks themselves are kept on disk until commit."""
+    __tablename__ = "upload_sessions"
+
+    id = Column(String(32), primary_key=True)
+    owner_id = Column(Integer, ForeignKey("users.id"), index=True)
+    filename = Column(String)
+    description = Column(String(100))
+    content_type = Column(String)
+    file_size_bytes = Column(BigInteger)
+    chunk_size_bytes = Column(Integer)
+    filehash = Column(String)
+    filehash_algorithm = Column(String)
+    expires_at = Column(DateTime, index=True)
+
+    @property
+    def chunks_count(self) -> int:
+        return -(-self.file_size_bytes // self.chunk_size_bytes)
+
+    def chunk_size(self, index: int) -> int:
+        return min(self.chunk_size_bytes, self.file_size_bytes - index * self.chunk_size_bytes)
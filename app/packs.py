@@ -0,0 +1,143 @@
+import os
+import time
+import logging
+
+from datetime import datetime, timedelta
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import select, insert, delete, func
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from typing import Optional, Tuple
+from dotenv import load_dotenv
+
+from models import Blob, Pack, PendingDeletion
+from storage import StagedFile, append_to_pack, copy_pack_entries, discard, locate_blob, pack_maps, pack_path
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+PACK_THRESHOLD_BYTES = int(os.environ.get('PACK_THRESHOLD_BYTES', 16 * 1024))
+PACK_SIZE_BYTES = int(os.environ.get('PACK_SIZE_BYTES', 64 * 1024 * 1024))
+PACK_ROTATE_SECONDS = int(os.environ.get('PACK_ROTATE_SECONDS', 3600))
+PACK_COMPACT_LIVE_RATIO = float(os.environ.get('PACK_COMPACT_LIVE_RATIO', 0.5))
+
+
+def should_pack(staged: StagedFile) -> bool:
+    return staged.stored_size_bytes <= PACK_THRESHOLD_BYTES
+
+
+async def create_pack(db: AsyncSession) -> int:
+    pack = Pack()
+    db.add(pack)
+    await db.flush()
+    return pack.id
+
+
+class PackWriter:
+    """
+    Appends small blobs to the pack this process currently writes to. Packs are registered in their own
+    transaction, so the row exists even when the upload that opened it is rolled back; bytes of such uploads
+    are dead space the compactor reclaims. A pack is rotated once it's PACK_SIZE_BYTES big or
+    PACK_ROTATE_SECONDS old, so packs older than that are never appended to again.
+    """
+
+    def __init__(self):
+        self.pack_id: Optional[int] = None
+        self._opened_at = 0.0
+        self._size = 0
+
+    def _needs_rotation(self) -> bool:
+        return (self.pack_id is None
+                or self._size >= PACK_SIZE_BYTES
+                or time.monotonic() - self._opened_at >= PACK_ROTATE_SECONDS)
+
+    async def _rotate(self, engine: AsyncEngine):
+        async with AsyncSession(engine) as pack_db:
+            pack_id = await create_pack(pack_db)
+            await pack_db.commit()
+        logger.debug("Pack id=%s opened for writing", pack_id)
+        self.pack_id, self._opened_at, self._size = pack_id, time.monotonic(), 0
+
+    async def append(self, db: AsyncSession, staged: StagedFile) -> Tuple[int, int]:
+        """Append the staged file to the current pack, returns pack id and offset. The staged file is kept."""
+        if self._needs_rotation():
+            await self._rotate(db.bind)
+        pack_id = self.pack_id
+        offset = await run_in_threadpool(append_to_pack, pack_path(pack_id), staged.path)
+        if pack_id == self.pack_id:
+            self._size = max(self._size, offset + staged.stored_size_bytes)
+        return pack_id, offset
+
+
+pack_writer = PackWriter()
+
+
+async def compact_pack(db: AsyncSession, pack_id: int):
+    """
+    Copy the live blobs of a pack into a new one and journal the old segment for deletion. Pack and blob rows
+    stay locked until commit, so concurrent compactors skip the pack and concurrent releases of its blobs wait.
+    """
+    query = select(Pack).where(Pack.id == pack_id).with_for_update(skip_locked=True)
+    if (await db.execute(query)).scalars().one_or_none() is None:
+        return
+    query = (
+        select(Blob)
+        .where(Blob.pack_id == pack_id)
+        .order_by(Blob.pack_offset)
+        .with_for_update()
+        .execution_options(populate_existing=True)
+    )
+    blobs = (await db.execute(query)).scalars().all()
+    new_path = None
+    try:
+        if blobs:
+            new_pack_id = await create_pack(db)
+            new_path = pack_path(new_pack_id)
+            offsets = await run_in_threadpool(copy_pack_entries,
+                                              pack_path(pack_id),
+                                              new_path,
+                                              [(blob.pack_offset, locate_blob(blob).stored_length) for blob in blobs])
+            for blob, offset in zip(blobs, offsets):
+                blob.pack_id, blob.pack_offset = new_pack_id, offset
+            await db.flush()
+        await db.execute(delete(Pack).where(Pack.id == pack_id))
+        # the old segment is removed by the deletion worker, see crud.DeletionCRUD
+        await db.execute(insert(PendingDeletion).values(path=pack_path(pack_id)))
+        await db.commit()
+    except BaseException:
+        await db.rollback()
+        if new_path:
+            discard(new_path)
+        raise
+    pack_maps.forget(pack_path(pack_id))
+    logger.info(msg=f"Pack id={pack_id} compacted, {len(blobs)} blobs kept")
+
+
+async def compact_packs(db: AsyncSession, min_age_seconds: float = 2 * PACK_ROTATE_SECONDS):
+    """
+    Compact packs whose live blobs take less than PACK_COMPACT_LIVE_RATIO of the segment.
+    Only packs no writer appends to anymore are considered, the age check leaves a whole
+    rotation period for uploads that appended to a pack to commit.
+    """
+    logger.info(msg="Start compacting packs")
+    query = (
+        select(Pack.id, func.coalesce(func.sum(func.coalesce(Blob.stored_size_bytes, Blob.size_bytes)), 0))
+        .outerjoin(Blob, Blob.pack_id == Pack.id)
+        .where(Pack.created_at <= datetime.utcnow() - timedelta(seconds=min_age_seconds))
+        .group_by(Pack.id)
+        .order_by(Pack.id)
+    )
+    if pack_writer.pack_id is not None:
+        query = query.where(Pack.id != pack_writer.pack_id)
+    candidates = (await db.execute(query)).all()
+    await db.commit()
+    compacted = 0
+    for pack_id, live_bytes in candidates:
+        try:
+            size = os.path.getsize(pack_path(pack_id))
+        except FileNotFoundError:
+            size = 0
+        if size and live_bytes >= size * PACK_COMPACT_LIVE_RATIO:
+            continue
+        await compact_pack(db, pack_id)
+        compacted += 1
+    logger.info(msg=f"End compacting packs, {compacted} of {len(candidates)} compacted")
@@ -0,0 +1,226 @@
+import os
+import time
+import logging
+
+from collections import Counter
+from itertools import islice
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import AsyncIterator, Iterator, List, Tuple
+from dotenv import load_dotenv
+
+from crud import DeletionCRUD
+from models import Blob, File, Pack, UploadSession
+from storage import UPLOAD_DIR, BLOBS_DIR, PACKS_DIR, TMP_DIR, SESSIONS_DIR, blob_path, pack_path
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+STORAGE_RECONCILE_BATCH_SIZE = int(os.environ.get('STORAGE_RECONCILE_BATCH_SIZE', 1000))
+# younger files may belong to transactions that haven't committed yet
+STORAGE_RECONCILE_GRACE_SECONDS = int(os.environ.get('STORAGE_RECONCILE_GRACE_SECONDS', 3600))
+STORAGE_RECONCILE_FIX = os.environ.get('STORAGE_RECONCILE_FIX', 'false').lower() == 'true'
+
+# path, name and modification time of a directory entry
+Entry = Tuple[str, str, float]
+
+
+def walk_files(root: str) -> Iterator[Entry]:
+    """Yield files under root depth first, only the directories on the current path are open at a time."""
+    try:
+        entries = os.scandir(root)
+    except FileNotFoundError:
+        return
+    with entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from walk_files(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry.path, entry.name, entry.stat(follow_symlinks=False).st_mtime
+            except FileNotFoundError:
+                # removed while walking
+                continue
+
+
+def list_dirs(root: str) -> Iterator[Entry]:
+    try:
+        entries = os.scandir(root)
+    except FileNotFoundError:
+        return
+    with entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    yield entry.path, entry.name, entry.stat(follow_symlinks=False).st_mtime
+            except FileNotFoundError:
+                continue
+
+
+def missing_paths(paths: List[str]) -> List[str]:
+    return [path for path in paths if not os.path.exists(path)]
+
+
+async def batches(entries: Iterator[Entry]) -> AsyncIterator[List[Entry]]:
+    """Pull STORAGE_RECONCILE_BATCH_SIZE entries at a time, directory listing runs in a worker thread."""
+    while True:
+        batch = await run_in_threadpool(lambda: list(islice(entries, STORAGE_RECONCILE_BATCH_SIZE)))
+        if not batch:
+            return
+        yield batch
+
+
+class StorageReconciler:
+    """
+    Cross-checks UPLOAD_DIR and the database in both directions, a batch at a time on each side.
+    Orphans, files no row references, are reported and, with STORAGE_RECONCILE_FIX, journaled for deletion.
+    Dangling rows, rows whose content is missing, are only reported: there is nothing to restore them from.
+    """
+
+    def __init__(self,
+                 db: AsyncSession,
+                 fix: bool = STORAGE_RECONCILE_FIX,
+                 grace_seconds: float = STORAGE_RECONCILE_GRACE_SECONDS):
+        self.db = db
+        self.fix = fix
+        self.settled_before = time.time() - grace_seconds
+        self.report = Counter()
+
+    async def orphans(self, kind: str, paths: List[str]):
+        if paths:
+            self.report[kind] += len(paths)
+            logger.warning(msg=f"{len(paths)} orphaned {kind} found, e.g. {paths[0]}")
+            if self.fix:
+                await DeletionCRUD(self.db).enqueue(paths)
+                self.report['queued_for_deletion'] += len(paths)
+        await self.db.commit()
+
+    def dangling(self, kind: str, ids: List):
+        if ids:
+            self.report[kind] += len(ids)
+            logger.error(msg=f"{len(ids)} {kind} without content found, ids {ids[:100]}")
+
+    async def check_blob_files(self):
+        async for batch in batches(walk_files(BLOBS_DIR)):
+            candidates = {}
+            for path, name, mtime in batch:
+                if mtime <= self.settled_before:
+                    blob_id = name.rpartition('.')[2]
+                    candidates[path] = int(blob_id) if blob_id.isdigit() else None
+            query = select(Blob).where(Blob.id.in_({blob_id for blob_id in candidates.values() if blob_id}))
+            blobs = {blob.id: blob for blob in (await self.db.execute(query)).scalars().all()}
+            await self.orphans('blob_files', [
+                path for path, blob_id in candidates.items()
+                if blob_id not in blobs
+                or blobs[blob_id].pack_id is not None
+                or path != blob_path(blobs[blob_id].hash, blob_id)
+            ])
+
+    async def check_pack_files(self):
+        async for batch in batches(walk_files(PACKS_DIR)):
+            candidates = {}
+            for path, name, mtime in batch:
+                pack_id = name.partition('.')[0]
+                if mtime <= self.settled_before:
+                    candidates[path] = int(pack_id) if pack_id.isdigit() else None
+            query = select(Pack.id).where(Pack.id.in_({pack_id for pack_id in candidates.values() if pack_id}))
+            pack_ids = set((await self.db.execute(query)).scalars().all())
+            await self.orphans('pack_files', [
+                path for path, pack_id in candidates.items()
+                if pack_id not in pack_ids or path != pack_path(pack_id)
+            ])
+
+    async def check_tmp_files(self):
+        async for batch in batches(walk_files(TMP_DIR)):
+            await self.orphans('tmp_files', [path for path, _, mtime in batch if mtime <= self.settled_before])
+
+    async def check_session_dirs(self):
+        async for batch in batches(list_dirs(SESSIONS_DIR)):
+            candidates = {name: path for path, name, mtime in batch if mtime <= self.settled_before}
+            query = select(UploadSession.id).where(UploadSession.id.in_(candidates))
+            session_ids = set((await self.db.execute(query)).scalars().all())
+            await self.orphans('session_dirs', [
+                path for session_id, path in candidates.items() if session_id not in session_ids
+            ])
+
+    async def check_legacy_files(self):
+        """Files uploaded before the blob store live in {UPLOAD_DIR}/{owner id}/."""
+        owner_dirs = await run_in_threadpool(
+            lambda: [path for path, name, _ in list_dirs(UPLOAD_DIR) if name.isdigit()]
+        )
+        for file_dir in owner_dirs:
+            async for batch in batches(walk_files(file_dir)):
+                candidates = {name: path for path, name, mtime in batch
+                              if mtime <= self.settled_before and os.path.dirname(path) == file_dir}
+                query = select(File.filename).where(File.file_dir == file_dir,
+                                                    File.blob_id.is_(None),
+                                                    File.filename.in_(candidates))
+                filenames = set((await self.db.execute(query)).scalars().all())
+                await self.orphans('legacy_files', [
+                    path for filename, path in candidates.items() if filename not in filenames
+                ])
+
+    async def check_blob_rows(self):
+        last_id = 0
+        while True:
+            query = (
+                select(Blob)
+                .where(Blob.id > last_id, Blob.pack_id.is_(None))
+                .order_by(Blob.id)
+                .limit(STORAGE_RECONCILE_BATCH_SIZE)
+            )
+            blobs = (await self.db.execute(query)).scalars().all()
+            await self.db.commit()
+            if not blobs:
+                return
+            last_id = blobs[-1].id
+            paths = {blob_path(blob.hash, blob.id): blob.id for blob in blobs}
+            self.dangling('blobs', [paths[path] for path in await run_in_threadpool(missing_paths, list(paths))])
+
+    async def check_pack_rows(self):
+        last_id = 0
+        while True:
+            query = (
+                select(Pack.id)
+                .where(Pack.id > last_id, Pack.id.in_(select(Blob.pack_id)))
+                .order_by(Pack.id)
+                .limit(STORAGE_RECONCILE_BATCH_SIZE)
+            )
+            pack_ids = (await self.db.execute(query)).scalars().all()
+            await self.db.commit()
+            if not pack_ids:
+                return
+            last_id = pack_ids[-1]
+            paths = {pack_path(pack_id): pack_id for pack_id in pack_ids}
+            self.dangling('packs', [paths[path] for path in await run_in_threadpool(missing_paths, list(paths))])
+
+    async def check_legacy_rows(self):
+        last_id = 0
+        while True:
+            query = (
+                select(File.id, File.file_dir, File.filename)
+                .where(File.id > last_id, File.blob_id.is_(None))
+                .order_by(File.id)
+                .limit(STORAGE_RECONCILE_BATCH_SIZE)
+            )
+            rows = (await self.db.execute(query)).all()
+            await self.db.commit()
+            if not rows:
+                return
+            last_id = rows[-1].id
+            paths = {f'{row.file_dir}/{row.filename}': row.id for row in rows}
+            self.dangling('files', [paths[path] for path in await run_in_threadpool(missing_paths, list(paths))])
+
+    async def run(self) -> Counter:
+        logger.info(msg="Start reconciling storage")
+        await self.check_blob_files()
+        await self.check_pack_files()
+        await self.check_tmp_files()
+        await self.check_session_dirs()
+        await self.check_legacy_files()
+        await self.check_blob_rows()
+        await self.check_pack_rows()
+        await self.check_legacy_rows()
+        logger.info(msg=f"End reconciling storage, {dict(self.report) or 'nothing to report'}")
+        return self.report
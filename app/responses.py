@@ -0,0 +1,297 @@
+import os
+import logging
+
+import anyio
+from fastapi import HTTPException, Request
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+from typing import List, Optional, Tuple
+from urllib.parse import quote
+
+from storage import CHUNK_SIZE, Location, iter_location, pack_maps
+
+logger = logging.getLogger(__name__)
+
+ZEROCOPY_EXTENSION = "http.response.zerocopysend"
+# parts of a multipart/byteranges response at most, compressed content is decompressed from its start for each
+MAX_RANGES = 100
+
+ByteRange = Tuple[int, int]
+
+
+def make_etag(filehash: str) -> str:
+    return f'"{filehash}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or f'W/{etag}' in tags
+
+
+def accepts_encoding(accept_encoding: Optional[str], encoding: str) -> bool:
+    """Whether an Accept-Encoding header names encoding (or "*") without q=0."""
+    if not accept_encoding:
+        return False
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() not in (encoding, '*'):
+            continue
+        quality = params.strip()
+        if quality.startswith('q='):
+            try:
+                return float(quality[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+def parse_range_header(range_header: Optional[str], size: int) -> Optional[List[ByteRange]]:
+    """
+    Parse a "bytes=" Range header into inclusive (start, end) pairs, overlapping and adjacent ranges merged.
+    Returns None when the whole content should be sent, which includes malformed headers and headers
+    with more than MAX_RANGES ranges, raises 416 if no range is satisfiable.
+    """
+    if not range_header:
+        return None
+    unit, _, ranges_spec = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or not ranges_spec:
+        return None
+    range_specs = ranges_spec.split(',')
+    if len(range_specs) > MAX_RANGES:
+        logger.debug("Range header with %s ranges ignored", len(range_specs))
+        return None
+    ranges = []
+    for range_spec in range_specs:
+        start, sep, end = range_spec.strip().partition('-')
+        if not sep or not (start or end) or not all(value.isdigit() for value in (start, end) if value):
+            return None
+        try:
+            if not start:
+                suffix = int(end)
+                if suffix == 0:
+                    continue
+                ranges.append((max(size - suffix, 0), size - 1))
+                continue
+            start = int(start)
+            end = int(end) if end else None
+        except ValueError:
+            return None
+        if end is not None and start > end:
+            return None
+        if start < size:
+            ranges.append((start, size - 1 if end is None else min(end, size - 1)))
+    if not ranges:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def content_disposition(filename: str) -> str:
+    quoted_filename = quote(filename)
+    if quoted_filename != filename:
+        return f"attachment; filename*=utf-8''{quoted_filename}"
+    return f'attachment; filename="{filename}"'
+
+
+class RangeFileResponse(Response):
+    """
+    Sends byte ranges of a stored file. Uses the ASGI zero-copy extension when the server offers it,
+    otherwise reads the file in CHUNK_SIZE pieces with pread in a worker thread.
+    Small packed files are copied straight out of the mmap'd pack segment instead,
+    compressed files are decompressed as they are sent. Content already in memory is sliced.
+    """
+
+    chunk_size = CHUNK_SIZE
+
+    def __init__(self,
+                 location: Location,
+                 ranges: Optional[List[ByteRange]] = None,
+                 headers: dict = None,
+                 media_type: str = None,
+                 send_header_only: bool = False,
+                 content: Optional[bytes] = None):
+        self.location = location
+        self.content = content
+        self.media_type = media_type or "application/octet-stream"
+        self.background = None
+        self.send_header_only = send_header_only
+        self.ranges = ranges or [(0, location.length - 1)]
+        self.status_code = 206 if ranges else 200
+        self.init_headers(headers)
+        self.headers["accept-ranges"] = "bytes"
+        self.parts = []
+        if len(self.ranges) == 1:
+            start, end = self.ranges[0]
+            if ranges:
+                self.headers["content-range"] = f"bytes {start}-{end}/{location.length}"
+            self.headers["content-length"] = str(end - start + 1)
+        else:
+            boundary = os.urandom(16).hex()
+            self.headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+            content_length = 0
+            for start, end in self.ranges:
+                part_header = (
+                    f"--{boundary}\r\n"
+                    f"Content-Type: {self.media_type}\r\n"
+                    f"Content-Range: bytes {start}-{end}/{location.length}\r\n\r\n"
+                ).encode('latin-1')
+                self.parts.append((part_header, start, end))
+                content_length += len(part_header) + (end - start + 1) + 2
+            self.closing = f"--{boundary}--\r\n".encode('latin-1')
+            self.headers["content-length"] = str(content_length + len(self.closing))
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+        if self.send_header_only:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        if self.content is not None:
+            await self.send_content(send)
+            return
+        if self.location.compression:
+            await self.send_decompressed(send)
+            return
+        if self.location.packed:
+            await self.send_packed(send)
+            return
+        zerocopy = ZEROCOPY_EXTENSION in scope.get("extensions", {})
+        with open(self.location.path, 'rb') as file:
+            if not self.parts:
+                start, end = self.ranges[0]
+                await self.send_range(send, file, start, end, zerocopy)
+            else:
+                for part_header, start, end in self.parts:
+                    await send({"type": "http.response.body", "body": part_header, "more_body": True})
+                    await self.send_range(send, file, start, end, zerocopy)
+                    await send({"type": "http.response.body", "body": b"\r\n", "more_body": True})
+                await send({"type": "http.response.body", "body": self.closing, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def send_decompressed(self, send: Send):
+        if not self.parts:
+            start, end = self.ranges[0]
+            await self.send_decompressed_range(send, start, end)
+        else:
+            for part_header, start, end in self.parts:
+                await send({"type": "http.response.body", "body": part_header, "more_body": True})
+                await self.send_decompressed_range(send, start, end)
+                await send({"type": "http.response.body", "body": b"\r\n", "more_body": True})
+            await send({"type": "http.response.body", "body": self.closing, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def send_decompressed_range(self, send: Send, start: int, end: int):
+        """Compressed content can't be seeked into, everything before start is decompressed and skipped."""
+        position = 0
+        async for chunk in iter_location(self.location):
+            chunk_start, position = position, position + len(chunk)
+            if position <= start:
+                continue
+            body = chunk[max(start - chunk_start, 0):end + 1 - chunk_start]
+            await send({"type": "http.response.body", "body": body, "more_body": True})
+            if position > end:
+                return
+        if position <= end:
+            raise RuntimeError(f"Content at path {self.location.path} is shorter than expected")
+
+    async def send_content(self, send: Send):
+        if not self.parts:
+            start, end = self.ranges[0]
+            await send({"type": "http.response.body", "body": self.content[start:end + 1]})
+            return
+        for part_header, start, end in self.parts:
+            await send({
+                "type": "http.response.body",
+                "body": part_header + self.content[start:end + 1] + b"\r\n",
+                "more_body": True,
+            })
+        await send({"type": "http.response.body", "body": self.closing})
+
+    async def send_packed(self, send: Send):
+        if not self.parts:
+            start, end = self.ranges[0]
+            await send({"type": "http.response.body", "body": pack_maps.read(self.location, start, end - start + 1)})
+            return
+        for part_header, start, end in self.parts:
+            await send({
+                "type": "http.response.body",
+                "body": part_header + pack_maps.read(self.location, start, end - start + 1) + b"\r\n",
+                "more_body": True,
+            })
+        await send({"type": "http.response.body", "body": self.closing})
+
+    async def send_range(self, send: Send, file, start: int, end: int, zerocopy: bool):
+        offset = self.location.offset + start
+        count = end - start + 1
+        if zerocopy:
+            await send({
+                "type": ZEROCOPY_EXTENSION,
+                "file": file,
+                "offset": offset,
+                "count": count,
+                "more_body": True,
+            })
+            return
+        fd = file.fileno()
+        while count > 0:
+            chunk = await anyio.to_thread.run_sync(os.pread, fd, min(self.chunk_size, count), offset)
+            if not chunk:
+                raise RuntimeError(f"File at path {self.location.path} is shorter than expected")
+            offset += len(chunk)
+            count -= len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+
+
+def build_file_response(request: Request,
+                        location: Location,
+                        filehash: str,
+                        media_type: str,
+                        filename: str,
+                        content: Optional[bytes] = None) -> Response:
+    """
+    Answer a download request with 304, 206 or 200 depending on conditional and Range headers.
+    content, when given, is the uncompressed content at location, sent from memory.
+    Compressed content is sent as stored with Content-Encoding when the client accepts the encoding
+    and asks for the whole file, otherwise it's decompressed on the fly.
+    """
+    range_header = request.headers.get("range")
+    headers = {"content-disposition": content_disposition(filename)}
+    if location.compression:
+        headers["vary"] = "Accept-Encoding"
+        if range_header is None and accepts_encoding(request.headers.get("accept-encoding"), location.compression):
+            logger.debug("Sending content %s encoded", location.compression)
+            headers["content-encoding"] = location.compression
+            filehash = f'{filehash}-{location.compression}'
+            location = location._replace(length=location.stored_length, compression=None)
+    etag = make_etag(filehash)
+    headers["etag"] = etag
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        logger.debug(msg="ETag matched, sending 304")
+        return Response(status_code=304, headers={"etag": etag})
+    if_range = request.headers.get("if-range")
+    if if_range is not None and if_range.strip() != etag:
+        range_header = None
+    ranges = parse_range_header(range_header, location.length)
+    return RangeFileResponse(
+        location=location,
+        ranges=ranges,
+        headers=headers,
+        media_type=media_type,
+        send_header_only=request.method == "HEAD",
+        content=content,
+    )
@@ -1,23 +1,56 @@
+import os
+import time
 import asyncio
 import logging
 
-from fastapi import APIRouter, Depends, HTTPException, status, Form, UploadFile, File as File_
-from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Depends, HTTPException, status, Form, Header, Query, Request, Response, UploadFile, File as File_
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
-from typing import Optional
+from starlette.concurrency import run_in_threadpool
+from datetime import datetime
+from typing import List, Optional
+from urllib.parse import unquote
 
 from auth import (
     authenticate_user,
     create_token,
     get_current_user
 )
-from schemas import UserRead, UserCreate, FileRead, FileCreate
-from crud import UserCRUD, FileCRUD
+from schemas import (
+    UserRead,
+    UserCreate,
+    UserUsage,
+    FileRead,
+    FileCreate,
+    FilePage,
+    FilePreflight,
+    FilePreflightResult,
+    FileBatchItem,
+    FileBatchDelete,
+    FileIntegrityFailure,
+    FileLink,
+    UploadSessionCreate,
+    UploadSessionRead,
+)
+from crud import BATCH_MAX_FILES, CachedFile, UserCRUD, FileCRUD, UploadSessionCRUD
+from export import export_entries, stream_tar, stream_zip
+from links import (
+    LINK_MAX_TTL_SECONDS,
+    LINK_TTL_SECONDS,
+    LinkClaims,
+    deny_list,
+    invalid_link_error,
+    link_token,
+    verify_link,
+)
+from logs import log_step
+from responses import build_file_response
+from storage import check_content_length, locate, validate_filename
 
 
 users_router = APIRouter(prefix="/users", tags=["users"])
 files_router = APIRouter(prefix="/files", tags=["files"])
+links_router = APIRouter(prefix="/links", tags=["links"])
 
 logger = logging.getLogger(__name__)
 
@@ -29,10 +62,10 @@ async def async_print():
 
 @users_router.post('/token')
 async def login(form_data: OAuth2PasswordRequestForm = Depends(), users: UserCRUD = Depends()):
-    logger.info(msg="Start logining user")
-    user = authenticate_user(form_data.username, form_data.password, users)
+    log_step(logger, "Start logining user")
+    user = await authenticate_user(form_data.username, form_data.password, users)
     response = create_token(user.username)
-    logger.info(msg="End logining user")
+    log_step(logger, "End logining user")
     return response
 
 
@@ -43,15 +76,15 @@ async def create_user(username: str = Form(...),
                       last_name: Optional[str] = Form(None),
                       password: str = Form(...),
                       users: UserCRUD = Depends()):
-    logger.info(msg="Start registering user")
+    log_step(logger, "Start registering user")
     user = UserCreate(username=username,
                       email=email,
                       first_name=first_name,
                       last_name=last_name,
                       password=password)
-    db_user = users.create(user)
+    db_user = await users.create(user)
     response = UserRead.from_orm(db_user)
-    logger.info(msg="End registering user")
+    log_step(logger, "End registering user")
     return response
 
 
@@ -60,17 +93,22 @@ async def get_login_user(current_user: UserRead = Depends(get_current_user)):
     return current_user
 
 
+@users_router.get("/logined_user/usage", response_model=UserUsage)
+async def get_login_user_usage(current_user: UserRead = Depends(get_current_user), users: UserCRUD = Depends()):
+    return await users.read_usage(user_id=current_user.id)
+
+
 @users_router.get("/{username}", response_model=UserRead)
 async def get_user(username: str, users: UserCRUD = Depends()):
-    logger.info(msg=f"Try to find user '{username}'")
-    db_user = users.read_by_username(username)
+    logger.info("Try to find user '%s'", username)
+    db_user = await users.read_by_username(username)
     if db_user is None:
         logger.error(msg=f"User '{username}' NOT found")
         raise HTTPException(
             status_code=404,
             detail="User not found"
         )
-    logger.info(msg=f"User '{username}' found")
+    logger.info("User '%s' found", username)
     return UserRead.from_orm(db_user)
 
 
@@ -80,7 +118,7 @@ async def upload_file(description: Optional[str] = Form(None),
                       files: FileCRUD = Depends(),
                       current_user: UserRead = Depends(get_current_user)
                       ):
-    logger.info(msg="Start upload file")
+    log_step(logger, "Start upload file")
     file_data = FileCreate(description=description,
                            file=file,
                            )
@@ -92,20 +130,208 @@ async def upload_file(description: Optional[str] = Form(None),
     ]
     result = await asyncio.gather(*tasks, loop=main_loop)
     db_file = result[0]
-    logger.info(msg="End upload file")
+    log_step(logger, "End upload file")
+    return FileRead.from_orm(db_file)
+
+
+@files_router.post("/batch", response_model=List[FileBatchItem])
+async def upload_files_batch(files_to_upload: List[UploadFile] = File_(..., alias="files"),
+                             files: FileCRUD = Depends(),
+                             current_user: UserRead = Depends(get_current_user)):
+    return await files.create_many(uploads=files_to_upload, current_user=current_user)
+
+
+@files_router.delete("/batch", response_model=List[FileBatchItem])
+async def delete_files_batch(data: FileBatchDelete,
+                             files: FileCRUD = Depends(),
+                             current_user: UserRead = Depends(get_current_user)):
+    if len(data.ids) > BATCH_MAX_FILES:
+        raise HTTPException(
+            status_code=422,
+            detail=f"Please, delete at most {BATCH_MAX_FILES} files at once"
+        )
+    results = await files.delete_files_by_ids(current_user=current_user, file_ids=data.ids)
+    for result in results:
+        if result.status_code == 200:
+            deny_list.revoke(result.id)
+    return results
+
+
+@files_router.post("/preflight", response_model=FilePreflightResult)
+async def upload_preflight(preflight: FilePreflight,
+                           files: FileCRUD = Depends(),
+                           current_user: UserRead = Depends(get_current_user)):
+    return await files.preflight(preflight=preflight, current_user=current_user)
+
+
+@files_router.post("/uploads", response_model=UploadSessionRead, status_code=status.HTTP_201_CREATED)
+async def create_upload_session(data: UploadSessionCreate,
+                                sessions: UploadSessionCRUD = Depends(),
+                                current_user: UserRead = Depends(get_current_user)):
+    return await sessions.create(data=data, current_user=current_user)
+
+
+@files_router.get("/uploads/{session_id}", response_model=UploadSessionRead)
+async def get_upload_session(session_id: str,
+                             sessions: UploadSessionCRUD = Depends(),
+                             current_user: UserRead = Depends(get_current_user)):
+    return await sessions.read_status(session_id=session_id, current_user=current_user)
+
+
+@files_router.put("/uploads/{session_id}/chunks/{index}", status_code=status.HTTP_204_NO_CONTENT)
+async def put_upload_session_chunk(session_id: str,
+                                   index: int,
+                                   request: Request,
+                                   sessions: UploadSessionCRUD = Depends(),
+                                   current_user: UserRead = Depends(get_current_user)):
+    await sessions.put_chunk(session_id=session_id, index=index, chunks=request.stream(), current_user=current_user)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+@files_router.post("/uploads/{session_id}/commit", response_model=FileRead)
+async def commit_upload_session(session_id: str,
+                                sessions: UploadSessionCRUD = Depends(),
+                                current_user: UserRead = Depends(get_current_user)):
+    db_file = await sessions.commit(session_id=session_id, current_user=current_user)
+    return FileRead.from_orm(db_file)
+
+
+@files_router.delete("/uploads/{session_id}")
+async def delete_upload_session(session_id: str,
+                                sessions: UploadSessionCRUD = Depends(),
+                                current_user: UserRead = Depends(get_current_user)):
+    await sessions.delete(session_id=session_id, current_user=current_user)
+    return f'Upload session {session_id} successfully deleted'
+
+
+@files_router.put("/{filename}", response_model=FileRead)
+async def put_file(filename: str,
+                   request: Request,
+                   content_type: str = Header("application/octet-stream"),
+                   content_length: Optional[int] = Header(None),
+                   x_file_description: Optional[str] = Header(None),
+                   files: FileCRUD = Depends(),
+                   current_user: UserRead = Depends(get_current_user)
+                   ):
+    log_step(logger, "Start put file")
+    validate_filename(filename)
+    check_content_length(content_length)
+    description = unquote(x_file_description) if x_file_description is not None else None
+    db_file = await files.create_from_stream(chunks=request.stream(),
+                                             filename=filename,
+                                             content_type=content_type,
+                                             description=description,
+                                             current_user=current_user)
+    log_step(logger, "End put file")
     return FileRead.from_orm(db_file)
 
 
-@files_router.get("/")
-async def get_user_files(current_user: UserRead = Depends(get_current_user), files: FileCRUD = Depends()):
-    db_files_dict = files.read_current_user_all_files(current_user=current_user)
-    logger.debug(msg="Start encode content to JSON")
-    content = jsonable_encoder(db_files_dict)
-    logger.debug(msg="End encode content to JSON")
-    return JSONResponse(content=content)
+@files_router.get("/", response_model=FilePage)
+async def get_user_files(cursor: Optional[int] = None,
+                         limit: int = Query(100, ge=1, le=1000),
+                         order: str = Query("asc", regex="^(asc|desc)$"),
+                         content_type: Optional[str] = None,
+                         min_size: Optional[int] = Query(None, ge=0),
+                         max_size: Optional[int] = Query(None, ge=0),
+                         name_prefix: Optional[str] = None,
+                         current_user: UserRead = Depends(get_current_user),
+                         files: FileCRUD = Depends()):
+    return await files.read_current_user_files(current_user=current_user,
+                                               cursor=cursor,
+                                               limit=limit,
+                                               order=order,
+                                               content_type=content_type,
+                                               min_size=min_size,
+                                               max_size=max_size,
+                                               name_prefix=name_prefix)
+
+
+@files_router.get("/export")
+async def export_files(ids: Optional[List[int]] = Query(None),
+                       archive_format: str = Query("zip", alias="format", regex="^(zip|tar)$"),
+                       files: FileCRUD = Depends(),
+                       current_user: UserRead = Depends(get_current_user)):
+    if ids is not None:
+        if len(ids) > BATCH_MAX_FILES:
+            raise HTTPException(
+                status_code=422,
+                detail=f"Please, export at most {BATCH_MAX_FILES} selected files at once"
+            )
+        await files.check_files_owned(current_user=current_user, file_ids=ids)
+    entries = export_entries(files.iter_current_user_files(current_user=current_user, file_ids=ids))
+    return StreamingResponse(stream_zip(entries) if archive_format == "zip" else stream_tar(entries),
+                             media_type="application/zip" if archive_format == "zip" else "application/x-tar",
+                             headers={"Content-Disposition": f'attachment; filename="files.{archive_format}"'})
+
+
+@files_router.get("/integrity", response_model=List[FileIntegrityFailure])
+async def get_integrity_failures(current_user: UserRead = Depends(get_current_user), files: FileCRUD = Depends()):
+    return await files.read_integrity_failures(current_user=current_user)
+
+
+@files_router.api_route("/{file_id}/content", methods=["GET", "HEAD"])
+async def download_file(file_id: int,
+                        request: Request,
+                        current_user: UserRead = Depends(get_current_user),
+                        files: FileCRUD = Depends()):
+    db_file = await files.read_current_user_file_content(current_user=current_user, file_id=file_id)
+    if isinstance(db_file, CachedFile):
+        return build_file_response(request=request,
+                                   location=db_file.location,
+                                   filehash=db_file.filehash,
+                                   media_type=db_file.content_type,
+                                   filename=db_file.filename,
+                                   content=db_file.content)
+    return build_file_response(request=request,
+                               location=locate(db_file),
+                               filehash=db_file.filehash,
+                               media_type=db_file.content_type,
+                               filename=db_file.filename)
 
 
 @files_router.delete("/{file_id}")
 async def delete_file(file_id: int, current_user: UserRead = Depends(get_current_user), files: FileCRUD = Depends()):
-    deleted_filename = files.delete_file_by_id(current_user=current_user, file_id=file_id)
+    deleted_filename = await files.delete_file_by_id(current_user=current_user, file_id=file_id)
+    deny_list.revoke(file_id)
     return f'File {deleted_filename} successfully deleted'
+
+
+@files_router.post("/{file_id}/link", response_model=FileLink)
+async def create_file_link(file_id: int,
+                           request: Request,
+                           ttl_seconds: int = Query(LINK_TTL_SECONDS, ge=1, le=LINK_MAX_TTL_SECONDS),
+                           current_user: UserRead = Depends(get_current_user),
+                           files: FileCRUD = Depends()):
+    db_file = await files.read_current_user_file(current_user=current_user, file_id=file_id)
+    expires_at = int(time.time()) + ttl_seconds
+    token = link_token(LinkClaims(file_id=db_file.id,
+                                  location=locate(db_file),
+                                  filehash=db_file.filehash,
+                                  media_type=db_file.content_type,
+                                  filename=db_file.filename,
+                                  issued_at=time.time(),
+                                  expires_at=expires_at))
+    return FileLink(url=request.url_for("download_link", token=token), expires_at=datetime.utcfromtimestamp(expires_at))
+
+
+@files_router.delete("/{file_id}/link")
+async def revoke_file_links(file_id: int,
+                            current_user: UserRead = Depends(get_current_user),
+                            files: FileCRUD = Depends()):
+    await files.read_current_user_file(current_user=current_user, file_id=file_id)
+    deny_list.revoke(file_id)
+    return f'Links of file {file_id} successfully revoked'
+
+
+@links_router.api_route("/{token}", methods=["GET", "HEAD"])
+async def download_link(token: str, request: Request):
+    """Serves a link minted by create_file_link from what it carries, no database or token lookups."""
+    claims = verify_link(token)
+    # the content moved away, e.g. its pack was compacted, a new link points to where it is now
+    if not await run_in_threadpool(os.path.exists, claims.location.path):
+        raise invalid_link_error()
+    return build_file_response(request=request,
+                               location=claims.location,
+                               filehash=claims.filehash,
+                               media_type=claims.media_type,
+                               filename=claims.filename)
@@ -1,7 +1,10 @@
-from typing import Optional
+from datetime import datetime
+from typing import List, Optional
 
 from fastapi import UploadFile, File as File_
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, validator
+
+from hashing import FILE_HASH_ALGORITHM
 
 
 class Token(BaseModel):
@@ -32,6 +35,18 @@ class UserRead(UserBase):
         orm_mode = True
 
 
+class UserUsage(BaseModel):
+    used_bytes: int
+    files_count: int
+    # None means unlimited
+    quota_bytes: Optional[int] = None
+    quota_files: Optional[int] = None
+
+    def fits(self, size_bytes: int, files_count: int = 1) -> bool:
+        return ((self.quota_bytes is None or self.used_bytes + size_bytes <= self.quota_bytes)
+                and (self.quota_files is None or self.files_count + files_count <= self.quota_files))
+
+
 class FileBase(BaseModel):
     description: Optional[str] = None
     file_size_bytes: Optional[int] = None
@@ -44,6 +59,7 @@ class FileCreate(FileBase):
 
 class FileRead(FileBase):
     id: int
+    filehash_algorithm: Optional[str] = None
     filename: str
     file_dir: str
     content_type: str
@@ -51,3 +67,79 @@ class FileRead(FileBase):
 
     class Config:
         orm_mode = True
+
+
+class FilePage(BaseModel):
+    items: List[FileRead]
+    next_cursor: Optional[int] = None
+
+
+def filename_is_plain(filename: str) -> str:
+    if not filename or filename in ('.', '..') or '/' in filename or '\\' in filename:
+        raise ValueError("invalid filename")
+    return filename
+
+
+class FilePreflight(BaseModel):
+    hash: str = Field(..., regex="^[0-9a-f]{64}$")
+    hash_algorithm: str = FILE_HASH_ALGORITHM
+    size: int = Field(..., ge=0)
+    filename: str
+    content_type: str = "application/octet-stream"
+    description: Optional[str] = None
+
+    _filename_is_plain = validator("filename", allow_reuse=True)(filename_is_plain)
+
+
+class FilePreflightResult(BaseModel):
+    status: str
+    file: Optional[FileRead] = None
+
+
+class UploadSessionCreate(BaseModel):
+    filename: str
+    file_size_bytes: int = Field(..., ge=0)
+    filehash: str = Field(..., regex="^[0-9a-f]{64}$")
+    filehash_algorithm: str = FILE_HASH_ALGORITHM
+    content_type: str = "application/octet-stream"
+    description: Optional[str] = None
+    chunk_size_bytes: Optional[int] = None
+
+    _filename_is_plain = validator("filename", allow_reuse=True)(filename_is_plain)
+
+
+class UploadSessionRead(BaseModel):
+    id: str
+    filename: str
+    file_size_bytes: int
+    filehash: str
+    chunk_size_bytes: int
+    chunks_count: int
+    expires_at: datetime
+    received_chunks: List[int] = []
+
+    class Config:
+        orm_mode = True
+
+
+class FileBatchItem(BaseModel):
+    id: Optional[int] = None
+    filename: Optional[str] = None
+    status_code: int
+    detail: Optional[str] = None
+    file: Optional[FileRead] = None
+
+
+class FileIntegrityFailure(BaseModel):
+    file: FileRead
+    error: str
+    detected_at: datetime
+
+
+class FileLink(BaseModel):
+    url: str
+    expires_at: datetime
+
+
+class FileBatchDelete(BaseModel):
+    ids: List[int] = Field(..., min_items=1)
@@ -0,0 +1,224 @@
+import os
+import time
+import asyncio
+import logging
+import logging.config
+
+from collections import Counter
+from concurrent.futures import Executor, ProcessPoolExecutor
+from datetime import datetime
+from sqlalchemy import select, delete, exists
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, NamedTuple, Optional
+from dotenv import load_dotenv
+
+import database
+from compression import new_decompressor
+from hashing import algorithm_of, new_hasher
+from models import Blob, File, ScrubCursor, ScrubFailure
+from storage import CHUNK_SIZE, Location, locate, locate_blob
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+SCRUB_WORKERS = int(os.environ.get('SCRUB_WORKERS', 0)) or os.cpu_count()
+# 0 disables the limit
+SCRUB_RATE_MB_PER_SECOND = float(os.environ.get('SCRUB_RATE_MB_PER_SECOND', 20))
+SCRUB_BATCH_SIZE = int(os.environ.get('SCRUB_BATCH_SIZE', 500))
+
+
+class ScrubItem(NamedTuple):
+    id: int
+    location: Location
+    filehash: str
+    filehash_algorithm: str
+
+
+def verify_location(location: Location, filehash: str, filehash_algorithm: str) -> Optional[str]:
+    """Re-hash the content stored at location, returns what is wrong with it or None. Runs in a pool process."""
+    hasher = new_hasher(filehash_algorithm)
+    size = 0
+    try:
+        decompressor = new_decompressor(location.compression) if location.compression else None
+        with open(location.path, 'rb') as file:
+            offset, remaining = location.offset, location.stored_length
+            while remaining > 0:
+                data = os.pread(file.fileno(), min(CHUNK_SIZE, remaining), offset)
+                if not data:
+                    return f"truncated, {location.stored_length - remaining} of {location.stored_length} bytes stored"
+                offset += len(data)
+                remaining -= len(data)
+                if decompressor:
+                    data = decompressor.decompress(data)
+                size += len(data)
+                hasher.update(data)
+    except FileNotFoundError:
+        return "missing"
+    except Exception as error:
+        return f"unreadable, {error}"
+    if size != location.length:
+        return f"size is {size} bytes, expected {location.length}"
+    actual_hash = hasher.hexdigest()
+    if actual_hash != filehash:
+        return f"hash is {actual_hash}, expected {filehash}"
+    return None
+
+
+class RateLimiter:
+    """Spaces out work so that on average at most rate bytes per second are started."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._next_start = time.monotonic()
+
+    async def acquire(self, amount: int):
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        start = max(self._next_start, now)
+        self._next_start = start + amount / self.rate
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+class Scrubber:
+    """
+    Re-hashes stored content in a process pool, so throughput scales with cores, walking blobs and legacy
+    files by id. The cursor is saved after every batch, an interrupted pass resumes where it stopped.
+    Failures are upserted into scrub_failures and cleared once the content verifies again.
+    """
+
+    def __init__(self,
+                 db: AsyncSession,
+                 executor: Executor,
+                 workers: int = SCRUB_WORKERS,
+                 rate_mb_per_second: float = SCRUB_RATE_MB_PER_SECOND):
+        self.db = db
+        self.executor = executor
+        self.workers = workers
+        self.limiter = RateLimiter(rate_mb_per_second * 1024 * 1024)
+        self.report = Counter()
+
+    async def read_blobs(self, last_id: int) -> List[ScrubItem]:
+        query = select(Blob).where(Blob.id > last_id).order_by(Blob.id).limit(SCRUB_BATCH_SIZE)
+        return [
+            ScrubItem(id=blob.id,
+                      location=locate_blob(blob),
+                      filehash=blob.hash,
+                      filehash_algorithm=blob.hash_algorithm)
+            for blob in (await self.db.execute(query)).scalars().all()
+        ]
+
+    async def read_legacy_files(self, last_id: int) -> List[ScrubItem]:
+        query = (
+            select(File)
+            .where(File.id > last_id, File.blob_id.is_(None))
+            .order_by(File.id)
+            .limit(SCRUB_BATCH_SIZE)
+        )
+        return [
+            ScrubItem(id=db_file.id,
+                      location=locate(db_file),
+                      filehash=db_file.filehash,
+                      filehash_algorithm=algorithm_of(db_file.filehash, db_file.filehash_algorithm))
+            for db_file in (await self.db.execute(query)).scalars().all()
+        ]
+
+    async def verify(self, items: List[ScrubItem]) -> List[Optional[str]]:
+        loop = asyncio.get_running_loop()
+        # enough jobs in flight to keep every worker busy
+        semaphore = asyncio.Semaphore(self.workers * 2)
+
+        async def verify_item(item: ScrubItem) -> Optional[str]:
+            async with semaphore:
+                await self.limiter.acquire(item.location.stored_length)
+                return await loop.run_in_executor(self.executor,
+                                                  verify_location,
+                                                  item.location,
+                                                  item.filehash,
+                                                  item.filehash_algorithm)
+
+        return await asyncio.gather(*(verify_item(item) for item in items))
+
+    async def record(self, key_column, items: List[ScrubItem], errors: List[Optional[str]]):
+        failed = [(item, error) for item, error in zip(items, errors) if error is not None]
+        for item, error in failed:
+            logger.error(msg=f"Scrub of {key_column.key}={item.id} at {item.location.path} failed: {error}")
+            query = (
+                insert(ScrubFailure)
+                .values({key_column.key: item.id, 'error': error, 'detected_at': datetime.utcnow()})
+                .on_conflict_do_update(index_elements=[key_column.key],
+                                       set_={'error': error, 'detected_at': datetime.utcnow()})
+            )
+            await self.db.execute(query)
+        verified_ids = [item.id for item, error in zip(items, errors) if error is None]
+        if verified_ids:
+            await self.db.execute(delete(ScrubFailure).where(key_column.in_(verified_ids)))
+        self.report['checked'] += len(items)
+        self.report['failed'] += len(failed)
+        self.report['bytes'] += sum(item.location.stored_length for item in items)
+
+    async def save_cursor(self, target: str, last_id: int):
+        query = (
+            insert(ScrubCursor)
+            .values(target=target, last_id=last_id, updated_at=datetime.utcnow())
+            .on_conflict_do_update(index_elements=[ScrubCursor.target],
+                                   set_={'last_id': last_id, 'updated_at': datetime.utcnow()})
+        )
+        await self.db.execute(query)
+        await self.db.commit()
+
+    async def scrub(self, target: str, read_batch, key_column):
+        query = select(ScrubCursor.last_id).where(ScrubCursor.target == target)
+        last_id = (await self.db.execute(query)).scalar_one_or_none() or 0
+        if last_id:
+            logger.info(msg=f"Resuming scrub of {target} after id={last_id}")
+        while True:
+            items = await read_batch(last_id)
+            if not items:
+                break
+            await self.db.commit()
+            await self.record(key_column, items, await self.verify(items))
+            last_id = items[-1].id
+            await self.save_cursor(target, last_id)
+        # the pass is complete, the next one starts from the beginning
+        await self.save_cursor(target, 0)
+
+    async def prune(self):
+        """Forget failures of content that has been deleted since."""
+        await self.db.execute(delete(ScrubFailure).where(
+            ScrubFailure.blob_id.isnot(None),
+            ~exists().where(Blob.id == ScrubFailure.blob_id)
+        ).execution_options(synchronize_session=False))
+        await self.db.execute(delete(ScrubFailure).where(
+            ScrubFailure.file_id.isnot(None),
+            ~exists().where(File.id == ScrubFailure.file_id, File.blob_id.is_(None))
+        ).execution_options(synchronize_session=False))
+        await self.db.commit()
+
+    async def run(self) -> Counter:
+        logger.info(msg="Start scrubbing stored files")
+        await self.prune()
+        await self.scrub('blobs', self.read_blobs, ScrubFailure.blob_id)
+        await self.scrub('files', self.read_legacy_files, ScrubFailure.file_id)
+        logger.info(msg=f"End scrubbing stored files, {dict(self.report)}")
+        return self.report
+
+
+async def scrub(db: AsyncSession,
+                workers: int = SCRUB_WORKERS,
+                rate_mb_per_second: float = SCRUB_RATE_MB_PER_SECOND) -> Counter:
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return await Scrubber(db, executor, workers=workers, rate_mb_per_second=rate_mb_per_second).run()
+
+
+async def main():
+    async with database.SessionLocal() as db:
+        await scrub(db)
+    await database.dispose_engine()
+
+
+if __name__ == '__main__':
+    logging.config.fileConfig('logging.conf', disable_existing_loggers=False)
+    asyncio.run(main())
@@ -0,0 +1,394 @@
+import os
+import time
+import mmap
+import zlib
+import fcntl
+import shutil
+import logging
+import tempfile
+
+from fastapi import HTTPException, UploadFile
+from starlette.concurrency import run_in_threadpool
+from collections import OrderedDict
+from typing import AsyncIterator, List, NamedTuple, Optional, Tuple
+from dotenv import load_dotenv
+
+from compression import StreamCompressor, new_decompressor
+from hashing import FILE_HASH_ALGORITHM, new_hasher
+from logs import log_step
+from metrics import observe_stage
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = os.environ.get('UPLOAD_FILES_DIR')
+MAX_SIZE_MB = int(os.environ.get('MAX_SIZE_UPLOADED_FILES_MB'))
+CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE_BYTES', 1024 * 1024))
+
+MAX_SIZE_BYTES = MAX_SIZE_MB * 1024 * 1024
+BLOBS_DIR = f'{UPLOAD_DIR}/blobs'
+TMP_DIR = f'{UPLOAD_DIR}/tmp'
+SESSIONS_DIR = f'{UPLOAD_DIR}/sessions'
+PACKS_DIR = f'{UPLOAD_DIR}/packs'
+PACK_MAPS_MAX_OPEN = int(os.environ.get('PACK_MAPS_MAX_OPEN', 64))
+
+
+class StagedFile(NamedTuple):
+    path: str
+    file_size_bytes: int
+    filehash: str
+    filehash_algorithm: str
+    # size of the file on disk, smaller than file_size_bytes when compressed
+    stored_size_bytes: int
+    compression: Optional[str] = None
+    # CRC-32 of the content, what ZIP archives checksum entries with
+    crc32: Optional[int] = None
+
+
+class Location(NamedTuple):
+    """
+    Where the bytes of a stored file live: stored_length bytes of path starting at offset,
+    which hold length bytes of content once decompressed.
+    """
+    path: str
+    offset: int
+    length: int
+    stored_length: int
+    # bytes are a slice of a pack segment rather than a file of their own
+    packed: bool = False
+    compression: Optional[str] = None
+
+
+def blob_path(blob_hash: str, blob_id: int) -> str:
+    """
+    Blobs are fanned out by the first two bytes of their hash. The blob id suffix keeps a blob
+    re-created after deletion from sharing a path with the old one while it is being unlinked.
+    """
+    return f'{BLOBS_DIR}/{blob_hash[:2]}/{blob_hash[2:4]}/{blob_hash}.{blob_id}'
+
+
+def pack_path(pack_id: int) -> str:
+    return f'{PACKS_DIR}/{pack_id:08d}.pack'
+
+
+def locate_blob(blob) -> Location:
+    stored_length = blob.size_bytes if blob.stored_size_bytes is None else blob.stored_size_bytes
+    if blob.pack_id is not None:
+        return Location(path=pack_path(blob.pack_id),
+                        offset=blob.pack_offset,
+                        length=blob.size_bytes,
+                        stored_length=stored_length,
+                        packed=True,
+                        compression=blob.compression)
+    return Location(path=blob_path(blob.hash, blob.id),
+                    offset=0,
+                    length=blob.size_bytes,
+                    stored_length=stored_length,
+                    compression=blob.compression)
+
+
+def locate(db_file) -> Location:
+    if db_file.blob is not None:
+        return locate_blob(db_file.blob)
+    # files uploaded before the blob store live under the owner's directory
+    return Location(path=f'{db_file.file_dir}/{db_file.filename}',
+                    offset=0,
+                    length=db_file.file_size_bytes,
+                    stored_length=db_file.file_size_bytes)
+
+
+def file_too_big_error() -> HTTPException:
+    logger.error(msg=f"File too big, max size is {MAX_SIZE_MB} MB")
+    return HTTPException(
+        status_code=422,
+        detail=f"Your file too big - more than {MAX_SIZE_MB} MB,"
+               f" please, upload files less than {MAX_SIZE_MB} MB"
+    )
+
+
+def check_content_length(content_length: Optional[int]):
+    """Reject a request up front when its declared body is over the size limit."""
+    if content_length is not None and content_length > MAX_SIZE_BYTES:
+        raise file_too_big_error()
+
+
+def validate_filename(filename: str) -> str:
+    if not filename or filename in ('.', '..') or os.path.basename(filename) != filename or '\\' in filename:
+        logger.error(msg=f"Invalid filename '{filename}'")
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid filename"
+        )
+    return filename
+
+
+async def iter_upload_file(upload_file: UploadFile) -> AsyncIterator[bytes]:
+    """Yield the content of an uploaded file in CHUNK_SIZE pieces."""
+    await upload_file.seek(0)
+    while True:
+        chunk = await upload_file.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+async def stage_stream(chunks: AsyncIterator[bytes], file_dir: str = TMP_DIR, compress: bool = False) -> StagedFile:
+    """
+    Write chunks to a temporary file inside file_dir, hashing and counting bytes on the way.
+    Hashing and writing of every chunk run in a worker thread, hashers and zstd release the GIL on large buffers.
+    With compress the file is written zstd compressed unless the first chunk doesn't compress,
+    hash and size are always those of the original content. Time spent reading, hashing, compressing
+    and writing is summed per upload and reported with observe_stage.
+    Stops with 422 as soon as the stream crosses MAX_SIZE_UPLOADED_FILES_MB,
+    the temporary file is removed on any error.
+    """
+    log_step(logger, "Start staging file", level=logging.DEBUG)
+    os.makedirs(file_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=file_dir, prefix='.upload-', suffix='.part')
+    hasher = new_hasher()
+    crc32 = 0
+    compressor = StreamCompressor() if compress else None
+    stages = ('read', 'hash', 'compress', 'write') if compressor else ('read', 'hash', 'write')
+    stage_seconds = dict.fromkeys(stages, 0.0)
+    file_size_bytes = 0
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            def consume(data: bytes):
+                nonlocal crc32
+                started = time.perf_counter()
+                hasher.update(data)
+                crc32 = zlib.crc32(data, crc32)
+                hashed = time.perf_counter()
+                if compressor:
+                    data = compressor.compress(data)
+                compressed = time.perf_counter()
+                tmp_file.write(data)
+                stage_seconds['hash'] += hashed - started
+                if compressor:
+                    stage_seconds['compress'] += compressed - hashed
+                stage_seconds['write'] += time.perf_counter() - compressed
+
+            read_started = time.perf_counter()
+            async for chunk in chunks:
+                stage_seconds['read'] += time.perf_counter() - read_started
+                file_size_bytes += len(chunk)
+                if file_size_bytes > MAX_SIZE_BYTES:
+                    raise file_too_big_error()
+                await run_in_threadpool(consume, chunk)
+                read_started = time.perf_counter()
+            if compressor:
+                tmp_file.write(compressor.flush())
+            stored_size_bytes = tmp_file.tell()
+    except BaseException:
+        discard(tmp_path)
+        raise
+    for stage, seconds in stage_seconds.items():
+        observe_stage(stage, seconds)
+    log_step(logger, "End staging file", level=logging.DEBUG)
+    return StagedFile(path=tmp_path,
+                      file_size_bytes=file_size_bytes,
+                      filehash=hasher.hexdigest(),
+                      filehash_algorithm=FILE_HASH_ALGORITHM,
+                      stored_size_bytes=stored_size_bytes,
+                      compression=compressor.compression if compressor else None,
+                      crc32=crc32)
+
+
+def stage_existing(path: str, file_dir: str = TMP_DIR) -> StagedFile:
+    """
+    Hard link an already stored file into file_dir and hash it, the original stays untouched.
+    Blocking, meant to run in a worker thread.
+    """
+    os.makedirs(file_dir, exist_ok=True)
+    tmp_path = os.path.join(file_dir, f'.migrate-{os.urandom(8).hex()}.part')
+    os.link(path, tmp_path)
+    try:
+        hasher = new_hasher()
+        crc32 = 0
+        file_size_bytes = 0
+        with open(tmp_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                file_size_bytes += len(chunk)
+                hasher.update(chunk)
+                crc32 = zlib.crc32(chunk, crc32)
+    except BaseException:
+        discard(tmp_path)
+        raise
+    return StagedFile(path=tmp_path,
+                      file_size_bytes=file_size_bytes,
+                      filehash=hasher.hexdigest(),
+                      filehash_algorithm=FILE_HASH_ALGORITHM,
+                      stored_size_bytes=file_size_bytes,
+                      crc32=crc32)
+
+
+def commit_staged(staged: StagedFile, path: str):
+    """Atomically move a staged file to its final location."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(staged.path, path)
+
+
+async def iter_location(location: Location) -> AsyncIterator[bytes]:
+    """Yield the content stored at location in pieces, decompressing it if it's stored compressed."""
+    decompressor = new_decompressor(location.compression) if location.compression else None
+
+    def read(fd: int, count: int, offset: int) -> Tuple[bytes, bytes]:
+        data = os.pread(fd, count, offset)
+        if not data:
+            raise RuntimeError(f"File at path {location.path} is shorter than expected")
+        return data, decompressor.decompress(data) if decompressor else data
+
+    with open(location.path, 'rb') as file:
+        offset, remaining = location.offset, location.stored_length
+        while remaining > 0:
+            data, content = await run_in_threadpool(read, file.fileno(), min(CHUNK_SIZE, remaining), offset)
+            offset += len(data)
+            remaining -= len(data)
+            if content:
+                yield content
+
+
+def append_to_pack(path: str, source_path: str) -> int:
+    """
+    Append the content of source_path to the pack segment at path, returns the offset it was written at.
+    The segment is locked for the append, so concurrent appends never interleave.
+    Blocking, meant to run in a worker thread.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'ab') as pack_file, open(source_path, 'rb') as source_file:
+        fcntl.flock(pack_file, fcntl.LOCK_EX)
+        try:
+            offset = pack_file.seek(0, os.SEEK_END)
+            shutil.copyfileobj(source_file, pack_file, CHUNK_SIZE)
+            pack_file.flush()
+        finally:
+            fcntl.flock(pack_file, fcntl.LOCK_UN)
+    return offset
+
+
+def copy_pack_entries(source_path: str, path: str, entries: List[Tuple[int, int]]) -> List[int]:
+    """
+    Copy (offset, length) entries of one pack segment into a new segment at path,
+    returns the offsets of the entries in the new segment. Blocking, meant to run in a worker thread.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    offsets = []
+    with open(source_path, 'rb') as source_file, open(path, 'xb') as pack_file:
+        for offset, length in entries:
+            offsets.append(pack_file.tell())
+            pack_file.write(os.pread(source_file.fileno(), length, offset))
+    return offsets
+
+
+class PackMaps:
+    """
+    Read-only mmaps of pack segments, so reading a packed file is a memory copy instead of open and read calls.
+    The least recently used segments are unmapped beyond maxsize. Not thread-safe, meant for the event loop only.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._maps = OrderedDict()
+
+    def _map(self, path: str) -> mmap.mmap:
+        self.forget(path)
+        with open(path, 'rb') as pack_file:
+            mapped = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps[path] = mapped
+        while len(self._maps) > self.maxsize:
+            self._maps.popitem(last=False)[1].close()
+        return mapped
+
+    def read(self, location: Location, start: int, count: int) -> bytes:
+        """Read count bytes from start of a packed location."""
+        offset = location.offset + start
+        mapped = self._maps.get(location.path)
+        if mapped is None or offset + count > len(mapped):
+            # segments only grow, a mapping made before the entry was appended is too short
+            mapped = self._map(location.path)
+        self._maps.move_to_end(location.path)
+        if offset + count > len(mapped):
+            raise RuntimeError(f"Pack at path {location.path} is shorter than expected")
+        return mapped[offset:offset + count]
+
+    def forget(self, path: str):
+        mapped = self._maps.pop(path, None)
+        if mapped is not None:
+            mapped.close()
+
+    def clear(self):
+        for path in list(self._maps):
+            self.forget(path)
+
+
+pack_maps = PackMaps(maxsize=PACK_MAPS_MAX_OPEN)
+
+
+def discard(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def remove_paths(paths: List[str]):
+    """Remove files and directories, missing ones are skipped. Blocking, meant to run in a worker thread."""
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            discard(path)
+
+
+def session_dir(session_id: str) -> str:
+    return f'{SESSIONS_DIR}/{session_id}'
+
+
+def chunk_path(session_id: str, index: int) -> str:
+    return f'{session_dir(session_id)}/{index:08d}.chunk'
+
+
+async def stage_chunk(chunks: AsyncIterator[bytes], session_id: str, index: int, expected_size: int):
+    """
+    Store one chunk of an upload session. The chunk shows up under its final name only when
+    exactly expected_size bytes were received, so an interrupted request leaves nothing behind.
+    """
+    file_dir = session_dir(session_id)
+    os.makedirs(file_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=file_dir, prefix='.chunk-', suffix='.part')
+    received = 0
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            async for chunk in chunks:
+                received += len(chunk)
+                if received > expected_size:
+                    break
+                await run_in_threadpool(tmp_file.write, chunk)
+        if received != expected_size:
+            logger.error(msg=f"Chunk {index} of session {session_id} has {received} bytes, expected {expected_size}")
+            raise HTTPException(
+                status_code=422,
+                detail=f"Chunk {index} must be exactly {expected_size} bytes"
+            )
+        os.replace(tmp_path, chunk_path(session_id, index))
+    finally:
+        discard(tmp_path)
+
+
+def received_chunks(session_id: str) -> List[int]:
+    try:
+        names = os.listdir(session_dir(session_id))
+    except FileNotFoundError:
+        return []
+    return sorted(int(name[:-len('.chunk')]) for name in names if name.endswith('.chunk'))
+
+
+async def iter_session_chunks(session_id: str, chunks_count: int) -> AsyncIterator[bytes]:
+    """Yield the content of all session chunks in order, in CHUNK_SIZE pieces."""
+    for index in range(chunks_count):
+        with open(chunk_path(session_id, index), 'rb') as chunk_file:
+            while True:
+                chunk = await run_in_threadpool(chunk_file.read, CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
@@ -0,0 +1,132 @@
+import os
+import zlib
+import random
+import asyncio
+import logging
+
+from sqlalchemy import text
+from typing import Awaitable, Callable, List
+from dotenv import load_dotenv
+
+import database
+from crud import DeletionCRUD, UploadSessionCRUD, UserCRUD
+from packs import compact_packs
+from reconcile import StorageReconciler
+from scrub import scrub
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+UPLOAD_SESSION_GC_INTERVAL_SECONDS = int(os.environ.get('UPLOAD_SESSION_GC_INTERVAL_SECONDS', 600))
+PACK_COMPACT_INTERVAL_SECONDS = int(os.environ.get('PACK_COMPACT_INTERVAL_SECONDS', 3600))
+USAGE_RECONCILE_INTERVAL_SECONDS = int(os.environ.get('USAGE_RECONCILE_INTERVAL_SECONDS', 24 * 3600))
+DELETION_INTERVAL_SECONDS = int(os.environ.get('DELETION_INTERVAL_SECONDS', 5))
+STORAGE_RECONCILE_INTERVAL_SECONDS = int(os.environ.get('STORAGE_RECONCILE_INTERVAL_SECONDS', 24 * 3600))
+# 0 leaves scrubbing to "python scrub.py" on a dedicated host
+SCRUB_INTERVAL_SECONDS = int(os.environ.get('SCRUB_INTERVAL_SECONDS', 0))
+
+background_tasks: List[asyncio.Task] = []
+
+
+async def run_exclusively(name: str, job: Callable[[], Awaitable]) -> bool:
+    """
+    Run job unless another worker is already running the job of the same name, which is told by
+    a Postgres advisory lock held for the run. Returns whether the job ran here.
+    """
+    key = zlib.crc32(name.encode())
+    async with database.get_engine().connect() as connection:
+        # the lock belongs to the connection, no transaction has to stay open while the job runs
+        connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+        if not (await connection.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": key})).scalar():
+            logger.debug("Background job '%s' is running in another worker, skipped", name)
+            return False
+        try:
+            await job()
+        finally:
+            await connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": key})
+    return True
+
+
+async def run_periodically(name: str, interval: float, job: Callable[[], Awaitable]):
+    """Run job every interval seconds in one worker at a time, starting at a random point of the first interval."""
+    # workers started together must not all run the full scans at once
+    await asyncio.sleep(random.uniform(0, interval))
+    while True:
+        try:
+            await run_exclusively(name, job)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception(msg=f"Background job '{name}' failed")
+        await asyncio.sleep(interval)
+
+
+async def collect_expired_upload_sessions():
+    async with database.SessionLocal() as db:
+        await UploadSessionCRUD(db).delete_expired()
+
+
+async def compact_stale_packs():
+    async with database.SessionLocal() as db:
+        await compact_packs(db)
+
+
+async def reconcile_usage():
+    async with database.SessionLocal() as db:
+        await UserCRUD(db).reconcile_usage()
+
+
+async def process_pending_deletions():
+    async with database.SessionLocal() as db:
+        await DeletionCRUD(db).process()
+
+
+async def reconcile_storage():
+    async with database.SessionLocal() as db:
+        await StorageReconciler(db).run()
+
+
+async def scrub_stored_files():
+    async with database.SessionLocal() as db:
+        await scrub(db)
+
+
+def start_background_tasks():
+    background_tasks.append(asyncio.create_task(run_periodically(
+        name="collect_expired_upload_sessions",
+        interval=UPLOAD_SESSION_GC_INTERVAL_SECONDS,
+        job=collect_expired_upload_sessions,
+    )))
+    background_tasks.append(asyncio.create_task(run_periodically(
+        name="compact_stale_packs",
+        interval=PACK_COMPACT_INTERVAL_SECONDS,
+        job=compact_stale_packs,
+    )))
+    background_tasks.append(asyncio.create_task(run_periodically(
+        name="reconcile_usage",
+        interval=USAGE_RECONCILE_INTERVAL_SECONDS,
+        job=reconcile_usage,
+    )))
+    background_tasks.append(asyncio.create_task(run_periodically(
+        name="process_pending_deletions",
+        interval=DELETION_INTERVAL_SECONDS,
+        job=process_pending_deletions,
+    )))
+    background_tasks.append(asyncio.create_task(run_periodically(
+        name="reconcile_storage",
+        interval=STORAGE_RECONCILE_INTERVAL_SECONDS,
+        job=reconcile_storage,
+    )))
+    if SCRUB_INTERVAL_SECONDS > 0:
+        background_tasks.append(asyncio.create_task(run_periodically(
+            name="scrub_stored_files",
+            interval=SCRUB_INTERVAL_SECONDS,
+            job=scrub_stored_files,
+        )))
+
+
+async def stop_background_tasks():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
@@ -1,19 +1,23 @@
 import os
+import asyncio
 import shutil
+import hashlib
 import pytest
 
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.event import listens_for
+from sqlalchemy.pool import NullPool
 from passlib.context import CryptContext
 
-from auth import create_token
+from auth import create_token, principal_cache
+from crud import file_cache
 from main import app
 from dependencies import get_db
-from database import Base
+from database import Base, dispose_engine
 from models import User, File
-from routers import hash_file
+from packs import pack_writer
 
 
 TEST_USER_DATA = {
@@ -29,39 +33,43 @@ UPLOAD_DIR = 'media'
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 SQLALCHEMY_DATABASE_URL = f"postgresql://postgres:postgres@db/db"
+ASYNC_SQLALCHEMY_DATABASE_URL = f"postgresql+asyncpg://postgres:postgres@db/db"
 
 engine = create_engine(SQLALCHEMY_DATABASE_URL)
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# TestClient runs every request in its own event loop, so connections can't be pooled between requests
+async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL, poolclass=NullPool)
+TestingAsyncSessionLocal = sessionmaker(bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
 Base.metadata.drop_all(bind=engine)
 Base.metadata.create_all(bind=engine)
+shutil.rmtree(UPLOAD_DIR, ignore_errors=True)
 
 
 @pytest.fixture()
 def session():
-    connection = engine.connect()
-    transaction = connection.begin()
-    session = TestingSessionLocal(bind=connection)
-
-    nested = connection.begin_nested()
-
-    @listens_for(session, "after_transaction_end")
-    def end_savepoint(session, transaction):
-        nonlocal nested
-        if not nested.is_active:
-            nested = connection.begin_nested()
+    session = TestingSessionLocal()
 
     yield session
 
     session.close()
-    transaction.rollback()
-    connection.close()
+    principal_cache.clear()
+    file_cache.clear()
+    # requests run in event loops of their own, connections they left in the app's pool are unusable
+    asyncio.run(dispose_engine())
+    pack_writer.pack_id = None
+    with engine.begin() as connection:
+        for table in reversed(Base.metadata.sorted_tables):
+            connection.execute(table.delete())
+    shutil.rmtree(UPLOAD_DIR, ignore_errors=True)
 
 
 @pytest.fixture()
 def client(session):
-    def override_get_db():
-        yield session
+    async def override_get_db():
+        async with TestingAsyncSessionLocal() as db:
+            yield db
     app.dependency_overrides[get_db] = override_get_db
     yield TestClient(app)
     del app.dependency_overrides[get_db]
@@ -95,8 +103,9 @@ def add_simple_file(add_user, session):
             description=None,
             owner_id=current_user.id,
             content_type='text',
-            file_size_bytes=file.__sizeof__(),
-            filehash=hash_file(file.read())
+            file_size_bytes=os.path.getsize(file.name),
+            # files uploaded before the blob store was introduced are MD5 hashed and kept in the owner's folder
+            filehash=hashlib.md5(file.read()).hexdigest()
         )
 
         if not os.path.exists(UPLOAD_DIR):
@@ -104,8 +113,10 @@ def add_simple_file(add_user, session):
         if not os.path.exists(db_file.file_dir):
             os.mkdir(db_file.file_dir)
         with open(f'{db_file.file_dir}/{db_file.filename}', 'wb') as new_file:
+            file.seek(0)
             shutil.copyfileobj(file, new_file)
 
     session.add(db_file)
     session.commit()
     session.refresh(db_file)
+    return db_file
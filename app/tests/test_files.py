@@ -1,3 +1,34 @@
+import io
+import os
+import json
+import tarfile
+import zipfile
+import asyncio
+import logging
+import pytest
+
+from fastapi import HTTPException
+
+from admission import UploadAdmission, upload_admission
+from auth import SECRET_KEY, create_token
+from cache import ByteBudgetCache
+from compression import zstandard
+from conftest import TestingAsyncSessionLocal, engine
+import crud
+from crud import CONTENT_CACHE_MAX_FILE_KB, DeletionCRUD, FileCRUD, UserCRUD, file_cache, hash_file
+from database import dispose_engine
+import links
+import logs
+from logs import ContextFilter, JsonFormatter, log_step
+from manage import init_db
+from models import Blob, File, Pack, User
+from packs import PACK_THRESHOLD_BYTES, compact_packs, pack_writer
+from reconcile import StorageReconciler
+from schemas import UserRead
+from scrub import scrub
+from storage import BLOBS_DIR, TMP_DIR, blob_path, pack_path
+from tasks import run_exclusively
+
 TEST_USER_DATA = {
     "username": "admin",
     "email": "admin@admin.com",
@@ -9,6 +40,13 @@ TEST_USER_DATA = {
 TEST_FILE_PATH = 'files_to_upload'
 
 
+def process_pending_deletions():
+    async def process():
+        async with TestingAsyncSessionLocal() as db:
+            await DeletionCRUD(db).process()
+    asyncio.run(process())
+
+
 def test_upload_file(add_user, user_token, client):
     with open(f'{TEST_FILE_PATH}/simple_file.txt', 'rb') as file:
         response = client.post("/files/upload",
@@ -35,13 +73,746 @@ def test_upload_same_file(add_user, user_token, add_simple_file, client):
     assert response.json()['detail'] == 'You already have File with same content'
 
 
+def test_put_file(add_user, user_token, client):
+    with open(f'{TEST_FILE_PATH}/simple_file.txt', 'rb') as file:
+        response = client.put("/files/simple_file.txt",
+                              headers={'Authorization': f'Bearer {user_token}',
+                                       'Content-Type': 'text/plain',
+                                       'X-File-Description': 'simple file'},
+                              data=file.read())
+    assert response.status_code == 200
+    assert response.json()['filename'] == 'simple_file.txt'
+    assert response.json()['description'] == 'simple file'
+
+
+def test_put_file_releases_connection_while_receiving(add_user, session):
+    user = UserRead.from_orm(session.query(User).one())
+
+    async def chunks(db):
+        assert not db.in_transaction()
+        yield b'streamed content'
+
+    async def put():
+        async with TestingAsyncSessionLocal() as db:
+            await UserCRUD(db).read_by_username(username=user.username)
+            assert db.in_transaction()
+            return await FileCRUD(db).create_from_stream(chunks=chunks(db),
+                                                         filename='streamed.txt',
+                                                         content_type='text/plain',
+                                                         description=None,
+                                                         current_user=user)
+    assert asyncio.run(put()).filename == 'streamed.txt'
+
+
+def test_upload_and_download_file(add_user, user_token, client):
+    headers = {'Authorization': f'Bearer {user_token}'}
+    file_id = client.put("/files/stored.txt", headers=headers, data=b'stored content').json()['id']
+
+    response = client.get(f"/files/{file_id}/content", headers=headers)
+    assert response.status_code == 200
+    assert response.content == b'stored content'
+
+
+@pytest.mark.skipif(zstandard is None, reason="zstandard isn't installed")
+def test_compressed_file(add_user, user_token, session, client):
+    headers = {'Authorization': f'Bearer {user_token}'}
+    content = b''.join(b'%d,line of a csv file\n' % number for number in range(10000))
+    file_id = client.put("/files/data.csv", headers={**headers, 'Content-Type': 'text/csv'}, data=content).json()['id']
+
+    blob = session.query(Blob).one()
+    assert blob.compression == 'zstd'
+    assert blob.size_bytes == len(content)
+    assert blob.stored_size_bytes < len(content) // 5
+
+    response = client.get(f"/files/{file_id}/content", headers=headers)
+    assert response.content == content
+    assert 'content-encoding' not in response.headers
+    response = client.get(f"/files/{file_id}/content", headers={**headers, 'Range': 'bytes=100-199'})
+    assert response.status_code == 206
+    assert response.content == content[100:200]
+    response = client.get(f"/files/{file_id}/content", headers={**headers, 'Accept-Encoding': 'zstd'})
+    assert response.headers['content-encoding'] == 'zstd'
+    assert int(response.headers['content-length']) == blob.stored_size_bytes
+    assert zstandard.ZstdDecompressor().decompressobj().decompress(response.content) == content
+
+
+def test_same_content_of_different_users_stored_once(add_user, user_token, session, client):
+    session.add(User(username='other', email='other@other.com', hashed_password='-'))
+    session.commit()
+    other_headers = {'Authorization': f'Bearer {create_token("other")["access_token"]}'}
+    headers = {'Authorization': f'Bearer {user_token}'}
+    content = b'shared content'.ljust(PACK_THRESHOLD_BYTES + 1, b'.')
+    file_id = client.put("/files/shared.txt", headers=headers, data=content).json()['id']
+    other_file_id = client.put("/files/shared.txt", headers=other_headers, data=content).json()['id']
+
+    blob = session.query(Blob).one()
+    assert blob.refcount == 2
+    stored_path = blob_path(blob.hash, blob.id)
+
+    client.delete(f"/files/{file_id}", headers=headers)
+    process_pending_deletions()
+    assert os.path.exists(stored_path)
+    client.delete(f"/files/{other_file_id}", headers=other_headers)
+    assert os.path.exists(stored_path)
+    process_pending_deletions()
+    assert not os.path.exists(stored_path)
+    assert session.query(Blob).count() == 0
+
+
+def test_small_files_packed_and_compacted(add_user, user_token, session, client):
+    headers = {'Authorization': f'Bearer {user_token}'}
+    kept_id = client.put("/files/kept.txt", headers=headers, data=b'kept content').json()['id']
+    deleted_id = client.put("/files/deleted.txt", headers=headers, data=b'deleted content').json()['id']
+
+    blob = session.query(Blob).filter(Blob.size_bytes == len(b'kept content')).one()
+    assert blob.pack_id is not None
+    assert not os.path.exists(blob_path(blob.hash, blob.id))
+    old_pack_id = blob.pack_id
+    response = client.get(f"/files/{kept_id}/content", headers={**headers, 'Range': 'bytes=5-'})
+    assert response.content == b'content'
+
+    client.delete(f"/files/{deleted_id}", headers=headers)
+    assert os.path.exists(pack_path(old_pack_id))
+
+    async def compact():
+        async with TestingAsyncSessionLocal() as db:
+            await compact_packs(db, min_age_seconds=0)
+    pack_writer.pack_id = None
+    asyncio.run(compact())
+
+    session.expire_all()
+    blob = session.query(Blob).one()
+    assert blob.pack_id != old_pack_id
+    assert session.query(Pack).one().id == blob.pack_id
+    process_pending_deletions()
+    assert not os.path.exists(pack_path(old_pack_id))
+    assert os.path.getsize(pack_path(blob.pack_id)) == len(b'kept content')
+    response = client.get(f"/files/{kept_id}/content", headers=headers)
+    assert response.content == b'kept content'
+
+
+def test_reconcile_storage(add_user, user_token, add_simple_file, client):
+    headers = {'Authorization': f'Bearer {user_token}'}
+    client.put("/files/kept.txt", headers=headers, data=b'kept content'.ljust(PACK_THRESHOLD_BYTES + 1, b'.'))
+    orphan_paths = [f'{BLOBS_DIR}/00/00/{"0" * 64}.999999', f'{TMP_DIR}/.upload-orphan.part']
+    for path in orphan_paths:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(b'orphan')
+    os.remove(f'{add_simple_file.file_dir}/{add_simple_file.filename}')
+
+    async def reconcile():
+        async with TestingAsyncSessionLocal() as db:
+            return await StorageReconciler(db, fix=True, grace_seconds=0).run()
+    report = asyncio.run(reconcile())
+    assert report == {'blob_files': 1, 'tmp_files': 1, 'queued_for_deletion': 2, 'files': 1}
+
+    process_pending_deletions()
+    assert not any(os.path.exists(path) for path in orphan_paths)
+    assert asyncio.run(reconcile()) == {'files': 1}
+
+
+def test_export(add_user, user_token, add_simple_file, client):
+    headers = {'Authorization': f'Bearer {user_token}'}
+    with open(f'{TEST_FILE_PATH}/simple_file.txt', 'rb') as file:
+        legacy_content = file.read()
+    large_content = os.urandom(PACK_THRESHOLD_BYTES + 1)
+    contents = {
+        add_simple_file.filename: legacy_content,
+        'packed.txt': b'packed content',
+        'large.bin': large_content,
+    }
+    packed_id = client.put("/files/packed.txt", headers=headers, data=b'packed content').json()['id']
+    client.put("/files/large.bin", headers=headers, data=large_content)
+    # the same name again
+    duplicate_id = client.put("/files/packed.txt", headers=headers, data=b'other content').json()['id']
+    contents[f'{duplicate_id}-packed.txt'] = b'other content'
+
+    response = client.get("/files/export", headers=headers)
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/zip'
+    with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+        assert archive.testzip() is None
+        assert {name: archive.read(name) for name in archive.namelist()} == contents
+
+    response = client.get("/files/export", headers=headers, params={'format': 'tar'})
+    assert response.status_code == 200
+    with tarfile.open(fileobj=io.BytesIO(response.content)) as archive:
+        assert {member.name: archive.extractfile(member).read() for member in archive.getmembers()} == contents
+
+    response = client.get("/files/export", headers=headers, params={'ids': [packed_id, duplicate_id]})
+    with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+        assert archive.namelist() == ['packed.txt', f'{duplicate_id}-packed.txt']
+
+    response = client.get("/files/export", headers=headers, params={'ids': [packed_id, 999999]})
+    assert response.status_code == 404
+
+
+def test_download_link(add_user, user_token, add_simple_file, client):
+    headers = {'Authorization': f'Bearer {user_token}'}
+    content = b'linked content'
+    file_id = client.put("/files/linked.txt", headers=headers, data=content).json()['id']
+
+    response = client.post(f"/files/{file_id}/link", headers=headers, params={'ttl_seconds': 60})
+    assert response.status_code == 200
+    url = response.json()['url']
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.content == content
+    assert client.get(url, headers={'Range': 'bytes=0-5'}).content == content[:6]
+    legacy_url = client.post(f"/files/{add_simple_file.id}/link", headers=headers).json()['url']
+    with open(f'{add_simple_file.file_dir}/{add_simple_file.filename}', 'rb') as file:
+        assert client.get(legacy_url).content == file.read()
+
+    payload, _, signature = url.rpartition('/')[2].partition('.')
+    tampered = f"{payload[:-2]}{'A' if payload[-2] != 'A' else 'B'}{payload[-1]}.{signature}"
+    assert client.get(f"/links/{tampered}").status_code == 404
+    assert client.get("/links/garbage").status_code == 404
+    assert client.get(f"/links/{payload}.{signature[:-1]}\u00e9").status_code == 404
+    assert client.get("/links/\u00e9t\u00e9.\u00e9t\u00e9").status_code == 404
+
+    assert client.delete(f"/files/{file_id}/link", headers=headers).status_code == 200
+    assert client.get(url).status_code == 404
+    new_url = client.post(f"/files/{file_id}/link", headers=headers).json()['url']
+    assert client.get(new_url).status_code == 200
+
+    client.delete(f"/files/{file_id}", headers=headers)
+    assert client.get(new_url).status_code == 404
+    assert client.post(f"/files/{file_id}/link", headers=headers).status_code == 404
+
+
+def test_download_cached_content(add_user, user_token, session, client):
+    headers = {'Authorization': f'Bearer {user_token}'}
+    content = b'hot content'
+    file_id = client.put("/files/hot.txt", headers=headers, data=content).json()['id']
+    large_content = b'cold content'.ljust(CONTENT_CACHE_MAX_FILE_KB * 1024 + 1, b'.')
+    large_file_id = client.put("/files/cold.txt", headers=headers, data=large_content).json()['id']
+
+    response = client.get(f"/files/{file_id}/content", headers=headers)
+    assert response.content == content
+    hits = file_cache.hits
+    response = client.get(f"/files/{file_id}/content", headers=headers)
+    assert (response.status_code, response.content) == (200, content)
+    assert file_cache.hits == hits + 1
+    assert response.headers['content-disposition'] == 'attachment; filename="hot.txt"'
+    response = client.get(f"/files/{file_id}/content", headers={**headers, 'Range': 'bytes=4-'})
+    assert (response.status_code, response.content) == (206, content[4:])
+    response = client.get(f"/files/{file_id}/content", headers={**headers, 'Range': 'bytes=0-2,4-6'})
+    assert response.status_code == 206
+    assert b'hot' in response.content and b'con' in response.content
+    etag = response.headers['etag']
+    assert client.get(f"/files/{file_id}/content", headers={**headers, 'If-None-Match': etag}).status_code == 304
+    assert file_cache.hits == hits + 4
+
+    misses, bypasses = file_cache.misses, file_cache.bypasses
+    assert client.get(f"/files/{large_file_id}/content", headers=headers).content == large_content
+    assert (file_cache.misses, file_cache.bypasses) == (misses, bypasses + 1)
+    assert len(file_cache) == 1
+    session.add(User(username='other', email='other@other.com', hashed_password='-'))
+    session.commit()
+    other_headers = {'Authorization': f'Bearer {create_token("other")["access_token"]}'}
+    assert client.get(f"/files/{file_id}/content", headers=other_headers).status_code == 404
+
+    client.delete(f"/files/{file_id}", headers=headers)
+    assert len(file_cache) == 0
+    assert client.get(f"/files/{file_id}/content", headers=headers).status_code == 404
+
+
+def test_cached_content_of_file_deleted_by_another_worker(add_user, user_token, client, monkeypatch):
+    headers = {'Authorization': f'Bearer {user_token}'}
+    file_id = client.put("/files/hot.txt", headers=headers, data=b'hot content').json()['id']
+    assert client.get(f"/files/{file_id}/content", headers=headers).content == b'hot content'
+    assert len(file_cache) == 1
+
+    # the delete is handled by a worker with a cache of its own
+    monkeypatch.setattr(crud, 'file_cache', ByteBudgetCache(max_bytes=1024 * 1024, max_item_bytes=1024))
+    assert client.delete(f"/files/{file_id}", headers=headers).status_code == 200
+    monkeypatch.undo()
+
+    assert len(file_cache) == 1
+    hits = file_cache.hits
+    assert client.get(f"/files/{file_id}/content", headers=headers).status_code == 404
+    assert file_cache.hits == hits
+
+
+def test_background_job_runs_in_one_worker_at_a_time():
+    async def run():
+        started, release = asyncio.Event(), asyncio.Event()
+
+        async def slow_job():
+            started.set()
+            await release.wait()
+        first = asyncio.create_task(run_exclusively('test_job', slow_job))
+        await started.wait()
+        ran_concurrently = await run_exclusively('test_job', slow_job)
+        release.set()
+        ran = await first
+        ran_after = await run_exclusively('test_job', release.wait)
+        await dispose_engine()
+        return ran, ran_concurrently, ran_after
+    assert asyncio.run(run()) == (True, False, True)
+
+
+def test_deny_list_drops_expired_revocations(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(links.time, 'time', lambda: now[0])
+    revocations = links.DenyList()
+    revocations.revoke(1)
+    revocations.revoke(2)
+    now[0] += links.LINK_MAX_TTL_SECONDS / 2
+    revocations.revoke(1)
+    now[0] += links.LINK_MAX_TTL_SECONDS / 2 + 1
+    revocations.revoke(3)
+    assert len(revocations) == 2
+    assert revocations.is_revoked(1, issued_at=now[0] - links.LINK_MAX_TTL_SECONDS)
+    assert not revocations.is_revoked(2, issued_at=0)
+
+
+def test_link_key_is_not_the_token_key():
+    assert links.LINK_SECRET_KEY != SECRET_KEY.encode()
+    # RFC 5869 test case 3, the first 32 bytes of its output
+    assert links.derive_key(b'\x0b' * 22, b'') == bytes.fromhex(
+        '8da4e775a563c18f715f802a063c5a31b8a11f5c5ee1879ec3454e5f3c738d2d'
+    )
+
+
+def test_scrub(add_user, user_token, add_simple_file, session, client):
+    headers = {'Authorization': f'Bearer {user_token}'}
+    content = b'scrubbed content'.ljust(PACK_THRESHOLD_BYTES + 1, b'.')
+    file_id = client.put("/files/scrubbed.txt", headers=headers, data=content).json()['id']
+    client.put("/files/packed.txt", headers=headers, data=b'packed content')
+
+    async def run_scrub():
+        async with TestingAsyncSessionLocal() as db:
+            return await scrub(db, workers=2, rate_mb_per_second=0)
+    assert asyncio.run(run_scrub())['failed'] == 0
+    assert client.get("/files/integrity", headers=headers).json() == []
+
+    blob = session.query(Blob).filter(Blob.size_bytes == len(content)).one()
+    with open(blob_path(blob.hash, blob.id), 'r+b') as stored_file:
+        stored_file.write(b'S')
+    report = asyncio.run(run_scrub())
+    assert (report['checked'], report['failed']) == (3, 1)
+    failures = client.get("/files/integrity", headers=headers).json()
+    assert [failure['file']['id'] for failure in failures] == [file_id]
+    assert failures[0]['error'].startswith('hash is')
+
+    with open(blob_path(blob.hash, blob.id), 'r+b') as stored_file:
+        stored_file.write(b's')
+    asyncio.run(run_scrub())
+    assert client.get("/files/integrity", headers=headers).json() == []
+
+
+def test_metrics(add_user, user_token, client):
+    client.put("/files/measured.txt", headers={'Authorization': f'Bearer {user_token}'}, data=b'measured content')
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain; version=0.0.4')
+    assert 'http_requests_total{route="put_file",method="PUT",status="200"}' in response.text
+    assert 'http_request_bytes_total{route="put_file"}' in response.text
+    for stage in ('read', 'hash', 'write', 'dedup_query', 'store', 'commit'):
+        assert f'upload_stage_duration_seconds_count{{stage="{stage}"}}' in response.text
+    assert 'auth_cache_misses_total' in response.text
+
+
+def test_upload_admission_queues_and_rejects():
+    async def scenario():
+        admission = UploadAdmission(max_concurrent=2, max_bytes=100, user_max_concurrent=1, user_max_bytes=100,
+                                    queue_limit=2, queue_timeout=0.1)
+        await admission.acquire('alice', 10)
+        # over alice's own limit, times out with 429
+        with pytest.raises(HTTPException) as error:
+            await admission.acquire('alice', 10)
+        assert error.value.status_code == 429
+        assert error.value.headers['Retry-After']
+
+        await admission.acquire('bob', 10)
+        # the global limit is reached, carol waits until bob is done
+        carol = asyncio.create_task(admission.acquire('carol', 10))
+        await asyncio.sleep(0)
+        assert len(admission.queue) == 1
+        admission.release('bob', 10)
+        await carol
+        assert admission.in_flight == 2 and not admission.queue
+
+        # waiting longer than the timeout for the global limit is a 503
+        with pytest.raises(HTTPException) as error:
+            await admission.acquire('dave', 10)
+        assert error.value.status_code == 503
+
+        # a full queue rejects right away
+        admission.queue_limit = 0
+        with pytest.raises(HTTPException) as error:
+            await admission.acquire('dave', 10)
+        assert error.value.status_code == 503
+        assert admission.rejected == 3
+
+        admission.release('alice', 10)
+        admission.release('carol', 10)
+        assert admission.in_flight == 0 and admission.in_flight_bytes == 0 and not admission.users
+
+    asyncio.run(scenario())
+
+
+def test_upload_rejected_when_saturated(add_user, user_token, client):
+    queue_limit, in_flight = upload_admission.queue_limit, upload_admission.in_flight
+    upload_admission.queue_limit, upload_admission.in_flight = 0, upload_admission.max_concurrent
+    try:
+        response = client.put("/files/busy.txt", headers={'Authorization': f'Bearer {user_token}'}, data=b'busy')
+    finally:
+        upload_admission.queue_limit, upload_admission.in_flight = queue_limit, in_flight
+    assert response.status_code == 503
+    assert response.headers['retry-after']
+
+    response = client.put("/files/busy.txt", headers={'Authorization': f'Bearer {user_token}'}, data=b'busy')
+    assert response.status_code == 200
+    assert upload_admission.in_flight == 0 and not upload_admission.users
+
+
+def test_health(client):
+    assert client.get("/health/live").json() == {"status": "alive"}
+    response = client.get("/health/ready")
+    assert response.status_code == 200
+    assert response.json() == {"status": "ready"}
+
+
+def test_init_db_upgrades_existing_tables(add_user, user_token, add_simple_file, session, client):
+    client.put("/files/stored.txt", headers={'Authorization': f'Bearer {user_token}'}, data=b'stored content')
+    # the schema can't be altered while the fixtures' transaction holds locks on the tables
+    session.commit()
+    with engine.begin() as connection:
+        # as left by a version from before usage counters, blob crc32 and owner indexes
+        connection.execute("ALTER TABLE users DROP COLUMN used_bytes, DROP COLUMN files_count, DROP COLUMN quota_files")
+        connection.execute("ALTER TABLE blobs DROP COLUMN crc32")
+        connection.execute("ALTER TABLE files ALTER COLUMN file_size_bytes TYPE INTEGER")
+        connection.execute("DROP INDEX ix_files_owner_id_filename")
+
+    asyncio.run(init_db())
+    asyncio.run(init_db())
+
+    session.expire_all()
+    user = session.query(User).one()
+    assert (user.used_bytes, user.files_count, user.quota_files) == (
+        sum(db_file.file_size_bytes for db_file in session.query(File)), 2, None
+    )
+    assert session.query(Blob).one().crc32 is None
+    with engine.connect() as connection:
+        assert connection.execute(
+            "SELECT data_type FROM information_schema.columns"
+            " WHERE table_name = 'files' AND column_name = 'file_size_bytes'"
+        ).scalar() == 'bigint'
+        assert connection.execute("SELECT to_regclass('ix_files_owner_id_filename')").scalar() is not None
+    assert client.get("/files/", headers={'Authorization': f'Bearer {user_token}'}).status_code == 200
+
+
+def test_request_log_summary(add_user, user_token, client, caplog):
+    caplog.set_level(logging.INFO)
+    response = client.put("/files/logged.txt",
+                          headers={'Authorization': f'Bearer {user_token}', 'X-Request-ID': 'upload-1'},
+                          data=b'logged content')
+    assert response.status_code == 200
+    assert response.headers['x-request-id'] == 'upload-1'
+
+    summaries = [record for record in caplog.records if getattr(record, 'summary', False)]
+    assert len(summaries) == 1
+    context = summaries[0].context
+    assert context['request_id'] == 'upload-1'
+    assert context['route'] == 'put_file'
+    assert context['status'] == 200
+    assert context['user_id'] == response.json()['owner_id']
+    assert context['file_id'] == response.json()['id']
+    assert {'read', 'hash', 'write', 'dedup_query', 'store', 'commit'} <= set(context['stages'])
+
+    entry = json.loads(JsonFormatter().format(summaries[0]))
+    assert entry['request_id'] == 'upload-1'
+    assert entry['message'].startswith('PUT /files/logged.txt 200')
+
+    response = client.get("/users/logined_user", headers={'Authorization': f'Bearer {user_token}'})
+    assert response.headers['x-request-id'] != 'upload-1'
+
+
+def test_context_filter_drops_start_end_records_of_requests():
+    context_filter = ContextFilter()
+
+    def record(msg, level=logging.INFO):
+        return logging.LogRecord('test', level, __file__, 1, msg, None, None)
+
+    assert context_filter.filter(record("Start saving file"))
+    token = logs.log_context.set({'request_id': 'test'})
+    try:
+        assert not context_filter.filter(record("Start saving file"))
+        assert not context_filter.filter(record("End saving file"))
+        assert context_filter.filter(record("End saving file", logging.ERROR))
+        kept = record("Blob stored")
+        assert context_filter.filter(kept)
+        assert kept.context == {'request_id': 'test'}
+    finally:
+        logs.log_context.reset(token)
+
+
+def test_log_step_skips_records_of_requests():
+    records = []
+    step_logger = logging.getLogger('test_log_step')
+    step_logger.setLevel(logging.INFO)
+    handler = logging.Handler()
+    handler.emit = records.append
+    step_logger.addHandler(handler)
+    try:
+        log_step(step_logger, "Start saving %s files", 2)
+        log_step(step_logger, "Start staging file", level=logging.DEBUG)
+        token = logs.log_context.set({'request_id': 'test'})
+        try:
+            log_step(step_logger, "End saving %s files", 2)
+        finally:
+            logs.log_context.reset(token)
+    finally:
+        step_logger.removeHandler(handler)
+    assert [record.getMessage() for record in records] == ["Start saving 2 files"]
+    assert records[0].funcName == 'test_log_step_skips_records_of_requests'
+
+
+def test_preflight(add_user, user_token, add_simple_file, session, client):
+    session.add(User(username='other', email='other@other.com', hashed_password='-'))
+    session.commit()
+    other_headers = {'Authorization': f'Bearer {create_token("other")["access_token"]}'}
+    headers = {'Authorization': f'Bearer {user_token}'}
+    content = b'content to link'
+    preflight = {'hash': hash_file(content), 'size': len(content), 'filename': 'linked.txt'}
+
+    response = client.post("/files/preflight", headers=headers, json=preflight)
+    assert response.json()['status'] == 'upload'
+
+    client.put("/files/linked.txt", headers=headers, data=content)
+    response = client.post("/files/preflight", headers=headers, json=preflight)
+    assert response.json()['status'] == 'exists'
+
+    response = client.post("/files/preflight", headers=other_headers, json=preflight)
+    assert response.json()['status'] == 'linked'
+    linked_file_id = response.json()['file']['id']
+    response = client.get(f"/files/{linked_file_id}/content", headers=other_headers)
+    assert response.content == content
+    assert session.query(Blob).one().refcount == 2
+
+
+def test_chunked_upload(add_user, user_token, client):
+    headers = {'Authorization': f'Bearer {user_token}'}
+    chunk_size = 256 * 1024
+    content = os.urandom(chunk_size * 2 + 1000)
+    response = client.post("/files/uploads", headers=headers, json={'filename': 'big.bin',
+                                                                     'file_size_bytes': len(content),
+                                                                     'filehash': hash_file(content),
+                                                                     'chunk_size_bytes': chunk_size})
+    assert response.status_code == 201
+    session_id = response.json()['id']
+    assert response.json()['chunks_count'] == 3
+
+    for index in (2, 0):
+        response = client.put(f"/files/uploads/{session_id}/chunks/{index}",
+                              headers=headers,
+                              data=content[index * chunk_size:(index + 1) * chunk_size])
+        assert response.status_code == 204
+
+    assert client.get(f"/files/uploads/{session_id}", headers=headers).json()['received_chunks'] == [0, 2]
+    assert client.post(f"/files/uploads/{session_id}/commit", headers=headers).status_code == 409
+
+    client.put(f"/files/uploads/{session_id}/chunks/1", headers=headers, data=content[chunk_size:chunk_size * 2])
+    response = client.post(f"/files/uploads/{session_id}/commit", headers=headers)
+    assert response.status_code == 200
+    file_id = response.json()['id']
+
+    assert client.get(f"/files/{file_id}/content", headers=headers).content == content
+    assert client.get(f"/files/uploads/{session_id}", headers=headers).status_code == 404
+
+
+def test_chunked_upload_wrong_hash(add_user, user_token, client):
+    headers = {'Authorization': f'Bearer {user_token}'}
+    response = client.post("/files/uploads", headers=headers, json={'filename': 'small.txt',
+                                                                     'file_size_bytes': 7,
+                                                                     'filehash': hash_file(b'other')})
+    session_id = response.json()['id']
+    assert client.put(f"/files/uploads/{session_id}/chunks/0", headers=headers, data=b'too long').status_code == 422
+    client.put(f"/files/uploads/{session_id}/chunks/0", headers=headers, data=b'content')
+    response = client.post(f"/files/uploads/{session_id}/commit", headers=headers)
+    assert response.status_code == 422
+
+
+def test_upload_files_batch(add_user, user_token, add_simple_file, client):
+    headers = {'Authorization': f'Bearer {user_token}'}
+    response = client.post("/files/batch",
+                           headers=headers,
+                           files=[('files', ('first.txt', b'first content')),
+                                  ('files', ('second.txt', b'second content')),
+                                  ('files', ('second_copy.txt', b'second content')),
+                                  ('files', ('simple_file.txt', b'simple file to upload'))])
+    assert response.status_code == 200
+    assert [item['status_code'] for item in response.json()] == [201, 201, 400, 400]
+
+    file_id = response.json()[1]['id']
+    assert client.get(f"/files/{file_id}/content", headers=headers).content == b'second content'
+
+
+def test_delete_files_batch(add_user, user_token, add_simple_file, client):
+    headers = {'Authorization': f'Bearer {user_token}'}
+    file_id = client.put("/files/other.txt", headers=headers, data=b'other content').json()['id']
+
+    response = client.delete("/files/batch", headers=headers, json={'ids': [add_simple_file.id, file_id, -1]})
+    assert response.status_code == 200
+    assert [item['status_code'] for item in response.json()] == [200, 200, 404]
+    assert client.get("/files/", headers=headers).json()['items'] == []
+
+
+def test_quota(add_user, user_token, session, client):
+    user = session.query(User).one()
+    user.quota_files = 2
+    session.commit()
+    headers = {'Authorization': f'Bearer {user_token}'}
+    file_id = client.put("/files/first.txt", headers=headers, data=b'first').json()['id']
+    response = client.post("/files/batch", headers=headers, files=[
+        ('files', ('second.txt', b'second')),
+        ('files', ('third.txt', b'third')),
+    ])
+    assert [item['status_code'] for item in response.json()] == [201, 413]
+    response = client.put("/files/third.txt", headers=headers, data=b'third')
+    assert response.status_code == 413
+
+    client.delete(f"/files/{file_id}", headers=headers)
+    response = client.put("/files/third.txt", headers=headers, data=b'third')
+    assert response.status_code == 200
+    session.refresh(user)
+    assert (user.used_bytes, user.files_count) == (len(b'second') + len(b'third'), 2)
+
+
+def test_put_file_invalid_filename(add_user, user_token, client):
+    response = client.put("/files/..%5Csecret.txt",
+                          headers={'Authorization': f'Bearer {user_token}'},
+                          data=b'content')
+    assert response.status_code == 400
+
+
+def test_upload_same_file_migrates_legacy_file(add_user, user_token, add_simple_file, session, client):
+    legacy_path = f'{add_simple_file.file_dir}/{add_simple_file.filename}'
+    with open(f'{TEST_FILE_PATH}/simple_file_copy.txt', 'rb') as file:
+        client.put("/files/simple_file_copy.txt", headers={'Authorization': f'Bearer {user_token}'}, data=file.read())
+
+    session.refresh(add_simple_file)
+    assert add_simple_file.filehash_algorithm == 'sha256'
+    assert add_simple_file.filehash == hash_file(b'simple file to upload')
+    assert add_simple_file.blob_id is not None
+    process_pending_deletions()
+    assert not os.path.exists(legacy_path)
+
+    response = client.get(f"/files/{add_simple_file.id}/content", headers={'Authorization': f'Bearer {user_token}'})
+    assert response.content == b'simple file to upload'
+
+
+def test_upload_same_size_as_missing_legacy_file(add_user, user_token, add_simple_file, session, client):
+    os.remove(f'{add_simple_file.file_dir}/{add_simple_file.filename}')
+    content = b'x' * add_simple_file.file_size_bytes
+    response = client.put("/files/same_size.txt", headers={'Authorization': f'Bearer {user_token}'}, data=content)
+    assert response.status_code == 200
+    session.refresh(add_simple_file)
+    assert add_simple_file.blob_id is None
+
+
+def test_legacy_file_locked_by_concurrent_upload_is_skipped(add_user, add_simple_file, session):
+    session.commit()
+    with engine.begin() as connection:
+        connection.execute(f"SELECT id FROM files WHERE id = {add_simple_file.id} FOR UPDATE")
+
+        async def migrate():
+            async with TestingAsyncSessionLocal() as db:
+                await FileCRUD(db).migrate_legacy_files(owner_id=add_simple_file.owner_id,
+                                                        file_sizes=[add_simple_file.file_size_bytes])
+        asyncio.run(migrate())
+    session.refresh(add_simple_file)
+    assert add_simple_file.blob_id is None
+
+
 def test_get_user_files(add_user, user_token, add_simple_file, client):
     response = client.get("/files/", headers={'Authorization': f'Bearer {user_token}'})
     assert response.status_code == 200
-    assert 'simple_file.txt' in response.json()
+    assert [file['filename'] for file in response.json()['items']] == ['simple_file.txt']
+    assert response.json()['next_cursor'] is None
+
+
+def test_get_user_files_pages(add_user, user_token, client):
+    headers = {'Authorization': f'Bearer {user_token}'}
+    for number in range(3):
+        client.put(f"/files/file_{number}.txt", headers=headers, data=f'content {number}'.encode())
+
+    response = client.get("/files/", headers=headers, params={'limit': 2})
+    assert [file['filename'] for file in response.json()['items']] == ['file_0.txt', 'file_1.txt']
+    next_cursor = response.json()['next_cursor']
+
+    response = client.get("/files/", headers=headers, params={'limit': 2, 'cursor': next_cursor})
+    assert [file['filename'] for file in response.json()['items']] == ['file_2.txt']
+    assert response.json()['next_cursor'] is None
+
+
+def test_get_user_files_filters(add_user, user_token, add_simple_file, client):
+    headers = {'Authorization': f'Bearer {user_token}'}
+    client.put("/files/other.bin", headers=headers, data=b'binary content')
+
+    response = client.get("/files/", headers=headers, params={'name_prefix': 'simple', 'order': 'desc'})
+    assert [file['filename'] for file in response.json()['items']] == ['simple_file.txt']
+
+    response = client.get("/files/", headers=headers, params={'content_type': 'application/octet-stream'})
+    assert [file['filename'] for file in response.json()['items']] == ['other.bin']
+
+
+def test_download_file(add_user, user_token, add_simple_file, client):
+    response = client.get(f"/files/{add_simple_file.id}/content", headers={'Authorization': f'Bearer {user_token}'})
+    assert response.status_code == 200
+    assert response.content == b'simple file to upload'
+    assert response.headers['etag'] == f'"{add_simple_file.filehash}"'
+
+
+def test_download_file_not_modified(add_user, user_token, add_simple_file, client):
+    response = client.get(f"/files/{add_simple_file.id}/content",
+                          headers={'Authorization': f'Bearer {user_token}',
+                                   'If-None-Match': f'"{add_simple_file.filehash}"'})
+    assert response.status_code == 304
+
+
+def test_download_file_range(add_user, user_token, add_simple_file, client):
+    response = client.get(f"/files/{add_simple_file.id}/content",
+                          headers={'Authorization': f'Bearer {user_token}', 'Range': 'bytes=0-5'})
+    assert response.status_code == 206
+    assert response.content == b'simple'
+    assert response.headers['content-range'] == 'bytes 0-5/21'
+
+
+def test_download_file_multi_range(add_user, user_token, add_simple_file, client):
+    response = client.get(f"/files/{add_simple_file.id}/content",
+                          headers={'Authorization': f'Bearer {user_token}', 'Range': 'bytes=0-5,-6'})
+    assert response.status_code == 206
+    assert response.headers['content-type'].startswith('multipart/byteranges')
+    assert b'Content-Range: bytes 0-5/21' in response.content
+    assert b'Content-Range: bytes 15-20/21' in response.content
+    assert b'upload' in response.content
+
+
+def test_download_file_range_not_satisfiable(add_user, user_token, add_simple_file, client):
+    response = client.get(f"/files/{add_simple_file.id}/content",
+                          headers={'Authorization': f'Bearer {user_token}', 'Range': 'bytes=100-'})
+    assert response.status_code == 416
+
+
+def test_download_file_malformed_or_excessive_range(add_user, user_token, add_simple_file, client):
+    headers = {'Authorization': f'Bearer {user_token}'}
+    for range_header in ('bytes=--5', 'bytes=-+5', 'bytes=-', 'bytes=0--1', 'bytes=' + ','.join(['0-0'] * 101)):
+        response = client.get(f"/files/{add_simple_file.id}/content", headers={**headers, 'Range': range_header})
+        assert response.status_code == 200
+        assert int(response.headers['content-length']) == add_simple_file.file_size_bytes
+    many_ranges = 'bytes=' + ','.join(f'{offset}-{offset}' for offset in range(6))
+    response = client.get(f"/files/{add_simple_file.id}/content", headers={**headers, 'Range': many_ranges})
+    assert response.status_code == 206
+    assert response.headers['content-range'] == 'bytes 0-5/21'
+    assert response.content == b'simple'
 
 
 def test_delete_file(add_user, user_token, add_simple_file, client):
-    response = client.delete(f"/files/simple_file.txt", headers={'Authorization': f'Bearer {user_token}'})
+    response = client.delete(f"/files/{add_simple_file.id}", headers={'Authorization': f'Bearer {user_token}'})
     assert response.status_code == 200
     assert 'successfully deleted' in response.json()
@@ -1,3 +1,13 @@
+import asyncio
+
+from passlib.context import CryptContext
+
+from auth import principal_cache
+from cache import TTLCache
+from conftest import TestingAsyncSessionLocal
+from crud import UserCRUD
+from models import User
+
 TEST_USER_DATA = {
     "username": "admin",
     "email": "admin@admin.com",
@@ -25,3 +35,72 @@ def test_get_user_by_username(add_user, client):
 def test_login(add_user, user_token, client):
     response = client.get("/users/logined_user", headers={'Authorization': f'Bearer {user_token}'})
     assert response.status_code == 200
+
+
+def test_login_user_is_cached(add_user, user_token, client):
+    client.get("/users/logined_user", headers={'Authorization': f'Bearer {user_token}'})
+    hits = principal_cache.hits
+    response = client.get("/users/logined_user", headers={'Authorization': f'Bearer {user_token}'})
+    assert response.status_code == 200
+    assert response.json()['username'] == TEST_USER_DATA['username']
+    assert principal_cache.hits == hits + 1
+
+
+def test_cached_user_dropped_on_update(add_user, user_token, session, client):
+    headers = {'Authorization': f'Bearer {user_token}'}
+    client.get("/users/logined_user", headers=headers)
+    principal_cache.set('other-token', object(), group='other')
+    assert len(principal_cache) == 2
+
+    user = session.query(User).filter(User.username == TEST_USER_DATA['username']).one()
+    user.first_name = 'Changed'
+    session.commit()
+    assert principal_cache.get(user_token) is None
+    assert len(principal_cache) == 1
+    assert client.get("/users/logined_user", headers=headers).json()['first_name'] == 'Changed'
+
+
+def test_ttl_cache_groups():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set('a', 1, group='x')
+    cache.set('b', 2, group='x')
+    cache.set('c', 3, group='y')
+    assert cache.get('a') is None
+    cache.set('b', 4, group='y')
+    cache.discard_group('y')
+    assert len(cache) == 0
+    cache.discard_group('x')
+    cache.set('d', 5, group='x')
+    assert cache.get('d') == 5
+
+
+def test_login_user_usage(add_user, user_token, add_simple_file, session, client):
+    headers = {'Authorization': f'Bearer {user_token}'}
+    client.put("/files/usage.txt", headers=headers, data=b'12345')
+    response = client.get("/users/logined_user/usage", headers=headers)
+    assert response.status_code == 200
+    # the seeded file bypassed the counters until usage is reconciled
+    assert response.json() == {'used_bytes': 5, 'files_count': 1, 'quota_bytes': None, 'quota_files': None}
+
+    async def reconcile():
+        async with TestingAsyncSessionLocal() as db:
+            return await UserCRUD(db).reconcile_usage()
+    assert asyncio.run(reconcile()) == 1
+    response = client.get("/users/logined_user/usage", headers=headers)
+    assert response.json()['used_bytes'] == 5 + add_simple_file.file_size_bytes
+    assert response.json()['files_count'] == 2
+
+
+def test_get_token_rehashes_password_with_other_cost(session, client):
+    user_data = TEST_USER_DATA.copy()
+    weak_pwd_context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=4)
+    user_data['hashed_password'] = weak_pwd_context.hash(user_data.pop("password"))
+    session.add(User(**user_data))
+    session.commit()
+
+    response = client.post("/users/token", data=TEST_USER_DATA)
+    assert response.status_code == 200
+
+    session.expire_all()
+    db_user = session.query(User).filter(User.username == TEST_USER_DATA['username']).one()
+    assert not db_user.hashed_password.startswith('$2b$04$')